@@ -0,0 +1,5 @@
+"""Benchmarks of ssp.
+
+`benchmarks.run` measures the hot paths against `benchmarks.fake_docker`, a fake Docker Engine,
+with configurations from `benchmarks.synthetic`. The other scripts need a real Docker daemon.
+"""
@@ -0,0 +1,90 @@
+"""Time to a usable shell with 1, 5 and 20 drives, for each drive strategy.
+
+Builds an image per strategy and number of drives from a synthetic ssp.yaml, starts a
+container from it the way `ssp run` does and measures the time until a shell in the
+container would start, i.e. until all drives are mounted.
+
+    python benchmarks/drives.py --from-image ssp_docker_image_free:1.0.0 --server nfs:/export
+"""
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ssp import config  # noqa: E402
+from ssp.context import BuildContext  # noqa: E402
+from ssp.engine import Engine  # noqa: E402
+from ssp.generators import Dockergen  # noqa: E402
+from ssp.model import SSPConfig  # noqa: E402
+from ssp.ssp import SSP_Launcher  # noqa: E402
+
+USER = 'sspbench'
+
+
+def ssp_yaml(options, strategy, count):
+    if strategy == 'bind':
+        drives = [f"{options.bind_source} /mnt/drive{index}" for index in range(count)]
+    else:
+        drives = [f"{options.server} /mnt/drive{index}" for index in range(count)]
+    return {'from_image': options.from_image, 'new_image': f"ssp-benchmark-drives:{strategy}-{count}",
+            'drive_strategy': strategy, 'users': [{'name': USER, 'uid': 4242, 'gid': 4242}], 'drives': drives}
+
+
+def time_to_shell(raw):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Launcher is used only for the container options `ssp run` would use, with all settings of ssp.yaml
+        config_path = pathlib.Path(tmpdir, 'ssp.yaml')
+        config_path.write_text(yaml.safe_dump(raw))
+        launcher = SSP_Launcher.__new__(SSP_Launcher)
+        launcher.config_path = config_path
+        launcher.current_user = USER
+        launcher.reload()
+        ssp_config = launcher.config
+        options = launcher._container_options(None, config.SSP_IDLE_TIMEOUT)
+
+        dockergen = Dockergen(ssp_config, USER)
+        dockergen.generate_dockerfile(pathlib.Path(tmpdir), True, 4242, 4242, stage_copyfiles=False)
+        Engine.build(BuildContext(dockergen.context_files(pathlib.Path(tmpdir))), ssp_config.new_image)
+
+    # The shell waits for the marker of the mount script, volumes are mounted before the start
+    ready = ['sh', '-c', 'test -e /run/ssp-drives-ready' if ssp_config.drive_strategy == 'fstab' else 'true']
+    started = time.monotonic()
+    container = Engine.run_detached(ssp_config.new_image, tty=True, **options)
+    try:
+        while container.exec_run(ready).exit_code != 0:
+            time.sleep(0.01)
+        return time.monotonic() - started
+    finally:
+        container.stop(timeout=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from-image', default=config.SSP_IMAGE_NAME, help="SSP image to build on.")
+    parser.add_argument('--server', required=True, help="NFS export mounted as every drive, e.g. nfs:/export.")
+    parser.add_argument('--bind-source', default=None,
+                        help="Host directory bind mounted as every drive, the NFS export mounted on the host by default.")
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 5, 20], help="Numbers of drives.")
+    parser.add_argument('--strategies', nargs='+', default=list(SSPConfig.DRIVE_STRATEGIES),
+                        choices=SSPConfig.DRIVE_STRATEGIES)
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, the fastest one is reported.")
+    options = parser.parse_args()
+    if 'bind' in options.strategies and not options.bind_source:
+        parser.error("--bind-source is required to benchmark bind strategy")
+
+    print("%-8s %s" % ('strategy', ' '.join("%9s" % f"{count} drives" for count in options.counts)))
+    for strategy in options.strategies:
+        times = [min(time_to_shell(ssp_yaml(options, strategy, count)) for _ in range(options.repeat))
+                 for count in options.counts]
+        print("%-8s %s" % (strategy, ' '.join("%7.2f s" % seconds for seconds in times)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""Fake Docker Engine API server on a unix socket, for benchmarks without a real daemon.
+
+Serves the subset of the Engine API used by ssp: ping, version and info, images (inspect,
+list, tag, build, pull, remove, df), containers (create, start, stop, inspect, list) and
+volumes. Every call is recorded with its duration. Scripted delays simulate a slow daemon,
+e.g. `{'POST /build': 2.0}` makes every build take two seconds.
+
+    with FakeDockerEngine(images=['ssp_docker_image_free:1.0.0']) as engine:
+        os.environ['DOCKER_HOST'] = engine.url
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+API_VERSION = '1.41'
+VERSION_PREFIX = re.compile(r'^/v[0-9.]+')
+
+
+def _image_id(seed):
+    return 'sha256:' + hashlib.sha256(seed.encode('utf-8')).hexdigest()
+
+
+def _matches(labels, filters):
+    # Label filters are `key` or `key=value`, all of them have to match
+    for label in filters.get('label', []):
+        key, separator, value = label.partition('=')
+        if key not in labels or (separator and labels[key] != value):
+            return False
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def _dispatch(self, method):
+        engine = self.server.engine
+        url = urllib.parse.urlsplit(self.path)
+        path = VERSION_PREFIX.sub('', url.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        body = self._body()
+        started = time.monotonic()
+        delay = engine.delay(method, path)
+        if delay:
+            time.sleep(delay)
+        try:
+            status, response = engine.handle(method, urllib.parse.unquote(path), query, body)
+        except KeyError as error:
+            status, response = 404, {'message': 'No such object: %s' % error}
+        if isinstance(response, list) and response and isinstance(response[0], bytes):
+            self._stream(status, response)
+        else:
+            self._send(status, response)
+        engine.record(method, path, time.monotonic() - started)
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status, response):
+        data = response if isinstance(response, bytes) else json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain' if isinstance(response, bytes) else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Api-Version', API_VERSION)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, status, chunks):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class FakeDockerEngine:
+    """Docker Engine API served from memory on a unix socket in a temporary directory.
+
+    :param images: Names of images present from the start, e.g. `from_image` of ssp.yaml.
+    :type images: [str]
+    :param delays: Seconds added to calls, by `METHOD /path` prefix without API version.
+    :type delays: {str: float}
+    :param image_size: Size reported for every image.
+    :type image_size: int
+    """
+
+    def __init__(self, images=(), delays=None, image_size=2 * 2**30):
+        self.delays = dict(delays or {})
+        self.image_size = image_size
+        self.calls = []
+        self.images = {}
+        self.containers = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        for name in images:
+            self._add_image(name, {})
+        self._directory = None
+        self._server = None
+
+    @property
+    def url(self):
+        return 'unix://' + self.socket_path
+
+    def start(self):
+        self._directory = tempfile.TemporaryDirectory(prefix='ssp-fake-docker-')
+        self.socket_path = os.path.join(self._directory.name, 'docker.sock')
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.engine = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._directory.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def delay(self, method, path):
+        request = f"{method} {path}"
+        return next((seconds for prefix, seconds in self.delays.items() if request.startswith(prefix)), 0.0)
+
+    def record(self, method, path, seconds):
+        with self._lock:
+            self.calls.append((method, path, seconds))
+
+    def summary(self):
+        """Number of calls and seconds spent by endpoint, ids in paths are replaced by `{id}`."""
+        summary = {}
+        for method, path, seconds in self.calls:
+            endpoint = '%s %s' % (method, re.sub(r'/(containers|images)/(?!json$|create$)[^/]+(/|$)', r'/\1/{id}\2', path))
+            count, total = summary.get(endpoint, (0, 0.0))
+            summary[endpoint] = (count + 1, total + seconds)
+        return summary
+
+    def handle(self, method, path, query, body):
+        with self._lock:
+            return self._handle(method, path, query, body)
+
+    def _handle(self, method, path, query, body):
+        filters = json.loads(query.get('filters') or '{}')
+        if path == '/_ping':
+            return 200, b'OK'
+        if path == '/version':
+            return 200, {'ApiVersion': API_VERSION, 'Version': 'fake', 'MinAPIVersion': '1.12'}
+        if path == '/info':
+            return 200, {'NCPU': os.cpu_count(), 'Name': 'fake-docker'}
+        if path == '/system/df':
+            return 200, {'LayersSize': self.image_size * len(self.images), 'Volumes': [], 'Containers': [],
+                         'Images': [dict(self._summary(image), SharedSize=0) for image in self._unique_images()]}
+        if path == '/build' and method == 'POST':
+            labels = json.loads(query.get('labels') or '{}')
+            image = self._add_image(query['t'], labels, seed=hashlib.sha256(body).hexdigest())
+            return 200, [json.dumps({'stream': 'Step 1/1 : fake build of %d bytes\n' % len(body)}).encode('utf-8'),
+                         json.dumps({'aux': {'ID': image['Id']}}).encode('utf-8')]
+        if path == '/images/create' and method == 'POST':
+            self._add_image('%s:%s' % (query['fromImage'], query.get('tag', 'latest')), {})
+            return 200, [json.dumps({'status': 'Pull complete', 'id': 'fake'}).encode('utf-8')]
+        if path == '/images/json':
+            return 200, [self._summary(image) for image in self._unique_images()
+                         if _matches(image['Config']['Labels'], filters)]
+        match = re.match(r'^/images/(.+?)(/json|/tag)?$', path)
+        if match:
+            image = self._image(match.group(1))
+            if match.group(2) == '/json':
+                return 200, image
+            if match.group(2) == '/tag':
+                name = query['repo'] + (':' + query['tag'] if query.get('tag') else '')
+                self._name(image, name)
+                return 201, b''
+            if method == 'DELETE':
+                for name in [name for name, other in self.images.items() if other is image]:
+                    del self.images[name]
+                return 200, [{'Deleted': image['Id']}]
+        if path == '/containers/create':
+            return self._create(json.loads(body.decode('utf-8')), query)
+        if path == '/containers/json':
+            return 200, [{'Id': container['Id'], 'Labels': container['Config']['Labels']}
+                         for container in self.containers.values()
+                         if (query.get('all') in ('1', 'true') or container['State']['Status'] == 'running')
+                         and _matches(container['Config']['Labels'], filters)]
+        match = re.match(r'^/containers/([^/]+)(/\w+)?$', path)
+        if match:
+            container = self.containers[match.group(1)]
+            action = match.group(2)
+            if action == '/json':
+                return 200, container
+            if action in ('/start', '/stop', '/wait', '/kill'):
+                container['State']['Status'] = 'running' if action == '/start' else 'exited'
+                return (200, {'StatusCode': 0}) if action == '/wait' else (204, b'')
+            if method == 'DELETE':
+                del self.containers[match.group(1)]
+                return 204, b''
+        if path == '/volumes':
+            return 200, {'Volumes': [], 'Warnings': None}
+        return 404, {'message': 'Not supported by fake Docker: %s %s' % (method, path)}
+
+    def _add_image(self, name, labels, seed=None):
+        image = {'Id': _image_id(seed or name), 'RepoTags': [], 'Size': self.image_size,
+                 'Created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'RepoDigests': [],
+                 'Config': {'Labels': labels}}
+        # Same content is the same image
+        image = next((other for other in self.images.values() if other['Id'] == image['Id']), image)
+        self._name(image, name)
+        return image
+
+    def _name(self, image, name):
+        if ':' not in name.rpartition('/')[2]:
+            name += ':latest'
+        previous = self.images.get(name)
+        if previous is not None and previous is not image:
+            previous['RepoTags'].remove(name)
+        self.images[name] = image
+        self.images[image['Id']] = image
+        if name not in image['RepoTags']:
+            image['RepoTags'].append(name)
+
+    def _image(self, name):
+        image = self.images.get(name) or self.images.get(name + ':latest') or self.images.get('sha256:' + name)
+        if image is None:
+            raise KeyError(name)
+        return image
+
+    def _unique_images(self):
+        return list({image['Id']: image for image in self.images.values()}.values())
+
+    def _summary(self, image):
+        return {'Id': image['Id'], 'RepoTags': image['RepoTags'], 'Labels': image['Config']['Labels'],
+                'Size': image['Size'], 'Created': int(time.time()), 'Containers': 0}
+
+    def _create(self, spec, query):
+        image = self._image(spec['Image'])
+        container_id = hashlib.sha256(str(next(self._ids)).encode('utf-8')).hexdigest()
+        self.containers[container_id] = {
+            'Id': container_id, 'Name': '/' + (query.get('name') or 'fake_%s' % container_id[:6]),
+            'Image': image['Id'], 'Config': {'Image': spec['Image'], 'Labels': spec.get('Labels') or {}},
+            'HostConfig': spec.get('HostConfig') or {}, 'State': {'Status': 'created', 'Running': False},
+            'NetworkSettings': {'IPAddress': '172.17.0.2', 'Ports': {}}, 'ExecIDs': None}
+        return 201, {'Id': container_id, 'Warnings': []}
@@ -0,0 +1,82 @@
+"""Import-time benchmark of the `ssp` console script.
+
+Runs `ssp version` and `ssp --help` under `python -X importtime` and fails when the
+time spent importing modules exceeds the budget, or when a heavy dependency which
+only some subcommands need is imported.
+
+    python benchmarks/import_time.py --budget-ms 50
+"""
+import argparse
+import os
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+COMMANDS = [['version'], ['--help']]
+# Dependencies which must not be imported just to print version or help
+FORBIDDEN = ['docker', 'requests', 'inquirer', 'yaml', 'ssp.ssp']
+RUNNER = "import sys; from ssp.cli import ssp; sys.argv = ['ssp'] + sys.argv[1:]; ssp()"
+
+
+def import_times(code, args=()):
+    """Run code with -X importtime, return {module: cumulative microseconds} of top-level imports."""
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code] + list(args),
+                            cwd=str(ROOT), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = {}
+    imported = set()
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imported.add(name.strip())
+        # Nested imports are indented, only top-level ones are summed
+        if not name.startswith('  ', 1):
+            times[name.strip()] = int(cumulative)
+    return times, imported
+
+
+def measure(args, repeat):
+    startup, _ = import_times('pass')
+    best = None
+    for _ in range(repeat):
+        times, imported = import_times(RUNNER, args)
+        times = {module: us for module, us in times.items() if module not in startup}
+        total = sum(times.values())
+        if best is None or total < best[0]:
+            best = (total, times, imported)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=50.0,
+                        help="Maximal import time of one command in milliseconds.")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs, the fastest one is reported.")
+    options = parser.parse_args()
+
+    failed = False
+    for args in COMMANDS:
+        total, times, imported = measure(args, options.repeat)
+        command = ' '.join(['ssp'] + args)
+        heaviest = sorted(times.items(), key=lambda item: -item[1])[:5]
+        print("%-14s %7.1f ms  (budget %.1f ms)" % (command, total / 1000, options.budget_ms))
+        for module, us in heaviest:
+            print("    %-30s %7.1f ms" % (module, us / 1000))
+
+        if total / 1000 > options.budget_ms:
+            print("    FAIL: over budget")
+            failed = True
+        for module in FORBIDDEN:
+            if module in imported:
+                print("    FAIL: imports %s" % module)
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Image size and build time of the ownership strategies of the generated Dockerfile.
+
+Builds a synthetic image with an SSP-like /prj/ssp tree, then builds one image per
+ownership strategy on top of it and reports the build time and how much each strategy
+adds to the image. The tree has a /prj/ssp/.cpm like an installation after `cpm init`:
+many small state and metadata files and large downloaded package archives. `--owned` files
+directly in /prj/ssp already belong to the container user, as in images installed as that user.
+
+    python benchmarks/ownership.py --tree-mib 512 --files 64 --cpm-mib 256 --owned 32
+"""
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ssp.context import BuildContext, format_size  # noqa: E402
+from ssp.engine import Engine  # noqa: E402
+from ssp.generators import Dockergen  # noqa: E402
+from ssp.model import SSPConfig  # noqa: E402
+
+TREE_IMAGE = 'ssp-benchmark-ownership:tree'
+# Container user the strategies give /prj/ssp to
+UID = 1000
+TREE_DOCKERFILE = """FROM {base}
+RUN mkdir -p /prj/ssp/.cpm/packages /prj/ssp/.cpm/cache /prj/ssp/packages \\
+    && for i in $(seq 1 {files}); do \\
+         head -c {file_size} /dev/urandom > /prj/ssp/file-$i.bin; \\
+         if [ $i -le {owned} ]; then chown {uid}:{uid} /prj/ssp/file-$i.bin; fi; \\
+         mkdir -p /prj/ssp/packages/p$i && head -c {file_size} /dev/urandom > /prj/ssp/packages/p$i/data.bin; \\
+         mkdir -p /prj/ssp/.cpm/packages/p$i \\
+         && head -c 2048 /dev/urandom > /prj/ssp/.cpm/packages/p$i/package.json \\
+         && head -c 16384 /dev/urandom > /prj/ssp/.cpm/packages/p$i/files.list \\
+         && head -c {archive_size} /dev/urandom > /prj/ssp/.cpm/cache/p$i.tar.gz; \\
+       done \\
+    && head -c 4096 /dev/urandom > /prj/ssp/.cpm/state
+"""
+
+
+def build(dockerfile, tag):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir, 'Dockerfile')
+        path.write_text(dockerfile)
+        started = time.monotonic()
+        Engine.build(BuildContext([('Dockerfile', path)]), tag)
+        elapsed = time.monotonic() - started
+    return elapsed, Engine.client().images.get(tag).attrs['Size']
+
+
+def remove(tag):
+    if Engine.client().images.list(tag):
+        Engine.client().images.remove(tag, force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base', default='debian:stable-slim',
+                        help="Image the synthetic /prj/ssp tree is created in.")
+    parser.add_argument('--tree-mib', type=int, default=256,
+                        help="Size of the synthetic /prj/ssp tree in MiB.")
+    parser.add_argument('--files', type=int, default=32,
+                        help="Number of files directly in /prj/ssp, the same number of packages is in subdirectories and .cpm.")
+    parser.add_argument('--cpm-mib', type=int, default=128,
+                        help="Size of package archives downloaded by cpm to /prj/ssp/.cpm/cache in MiB.")
+    parser.add_argument('--owned', type=int, default=None,
+                        help="Number of files directly in /prj/ssp owned by the container user already, half of them by default.")
+    parser.add_argument('--keep', action='store_true', help="Do not remove the built images.")
+    options = parser.parse_args()
+
+    file_size = options.tree_mib * 2**20 // (2 * options.files)
+    archive_size = options.cpm_mib * 2**20 // options.files
+    print("Building /prj/ssp tree of %s with %s in .cpm" % (
+        format_size(2 * options.files * file_size), format_size(options.files * (archive_size + 18432) + 4096)))
+    owned = options.files // 2 if options.owned is None else options.owned
+    _, tree_size = build(TREE_DOCKERFILE.format(
+        base=options.base, files=options.files, file_size=file_size, archive_size=archive_size,
+        owned=owned, uid=UID), TREE_IMAGE)
+
+    results = []
+    for strategy in SSPConfig.OWNERSHIP_STRATEGIES:
+        tag = f"ssp-benchmark-ownership:{strategy}"
+        dockerfile = f"FROM {TREE_IMAGE}\n" + Dockergen.ownership_instruction(strategy, UID, UID)
+        # Layer cache would make the second run of a strategy free
+        remove(tag)
+        elapsed, size = build(dockerfile, tag)
+        results.append((strategy, elapsed, size - tree_size))
+
+    print("%-8s %10s %12s" % ('strategy', 'build', 'added size'))
+    for strategy, elapsed, added in results:
+        print("%-8s %8.2f s %12s" % (strategy, elapsed, format_size(added)))
+
+    if not options.keep:
+        for strategy in SSPConfig.OWNERSHIP_STRATEGIES:
+            remove(f"ssp-benchmark-ownership:{strategy}")
+        remove(TREE_IMAGE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Benchmarks of the hot paths of ssp, against a fake Docker Engine instead of a real daemon.
+
+Every case is run `--repeat` times and the fastest run is reported. A case fails when it is
+slower than its threshold, or slower than the `--baseline` result by more than `--tolerance`.
+Results saved by `--save` of one release are the baseline of the next one.
+
+    python -m benchmarks.run --save benchmarks-1.0.json
+    python -m benchmarks.run --baseline benchmarks-1.0.json --tolerance 0.25
+"""
+import argparse
+import contextlib
+import getpass
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+RUNNER = "import sys; from ssp.cli import ssp; sys.argv = ['ssp'] + sys.argv[1:]; ssp()"
+
+# Milliseconds, generous enough for a loaded CI machine
+THRESHOLDS = {
+    'config.from_yaml': 100.0,
+    'config.load_cached': 10.0,
+    'yamlgen.dump': 100.0,
+    'launcher.init': 20.0,
+    'dockergen.generate': 50.0,
+    'copyfiles.stage_cold': 1000.0,
+    'copyfiles.stage_warm': 150.0,
+    'context.digest_warm': 150.0,
+    'cli.version': 300.0,
+    'cli.run_dry_run': 1500.0,
+    'cli.run_build': 2500.0,
+    'cli.run_cached': 1500.0,
+}
+
+
+class Suite:
+    """Synthetic configurations and the environment the cases run in."""
+
+    def __init__(self, where, options):
+        from benchmarks import synthetic
+        from ssp.model import SSPConfig
+
+        self.where = where
+        self.options = options
+        self.user = getpass.getuser()
+        self.sources = synthetic.write_copyfiles(
+            where / 'sources', [options.copyfile_mib * 2**20] * options.copyfiles, options.tree_files)
+        self.config_path, self.ssp_config = synthetic.write_config(
+            where / 'project', users=options.users, groups=options.groups, drives=options.drives,
+            symlinks=options.drives, exports=options.exports, copyfiles=self.sources, user=self.user)
+        self.raw = synthetic.ssp_yaml(users=options.users, groups=options.groups, drives=options.drives,
+                                      symlinks=options.drives, exports=options.exports, copyfiles=self.sources,
+                                      user=self.user)
+        self.content = self.config_path.read_bytes()
+        SSPConfig.load(self.config_path)
+        self.stub_path = where / 'bin'
+        self.stub_path.mkdir()
+        # `ssp run` attaches the terminal by docker CLI, the benchmark ends at the container start
+        docker = self.stub_path / 'docker'
+        docker.write_text('#!/bin/sh\nexit 0\n')
+        docker.chmod(0o755)
+
+    def case_config_from_yaml(self):
+        from ssp.model import SSPConfig
+        return _timed(SSPConfig.from_yaml, self.content)
+
+    def case_config_load_cached(self):
+        from ssp.model import SSPConfig
+        return _timed(SSPConfig.load, self.config_path)
+
+    def case_yamlgen_dump(self):
+        from ssp.generators import Yamlgen
+        return _timed(Yamlgen('dump.yaml', self.where).generate_yamlfile, self.raw)
+
+    def case_launcher_init(self):
+        from ssp.ssp import SSP_Launcher
+        return _timed(SSP_Launcher, self.config_path)
+
+    def case_dockergen_generate(self):
+        from ssp.generators import Dockergen
+        dockergen = Dockergen(self.ssp_config, self.user)
+        return _timed(dockergen.generate_dockerfile, self.where / 'context', True, 2000, 2000, False)
+
+    def case_copyfiles_stage_cold(self):
+        from ssp import manifest
+        staged = self.where / 'staged'
+        shutil.rmtree(str(staged), ignore_errors=True)
+        return _timed(manifest.stage, self._files(), staged)
+
+    def case_copyfiles_stage_warm(self):
+        from ssp import manifest
+        staged = self.where / 'staged'
+        manifest.stage(self._files(), staged)
+        return _timed(manifest.stage, self._files(), staged)
+
+    def case_context_digest_warm(self):
+        from ssp.generators import Dockergen
+        dockergen = Dockergen(self.ssp_config, self.user)
+        context = self.where / 'context'
+        dockergen.generate_dockerfile(context, True, 2000, 2000, stage_copyfiles=False)
+        dockergen.context_digest(context, 'sha256:0')
+        return _timed(Dockergen(self.ssp_config, self.user).context_digest, context, 'sha256:0')
+
+    def case_cli_version(self):
+        return self._ssp(['version'])
+
+    def case_cli_run_dry_run(self):
+        with self._engine() as engine:
+            return self._ssp(['run', '--dry-run'], engine), len(engine.calls)
+
+    def case_cli_run_build(self):
+        with self._engine() as engine:
+            return self._ssp(['run', '--rebuild'], engine), len(engine.calls)
+
+    def case_cli_run_cached(self):
+        with self._engine() as engine:
+            self._ssp(['run'], engine)
+            count = len(engine.calls)
+            return self._ssp(['run'], engine), len(engine.calls) - count
+
+    def _files(self):
+        from ssp import manifest
+        return [item for source, _ in self.sources for item in manifest.walk(source, source.name)]
+
+    @contextlib.contextmanager
+    def _engine(self):
+        from benchmarks.fake_docker import FakeDockerEngine
+        from benchmarks.synthetic import FROM_IMAGE
+        delays = {'POST /build': self.options.build_delay} if self.options.build_delay else {}
+        with FakeDockerEngine(images=[FROM_IMAGE], delays=delays) as engine:
+            yield engine
+
+    def _ssp(self, args, engine=None):
+        env = dict(os.environ, PYTHONPATH=str(ROOT), PATH='%s%s%s' % (self.stub_path, os.pathsep, os.environ['PATH']))
+        if engine is not None:
+            env['DOCKER_HOST'] = engine.url
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', RUNNER] + args, cwd=str(self.config_path.parent), env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return time.perf_counter() - started
+
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def run_cases(suite, names, repeat):
+    """Run cases, return {name: {'ms': fastest run, 'calls': Docker API calls of the run or None}}."""
+    results = OrderedDict()
+    for name in names:
+        case = getattr(suite, 'case_' + name.replace('.', '_'))
+        best = None
+        for _ in range(repeat):
+            measured = case()
+            seconds, calls = measured if isinstance(measured, tuple) else (measured, None)
+            if best is None or seconds < best[0]:
+                best = (seconds, calls)
+        results[name] = {'ms': best[0] * 1000, 'calls': best[1]}
+    return results
+
+
+def check(results, thresholds, baseline=None, tolerance=0.25):
+    """Failures of cases over threshold or slower than the baseline."""
+    failures = []
+    for name, result in results.items():
+        if result['ms'] > thresholds[name]:
+            failures.append("%s: %.1f ms over threshold %.1f ms" % (name, result['ms'], thresholds[name]))
+        previous = (baseline or {}).get(name)
+        if previous and result['ms'] > previous['ms'] * (1 + tolerance):
+            failures.append("%s: %.1f ms is %.0f %% slower than baseline %.1f ms" % (
+                name, result['ms'], (result['ms'] / previous['ms'] - 1) * 100, previous['ms']))
+        if previous and previous.get('calls') is not None and (result['calls'] or 0) > previous['calls']:
+            failures.append("%s: %d Docker API calls, baseline %d" % (name, result['calls'], previous['calls']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*', metavar='CASE', help="Cases to run, all by default: %s." % ', '.join(THRESHOLDS))
+    parser.add_argument('--repeat', type=int, default=5, help="Number of runs of a case, the fastest one is reported.")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--drives', type=int, default=20)
+    parser.add_argument('--exports', type=int, default=50)
+    parser.add_argument('--copyfiles', type=int, default=4, help="Number of copyfiles sources.")
+    parser.add_argument('--copyfile-mib', type=int, default=16, help="Size of every copyfiles source in MiB.")
+    parser.add_argument('--tree-files', type=int, default=1000, help="Files of the directory copyfiles source.")
+    parser.add_argument('--build-delay', type=float, default=0.0, help="Seconds every build of the fake Docker takes.")
+    parser.add_argument('--threshold', action='append', default=[], metavar='CASE=MS', help="Override threshold of a case.")
+    parser.add_argument('--baseline', type=pathlib.Path, help="Results saved by --save to compare with.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown against the baseline, 0.25 is 25 %%.")
+    parser.add_argument('--save', type=pathlib.Path, help="Save results as JSON.")
+    options = parser.parse_args()
+
+    thresholds = dict(THRESHOLDS)
+    for item in options.threshold:
+        name, _, value = item.partition('=')
+        thresholds[name] = float(value)
+    names = options.cases or list(THRESHOLDS)
+    unknown = [name for name in names if name not in thresholds]
+    if unknown:
+        parser.error("unknown cases: %s" % ', '.join(unknown))
+
+    with tempfile.TemporaryDirectory(prefix='ssp-benchmarks-') as tmpdir:
+        where = pathlib.Path(tmpdir)
+        # ssp reads its paths when imported, they must not touch state of the user
+        os.environ.update(SSP_STATE_PATH=str(where / 'state'), SSP_DOCKERFILE_PATH=str(where / 'dockerfile'))
+        os.environ.pop('SSP_DISK_BUDGET', None)
+        sys.path.insert(0, str(ROOT))
+        import ssp
+
+        results = run_cases(Suite(where, options), names, options.repeat)
+
+    baseline = json.loads(options.baseline.read_text())['cases'] if options.baseline else None
+    print("%-24s %10s %10s %10s %6s" % ('case', 'time', 'threshold', 'baseline', 'calls'))
+    for name, result in results.items():
+        previous = (baseline or {}).get(name)
+        print("%-24s %7.1f ms %7.1f ms %10s %6s" % (
+            name, result['ms'], thresholds[name], '%7.1f ms' % previous['ms'] if previous else '-',
+            result['calls'] if result['calls'] is not None else ''))
+    if options.save:
+        options.save.write_text(json.dumps({'version': ssp.__version__, 'python': sys.version.split()[0],
+                                            'cases': results}, indent=2))
+    failures = check(results, thresholds, baseline, options.tolerance)
+    for failure in failures:
+        print("FAIL %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
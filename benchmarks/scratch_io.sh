@@ -0,0 +1,64 @@
+#!/bin/sh
+# Throughput of the container overlay filesystem compared to tmpfs scratch space.
+#
+# Runs inside an SSP container started with scratch space, e.g. `ssp run --scratch-size 4G`:
+#
+#     sh scratch_io.sh [scratch] [overlay] [MiB] [files]
+#
+# Writes and reads one large file and creates many small files, like simulation
+# dumps and compiled models do, in both directories and prints the times.
+set -eu
+
+scratch=${1:-/scratch}
+overlay=${2:-/var/tmp}
+mib=${3:-1024}
+files=${4:-5000}
+
+now() {
+    date +%s.%N
+}
+
+seconds() {
+    echo "$1 $2" | awk '{ printf "%.2f", $2 - $1 }'
+}
+
+rate() {
+    echo "$1 $2" | awk '{ if ($2 > 0) printf "%.0f MiB/s", $1 / $2; else printf "-" }'
+}
+
+measure() {
+    dir=$1/ssp-scratch-io.$$
+    mkdir -p "$dir"
+
+    started=$(now)
+    dd if=/dev/zero of="$dir/large" bs=1M count="$mib" conv=fsync 2>/dev/null
+    write=$(seconds "$started" "$(now)")
+
+    # Drop the page cache when allowed, tmpfs is memory anyway
+    sync
+    echo 3 > /proc/sys/vm/drop_caches 2>/dev/null || true
+    started=$(now)
+    dd if="$dir/large" of=/dev/null bs=1M 2>/dev/null
+    read=$(seconds "$started" "$(now)")
+    rm -f "$dir/large"
+
+    started=$(now)
+    i=0
+    while [ "$i" -lt "$files" ]; do
+        head -c 4096 /dev/zero > "$dir/small.$i"
+        i=$((i + 1))
+    done
+    sync
+    rm -rf "$dir"
+    small=$(seconds "$started" "$(now)")
+
+    printf "%-30s %14s %14s %12s s\n" "$1" "$(rate "$mib" "$write")" "$(rate "$mib" "$read")" "$small"
+}
+
+if ! grep -qs " $scratch tmpfs " /proc/mounts; then
+    echo "warning: $scratch is not tmpfs, start the container with scratch space" >&2
+fi
+
+printf "%-30s %14s %14s %14s\n" "directory" "write" "read" "$files files"
+measure "$overlay"
+measure "$scratch"
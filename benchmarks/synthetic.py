@@ -0,0 +1,77 @@
+"""Synthetic ssp.yaml configurations of chosen size for benchmarks."""
+import pathlib
+
+from ssp.model import SSPConfig
+
+FROM_IMAGE = 'ssp_docker_image_free:1.0.0'
+NEW_IMAGE = 'ssp-benchmark:latest'
+
+
+def ssp_yaml(users=1, groups=0, drives=0, symlinks=0, exports=0, copyfiles=(), user='sspbench', **options):
+    """Raw ssp.yaml content.
+
+    :param users: Number of users, the first one is `user`.
+    :param copyfiles: Pairs of source and target of copyfiles, see :func:`write_copyfiles`.
+    :param options: Other top-level keys, e.g. `layer_order='cost'`.
+    :rtype: dict
+    """
+    names = [user] + ['user%03d' % index for index in range(1, users)]
+    group_names = ['group%03d' % index for index in range(groups)]
+    raw = {
+        'from_image': FROM_IMAGE,
+        'new_image': NEW_IMAGE,
+        'groups': {name: 5000 + index for index, name in enumerate(group_names)},
+        'users': [{'name': name, 'uid': 2000 + index, 'gid': 2000 + index, 'shell': '/bin/bash',
+                   'groups': group_names[index % groups:index % groups + 1] if groups else []}
+                  for index, name in enumerate(names)],
+        'drives': ['storage%d.example.com:/export/drive%d /mnt/drive%d' % (index % 4, index, index)
+                   for index in range(drives)],
+        'symlinks': ['/mnt/drive%d /home/link%d' % (index % max(drives, 1), index) for index in range(symlinks)],
+        'copyfiles': ['%s %s' % (source, target) for source, target in copyfiles],
+        'export': ['MGEN_TOOL%d_INSTALLDIR=/eda/tool%d' % (index, index) for index in range(exports)],
+    }
+    raw.update(options)
+    return raw
+
+
+def write_copyfiles(where, sizes, directory_files=0):
+    """Create copyfiles sources of given sizes in bytes, filled with repeating data.
+
+    :param directory_files: When set, also creates a directory source with this many 4 KiB files.
+    :return: Pairs of source and target for :func:`ssp_yaml`.
+    :rtype: [(pathlib.Path, str)]
+    """
+    where = pathlib.Path(where)
+    where.mkdir(parents=True, exist_ok=True)
+    pairs = []
+    block = bytes(range(256)) * 4096
+    for index, size in enumerate(sizes):
+        path = where / ('file%d.bin' % index)
+        with path.open('wb') as fp:
+            remaining = size
+            while remaining > 0:
+                remaining -= fp.write(block[:remaining])
+        pairs.append((path, '/opt/bench/file%d.bin' % index))
+    if directory_files:
+        directory = where / 'tree'
+        for index in range(directory_files):
+            path = directory / ('d%02d' % (index % 16)) / ('f%05d' % index)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(block[:4096])
+        pairs.append((directory, '/opt/bench/tree'))
+    return pairs
+
+
+def write_config(where, **kwargs):
+    """Write ssp.yaml with :func:`ssp_yaml` content into directory `where`.
+
+    :return: Path of ssp.yaml and the validated configuration.
+    :rtype: (pathlib.Path, ssp.model.SSPConfig)
+    """
+    from ssp.generators import Yamlgen
+
+    where = pathlib.Path(where)
+    where.mkdir(parents=True, exist_ok=True)
+    raw = ssp_yaml(**kwargs)
+    Yamlgen('ssp.yaml', where).generate_yamlfile(raw)
+    return where / 'ssp.yaml', SSPConfig.from_dict(raw)
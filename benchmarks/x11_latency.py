@@ -0,0 +1,151 @@
+"""Round-trip latency of X11 requests from an SSP container, for `ssh -X` and the local display.
+
+Starts a container of the customized image of ssp.yaml for each display mode, the way
+`ssp run -X` does, and runs a minimal X client in it. The client sends GetInputFocus
+requests one by one and waits for every reply, like toolkits do on XSync. Needs a local
+X server, the image built by `ssp build` and python3 in the image.
+
+    python benchmarks/x11_latency.py --count 2000
+"""
+import argparse
+import json
+import os
+import pathlib
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+# GetInputFocus has no arguments and a fixed size reply
+GET_INPUT_FOCUS = struct.pack('<BxH', 43, 1)
+
+
+def _recv(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("X server closed the connection")
+        data += chunk
+    return data
+
+
+def _cookie(number):
+    # Entries of Xauthority are family and four length prefixed fields, all big endian
+    path = os.environ.get('XAUTHORITY') or os.path.expanduser('~/.Xauthority')
+    try:
+        data = pathlib.Path(path).read_bytes()
+    except OSError:
+        return b'', b''
+    offset, found = 0, (b'', b'')
+    while offset + 2 <= len(data):
+        offset += 2
+        fields = []
+        for _ in range(4):
+            length, = struct.unpack('>H', data[offset:offset + 2])
+            fields.append(data[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        _, entry_number, name, cookie = fields
+        if name == b'MIT-MAGIC-COOKIE-1' and entry_number.decode() == number:
+            return name, cookie
+        if name == b'MIT-MAGIC-COOKIE-1' and not found[0]:
+            found = (name, cookie)
+    return found
+
+
+def connect(display):
+    host, _, rest = display.rpartition(':')
+    number = rest.partition('.')[0]
+    if host in ('', 'unix'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(f"/tmp/.X11-unix/X{number}")
+    else:
+        # E.g. localhost:10.0 of ssh X forwarding
+        connection = socket.create_connection((host, 6000 + int(number)))
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    name, cookie = _cookie(number)
+    pad = lambda data: data + b'\0' * (-len(data) % 4)  # noqa: E731
+    connection.sendall(struct.pack('<BxHHHHxx', ord('l'), 11, 0, len(name), len(cookie)) + pad(name) + pad(cookie))
+    status, _, _, _, length = struct.unpack('<BBHHH', _recv(connection, 8))
+    reason = _recv(connection, length * 4)
+    if status != 1:
+        raise ConnectionError("X server refused the connection: %s" % reason.decode(errors='replace').strip('\0 '))
+    return connection
+
+
+def client(count):
+    """Measure round-trips to the X server of DISPLAY, print their statistics as JSON."""
+    connection = connect(os.environ['DISPLAY'])
+    times = []
+    for _ in range(count):
+        started = time.perf_counter()
+        connection.sendall(GET_INPUT_FOCUS)
+        _recv(connection, 32)
+        times.append(time.perf_counter() - started)
+    connection.close()
+    times.sort()
+    print(json.dumps({'median': statistics.median(times), 'p95': times[int(len(times) * 0.95)],
+                      'mean': statistics.mean(times), 'count': count}))
+
+
+def measure(launcher, mode, count):
+    from ssp import display, probe
+    from ssp.engine import Engine
+
+    user = launcher.current_user
+    local_display = display.LocalDisplay(share_ipc=launcher.display_ipc) if mode == 'local' else None
+    if local_display and local_display.unavailable():
+        raise SystemExit("Unable to share the local display: %s" % local_display.unavailable())
+    options = launcher._container_options(None, 600, local_display)
+    image = launcher.config.user_image(user)
+    ports = {'22/tcp': None} if mode == 'ssh' else {}
+    container = Engine.run_detached(image, tty=True, ports=ports, **options)
+    try:
+        script = pathlib.Path(__file__).read_bytes()
+        arguments = ['python3', '-', '--client', '--count', str(count)]
+        if mode == 'ssh':
+            probe.SSHReadiness(container).wait()
+            container.reload()
+            address = container.attrs['NetworkSettings']['IPAddress']
+            command = ['ssh', '-X', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                       f"{user}@{address}"] + arguments
+        else:
+            command = ['docker', 'exec', '-i', '-u', user, container.id] + arguments
+        output = subprocess.run(command, input=script, stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(output.decode().strip().splitlines()[-1])
+    finally:
+        container.stop(timeout=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--client', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--config', type=pathlib.Path, default=None, help="ssp.yaml of the image, SSP_CONFIG_PATH by default.")
+    parser.add_argument('--count', type=int, default=1000, help="Number of round-trips.")
+    parser.add_argument('--modes', nargs='+', default=['ssh', 'local'], choices=['ssh', 'local'])
+    parser.add_argument('--display-ipc', action='store_true', help="Share IPC namespace with the local display.")
+    options = parser.parse_args()
+    if options.client:
+        client(options.count)
+        return 0
+
+    sys.path.insert(0, str(ROOT))
+    from ssp import config
+    from ssp.ssp import SSP_Launcher
+
+    launcher = SSP_Launcher(options.config or config.SSP_CONFIG_PATH)
+    launcher.set_display(share_ipc=options.display_ipc)
+    print("%-6s %12s %12s %12s" % ('mode', 'median', 'p95', 'mean'))
+    for mode in options.modes:
+        result = measure(launcher, mode, options.count)
+        print("%-6s %9.1f us %9.1f us %9.1f us" % (
+            mode, result['median'] * 1e6, result['p95'] * 1e6, result['mean'] * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
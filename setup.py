@@ -7,7 +7,7 @@ setup(name='ssp',
       version=ssp.__version__,
       author='Codasip s.r.o',
       author_email='support@codasip.com',
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
       python_requires='>=3.6',
       entry_points='''
             [console_scripts]
@@ -0,0 +1,257 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import pathlib
+import select
+import socket
+import socketserver
+import threading
+import time
+
+from ssp import config, manifest
+from ssp.exceptions import Exceptions
+
+
+class Watcher:
+    """Waits for changes of files, using inotify on Linux and polling elsewhere.
+
+    Parent directories of the files are watched, so that files replaced by editors
+    (written to a temporary file and renamed) are noticed as well.
+    """
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._libc = None
+        self._fd = -1
+        self._watched = set()
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as error:
+            logging.debug("inotify is not available, polling for changes: %s" % error)
+        if self._fd < 0:
+            logging.debug("inotify is not available, polling every %.1f s" % poll_interval)
+
+    def watch(self, paths):
+        if self._fd < 0:
+            return
+        for path in paths:
+            directory = str(path if path.is_dir() else path.parent)
+            if directory in self._watched:
+                continue
+            if self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK) < 0:
+                logging.debug("Unable to watch %s: %s" % (directory, os.strerror(ctypes.get_errno())))
+                continue
+            self._watched.add(directory)
+
+    def wait(self, timeout):
+        """Block until something in a watched directory changes, at most for `timeout` seconds.
+
+        :return: True when there may be a change. Polling always reports a possible change.
+        :rtype: bool
+        """
+        if self._fd < 0:
+            time.sleep(min(timeout, self.poll_interval))
+            return True
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        # Drain the events, files are compared by their signature anyway
+        try:
+            while os.read(self._fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8') or '{}')
+        except ValueError:
+            request = {}
+        agent = self.server.agent
+        if request.get('command') == 'wait' and request.get('config') == str(agent.config_path):
+            status = agent.wait_idle(request.get('timeout'))
+        else:
+            status = agent.status()
+        self.wfile.write(json.dumps(status).encode('utf-8') + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent:
+    """Rebuilds the customized image in background whenever ssp.yaml or `copyfiles` sources change.
+
+    Changes are debounced, so a build starts only when the files were not changed for
+    `debounce` seconds. The state of the builds is served as JSON on a unix socket,
+    see :class:`AgentClient`.
+    """
+    BUSY = ('pending', 'building')
+
+    def __init__(self, launcher, skip_config=False, debounce=config.SSP_AGENT_DEBOUNCE,
+                 socket_path=config.SSP_AGENT_SOCKET, niceness=10, cpu_shares=128):
+        self.launcher = launcher
+        self.config_path = launcher.config_path.resolve()
+        # Own build context, `ssp run` rewrites the one in SSP_DOCKERFILE_PATH while the agent may be building
+        self.context_path = pathlib.Path(config.SSP_DOCKERFILE_PATH, 'agent')
+        self.skip_config = skip_config
+        self.debounce = debounce
+        self.socket_path = socket_path
+        self.niceness = niceness
+        self.cpu_shares = cpu_shares
+        self.watcher = Watcher()
+        self._condition = threading.Condition()
+        self._status = {'state': 'idle', 'config': str(self.config_path), 'image': None,
+                        'started': None, 'finished': None, 'error': None, 'builds': 0}
+
+    def status(self):
+        with self._condition:
+            return dict(self._status)
+
+    def wait_idle(self, timeout=None):
+        """Block until the agent is not building, return its status."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._status['state'] not in self.BUSY, timeout)
+            return dict(self._status)
+
+    def _update(self, **status):
+        with self._condition:
+            self._status.update(status)
+            self._condition.notify_all()
+
+    def serve_forever(self):
+        server = self._listen()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("ssp agent watches %s, status on %s" % (self.config_path, self.socket_path))
+        # Builds must not slow down interactive work of the user
+        os.nice(self.niceness)
+        self.launcher.cpu_shares = self.cpu_shares
+        try:
+            self._loop()
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.watcher.close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+    def _loop(self):
+        built = None
+        paths = [self.config_path]
+        while True:
+            self.watcher.watch(paths)
+            if self.signature(paths) != built:
+                self._update(state='pending')
+                # Wait until the files stop changing, e.g. while copying a large installer
+                settled = self.signature(paths)
+                while True:
+                    self.watcher.wait(self.debounce)
+                    current = self.signature(paths)
+                    if current == settled:
+                        break
+                    settled = current
+                changed = self._build()
+                # New copyfiles are watched from now on, their changes during the build are not known
+                built = settled if changed == paths else self.signature(changed)
+                paths = changed
+            self.watcher.wait(60.0)
+
+    @classmethod
+    def signature(cls, paths):
+        stamps = []
+        for path in paths:
+            try:
+                stat = path.stat()
+                stamps.append((str(path), stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                stamps.append((str(path), None))
+        return stamps
+
+    def _build(self):
+        # Returns files to watch, which depend on copyfiles of the new configuration
+        from ssp import generators
+
+        self._update(state='building', started=time.time(), error=None)
+        paths = [self.config_path]
+        try:
+            # Settings taken from ssp.yaml, e.g. buildkit and resources, change with it
+            self.launcher.reload()
+            dockergen = generators.Dockergen(self.launcher.config, self.launcher.current_user)
+            # Files of directory sources are watched one by one
+            paths += [path for source, _ in dockergen.copyfiles()
+                      for _, path in manifest.walk(source, source.name)]
+            image = self.launcher.build(self.skip_config, where=self.context_path)
+        except (Exceptions.DockerException, Exceptions.ConfigurationError, Exceptions.SSPSetupError, OSError) as error:
+            # E.g. a copyfile removed while the context is generated, the next change builds again
+            logging.error("Background build failed: %s" % error)
+            self._update(state='failed', finished=time.time(), error=str(error))
+            return paths
+        logging.info("Image %s is ready" % image)
+        self._update(state='ready', image=image, finished=time.time(),
+                     builds=self.status()['builds'] + 1)
+        return paths
+
+    def _listen(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            if AgentClient(self.socket_path).request({'command': 'status'}) is not None:
+                raise Exceptions.SSPSetupError(
+                    "ssp agent is already running, its socket is %s" % self.socket_path)
+            # Left behind by an agent which was killed
+            self.socket_path.unlink()
+        server = _Server(str(self.socket_path), _Handler)
+        server.agent = self
+        os.chmod(str(self.socket_path), 0o600)
+        return server
+
+
+class AgentClient:
+    """Client of the status socket of :class:`Agent`."""
+
+    def __init__(self, socket_path=config.SSP_AGENT_SOCKET):
+        self.socket_path = socket_path
+
+    def request(self, request, timeout=5.0):
+        """Send request to the agent.
+
+        :return: Status of the agent, or None when no agent is running.
+        :rtype: dict
+        """
+        if not self.socket_path.exists():
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(timeout)
+                connection.connect(str(self.socket_path))
+                connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                with connection.makefile('rb') as response:
+                    return json.loads(response.readline().decode('utf-8'))
+        except (OSError, ValueError) as error:
+            logging.debug("ssp agent is not available: %s" % error)
+            return None
+
+    def wait_for_build(self, config_path, timeout=None):
+        """Wait until the agent finishes building the configuration, if it is building it.
+
+        :return: Status of the agent, or None when no agent is running.
+        :rtype: dict
+        """
+        config_path = str(config_path.resolve())
+        status = self.request({'command': 'status'})
+        if status is None or status.get('config') != config_path or status.get('state') not in Agent.BUSY:
+            return status
+        logging.info("Waiting for ssp agent to finish the build in progress")
+        return self.request({'command': 'wait', 'config': config_path, 'timeout': timeout}, timeout=timeout)
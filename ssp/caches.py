@@ -0,0 +1,52 @@
+import re
+
+from ssp import config
+from ssp.engine import api_errors
+
+
+class CacheVolumes:
+    """Named Docker volumes keeping build caches of one user between containers.
+
+    There is one volume per user, project and cache of ssp.yaml. Volumes are created with ssp
+    labels by the first container using them and found by the labels later.
+    """
+
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+
+    def volume_name(self, project, cache):
+        return re.sub(r'[^\w.-]', '_', f"ssp-cache-{self.user}-{project}-{cache}")
+
+    def mounts(self, ssp_config):
+        """Mounts of cache volumes for `docker run`, see `docker.types.Mount`."""
+        from docker.types import Mount
+
+        mounts = []
+        for cache in ssp_config.caches:
+            labels = {config.SSP_USER_LABEL: self.user,
+                      config.SSP_PROJECT_LABEL: ssp_config.cache_project,
+                      config.SSP_CACHE_LABEL: cache.name}
+            if cache.size_limit:
+                labels[config.SSP_SIZE_LIMIT_LABEL] = str(cache.size_limit)
+            mounts.append(Mount(cache.target, self.volume_name(ssp_config.cache_project, cache.name),
+                                type='volume', labels=labels))
+        return mounts
+
+    @api_errors
+    def list(self):
+        return self.client.volumes.list(
+            filters={'label': [config.SSP_CACHE_LABEL, f"{config.SSP_USER_LABEL}={self.user}"]})
+
+    @api_errors
+    def usage(self):
+        """Size of volumes in bytes, by volume name. Docker computes it for all volumes, it may take a while."""
+        usage = {}
+        for volume in self.client.df().get('Volumes') or []:
+            size = (volume.get('UsageData') or {}).get('Size', -1)
+            usage[volume['Name']] = size if size >= 0 else None
+        return usage
+
+    @api_errors
+    def remove(self, volume):
+        volume.remove()
@@ -1,15 +1,16 @@
+import contextlib
 import logging
 import os
 import pathlib
 import time
 
 import click
-import inquirer
 
 import ssp as ssp_base
 
-from ssp import ssp as ssp_module, config
-from ssp.ssp import User
+# Keep imports light, `ssp version` and `ssp --help` must start fast.
+# Launcher, Docker SDK and prompts are imported by the commands which need them.
+from ssp import config
 
 
 @click.group()
@@ -19,23 +20,45 @@ def ssp():
 
 @ssp.command()
 @click.option('-v', '--version', type=str, default='latest', help="Optional. Other version tha latest can be downloaded.")
+@click.option('--check', is_flag=True, help="Only reports whether an update of the local image is available.")
+@click.option('--region', type=str, default=None,
+              help="Region of the registry, e.g. EU/US or CN. `auto` selects the fastest configured registry. Asked for if not set.")
+@click.option('--failover', is_flag=True, help="When the pull stalls, continues with the next fastest registry. Used with --region auto.")
+@click.option('--stall-timeout', type=int, default=config.SSP_PULL_STALL_TIMEOUT, show_default=True,
+              help="Seconds without progress after which the pull is considered stalled.")
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False), default=None,
+              help="Writes timeline of the command phases, Docker API calls and subprocesses to this file, in Chrome trace format.")
 @click.option('--debug', is_flag=True)
-def download(version, debug):
-    launcher = ssp_module.SSP_Launcher(debug=debug)
-    region = inquirer.prompt([inquirer.List('region', message="Select your region: ",
-                                            choices=['EU/US', 'CN'], default=['EU/US'])])['region']
-    launcher.download(version, region)
+def download(version, check, region, failover, stall_timeout, profile_path, debug):
+    from ssp import ssp as ssp_module
+
+    with _profile('download', profile_path):
+        launcher = ssp_module.SSP_Launcher(debug=debug)
+        if region is None:
+            import inquirer
+            region = inquirer.prompt([inquirer.List('region', message="Select your region: ",
+                                                    choices=list(launcher.registries) + ['auto'], default=['EU/US'])])['region']
+        launcher.download(version, region, check, failover, stall_timeout)
 
 
 @ssp.command()
 @click.option('-i', '--interactive',
               help="Interactive mode ", is_flag=True)
 @click.option('-o', '--output', 'output_name', type=str, default="", )
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False), default=None,
+              help="Writes timeline of the command phases, Docker API calls and subprocesses to this file, in Chrome trace format.")
 @click.option('--debug', is_flag=True)
-def generate(interactive, output_name, debug):
+def generate(interactive, output_name, profile_path, debug):
     """
     Generates ssp.yaml file. By default, basic mode is invoked, setting few basic options. For more optimal experience, run ssp generate in interactive mode, via `ssp generate -i`
     """
+    with _profile('generate', profile_path):
+        _generate(interactive, output_name, debug)
+
+
+def _generate(interactive, output_name, debug):
+    from ssp import ssp as ssp_module
+
     launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
 
     try:
@@ -69,6 +92,8 @@ def generate(interactive, output_name, debug):
 
 
 def _setup_basic(setup_docker_url, setup_docker_name, launcher, output):
+    from ssp.ssp import User
+
     logging.info("Starting basic setup...")
 
     logging.info("Docker url is: %s" % setup_docker_url)
@@ -99,6 +124,9 @@ def _setup_basic(setup_docker_url, setup_docker_name, launcher, output):
 
 
 def _setup_interactive(setup_docker_url, setup_docker_name, launcher, output):
+    import inquirer
+    from ssp.ssp import User
+
     setup_docker_url = click.prompt(
         "Enter URL of SSP docker image", default=setup_docker_url, type=str)
 
@@ -219,21 +247,286 @@ def _setup_interactive(setup_docker_url, setup_docker_name, launcher, output):
 
 @ssp.command()
 @click.option('-x', '-X', 'sshx', is_flag=True, help="Launches docker in detached mode and connets to docker via ssh with xserver.")
+@click.option('--display', 'display_mode', type=click.Choice(['ssh', 'local']), default=None,
+              help="Forwards X11 like -x, by `ssh -X` or by sharing the X server socket of this host. [default: display of ssp.yaml, ssh]")
+@click.option('--display-ipc', is_flag=True, help="Shares IPC namespace of the host with --display local, so X clients can use MIT-SHM.")
 @click.option('-d', '--dry-run', 'dry_run', is_flag=True, help="Creates only Dockerfile.")
 @click.option('-f', '--from-file', is_flag=True, help="Building Dockerfile will be skipped, using dockerfile in current folder.")
 @click.option('--skip-config', is_flag=True, help="During cpm init, doesnt ask to configure each package and skips all questions.")
+@click.option('--rebuild', is_flag=True, help="Always runs docker build, even if an image built from the same context exists.")
+@click.option('-r', '--reuse', is_flag=True, help="Attaches to your running SSP container of the same image, keeps a new container running in background.")
+@click.option('--idle-timeout', type=int, default=config.SSP_IDLE_TIMEOUT, show_default=True,
+              help="Seconds without any session after which a container started with --reuse is stopped.")
+@click.option('--explain', is_flag=True, help="Only reports which image layers a change of ssp.yaml rebuilds, compared to the last generated Dockerfile.")
+@click.option('--buildkit', is_flag=True, help="Builds the image with BuildKit (docker buildx), using cache mounts for cpm init.")
+@click.option('--cache-from', type=str, default=None, help="Directory or registry reference to import BuildKit cache from. Implies --buildkit.")
+@click.option('--cache-to', type=str, default=None, help="Directory or registry reference to export BuildKit cache to. Implies --buildkit.")
+@click.option('--scratch', type=str, default=None, help="Mount point of tmpfs scratch space, e.g. /tmp. [default: /scratch with --scratch-size]")
+@click.option('--scratch-size', type=str, default=None, help="Size of tmpfs scratch space, e.g. 8G.")
+@click.option('--shm-size', type=str, default=None, help="Size of /dev/shm, e.g. 2G.")
+@click.option('--cpus', type=float, default=None, help="Number of CPUs the container may use.")
+@click.option('--memory', type=str, default=None, help="Memory limit of the container, e.g. 32G.")
+@click.option('--ulimit', 'ulimits', type=str, multiple=True, help="Ulimit of the container, e.g. nofile=1024:65536. Can be repeated.")
+@click.option('--placement', 'placement_policy', type=click.Choice(['packed', 'spread', 'reserved']), default=None,
+              help="Pins the container to free CPUs and NUMA nodes of the host, see `ssp top`.")
+@click.option('--cores', type=int, default=None, help="Number of CPUs pinned by --placement. [default: --cpus rounded up]")
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False), default=None,
+              help="Writes timeline of the command phases, Docker API calls and subprocesses to this file, in Chrome trace format.")
 @click.option('--debug', is_flag=True)
-def run(sshx, dry_run, from_file, skip_config, debug):
+def run(sshx, display_mode, display_ipc, dry_run, from_file, skip_config, rebuild, reuse, idle_timeout, explain, buildkit, cache_from, cache_to,
+        scratch, scratch_size, shm_size, cpus, memory, ulimits, placement_policy, cores, profile_path, debug):
     """
     Run ssp via this command. SSP needs ssp.yaml configuration file in order tu run. To generate this file, run `ssp generate`
     """
+    with _profile('run', profile_path):
+        _run(sshx, display_mode, display_ipc, dry_run, from_file, skip_config, rebuild, reuse, idle_timeout, explain, buildkit,
+             cache_from, cache_to, scratch, scratch_size, shm_size, cpus, memory, ulimits, placement_policy, cores, debug)
+
+
+def _run(sshx, display_mode, display_ipc, dry_run, from_file, skip_config, rebuild, reuse, idle_timeout, explain, buildkit, cache_from,
+         cache_to, scratch, scratch_size, shm_size, cpus, memory, ulimits, placement_policy, cores, debug):
+    from ssp import ssp as ssp_module
+
+    sshx = sshx or display_mode is not None
     if from_file:
         launcher = ssp_module.SSP_Launcher(
             debug=debug, require_yaml_exists=False)
-        launcher.run_from_file(sshx)
+        launcher.set_build_cache(buildkit, cache_from, cache_to)
+        launcher.set_resources(scratch, scratch_size, shm_size, cpus, memory, ulimits)
+        launcher.set_placement(placement_policy, cores)
+        launcher.set_display(display_mode, display_ipc)
+        launcher.run_from_file(sshx, rebuild, reuse, idle_timeout)
+    elif explain:
+        launcher = ssp_module.SSP_Launcher(debug=debug)
+        launcher.set_build_cache(buildkit, cache_from, cache_to)
+        for line in launcher.explain(skip_config):
+            click.echo(line)
     else:
         launcher = ssp_module.SSP_Launcher(debug=debug)
-        launcher.run(sshx, dry_run, skip_config)
+        launcher.set_build_cache(buildkit, cache_from, cache_to)
+        launcher.set_resources(scratch, scratch_size, shm_size, cpus, memory, ulimits)
+        launcher.set_placement(placement_policy, cores)
+        launcher.set_display(display_mode, display_ipc)
+        launcher.run(sshx, dry_run, skip_config, rebuild, reuse, idle_timeout)
+
+
+@contextlib.contextmanager
+def _profile(command, trace_path):
+    # Every run of the command is timed into the profile history, the trace is written only on request
+    from ssp import profiler
+
+    recorder = profiler.Profiler.start(command)
+    status = 'failed'
+    try:
+        yield recorder
+        status = 'ok'
+    finally:
+        recorder.stop(status)
+        recorder.append_history()
+        if trace_path:
+            recorder.write_trace(trace_path)
+            logging.info("Profile of ssp %s written to %s" % (command, trace_path))
+
+
+@ssp.command()
+@click.option('--skip-config', is_flag=True, help="During cpm init, doesnt ask to configure each package and skips all questions.")
+@click.option('--rebuild', is_flag=True, help="Always runs docker build, even if an image built from the same context exists.")
+@click.option('--buildkit', is_flag=True, help="Builds the image with BuildKit (docker buildx), using cache mounts for cpm init.")
+@click.option('--cache-from', type=str, default=None, help="Directory or registry reference to import BuildKit cache from. Implies --buildkit.")
+@click.option('--cache-to', type=str, default=None, help="Directory or registry reference to export BuildKit cache to. Implies --buildkit.")
+@click.option('--matrix', type=str, default=None, help="Directory or glob pattern of ssp.yaml files to build concurrently, e.g. 'configs/*.yaml'.")
+@click.option('-j', '--workers', type=int, default=4, show_default=True, help="Maximal number of concurrent builds with --matrix.")
+@click.option('--log-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory for build output of each image with --matrix. [default: SSP_DOCKERFILE_PATH/matrix/logs]")
+@click.option('--debug', is_flag=True)
+def build(skip_config, rebuild, buildkit, cache_from, cache_to, matrix, workers, log_dir, debug):
+    """
+    Builds the customized SSP image from ssp.yaml without starting a container, e.g. on CI nodes.
+    """
+    from ssp import ssp as ssp_module
+
+    if not matrix:
+        launcher = ssp_module.SSP_Launcher(debug=debug)
+        launcher.set_build_cache(buildkit, cache_from, cache_to)
+        image = launcher.build(skip_config, rebuild)
+        logging.info("Image %s is ready" % image)
+        return
+
+    from ssp.context import format_size
+
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    launcher.set_build_cache(buildkit, cache_from, cache_to)
+    config_paths = launcher.matrix_configs(matrix)
+    if not config_paths:
+        raise click.ClickException("No ssp.yaml files match %s" % matrix)
+    results = launcher.build_matrix(config_paths, skip_config, rebuild, workers, log_dir)
+
+    click.echo("%-30s  %-40s  %-20s  %8s  %10s" % ("CONFIG", "IMAGE", "STATE", "TIME", "SIZE"))
+    for result in results:
+        click.echo("%-30s  %-40s  %-20s  %7.1fs  %10s" % (
+            result['config'], result['image'] or '', result['state'], result['seconds'],
+            format_size(result['size']) if result['size'] is not None else ''))
+    cache_hits = sum(1 for result in results if result['state'] == 'cached')
+    failed = [result for result in results if result['state'] == 'failed']
+    click.echo("%d images, %d cache hits, %d failed" % (len(results), cache_hits, len(failed)))
+    for result in failed:
+        click.echo("%s: %s%s" % (result['config'], result['error'],
+                                 ", see %s" % result['log'] if result['log'] else ''))
+    if failed:
+        raise click.ClickException("%d of %d images failed to build" % (len(failed), len(results)))
+
+
+@ssp.command()
+@click.option('--skip-config', is_flag=True, help="During cpm init, doesnt ask to configure each package and skips all questions.")
+@click.option('--debounce', type=float, default=config.SSP_AGENT_DEBOUNCE, show_default=True,
+              help="Seconds without further changes before a build starts.")
+@click.option('--debug', is_flag=True)
+def agent(skip_config, debounce, debug):
+    """
+    Watches ssp.yaml and copyfiles sources and rebuilds the customized image in background, so `ssp run` starts at once.
+    """
+    from ssp import ssp as ssp_module
+    from ssp.agent import Agent
+
+    launcher = ssp_module.SSP_Launcher(debug=debug)
+    try:
+        Agent(launcher, skip_config, debounce).serve_forever()
+    except KeyboardInterrupt:
+        logging.info("ssp agent stopped")
+
+
+@ssp.command()
+@click.option('--debug', is_flag=True)
+def ps(debug):
+    """
+    Lists your running SSP containers.
+    """
+    from ssp import ssp as ssp_module
+
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    rows = list(launcher.ps())
+    click.echo("%-12s  %-30s  %-10s  %8s  %s" %
+               ("CONTAINER", "IMAGE", "STATUS", "SESSIONS", "IDLE"))
+    for container, idle_time, sessions in rows:
+        click.echo("%-12s  %-30s  %-10s  %8d  %dm" % (container.short_id, container.labels.get(config.SSP_IMAGE_LABEL, ''),
+                                                     container.status, sessions, idle_time // 60))
+
+
+@ssp.command()
+@click.option('--debug', is_flag=True)
+def top(debug):
+    """
+    Shows CPUs and NUMA nodes given to SSP containers of all users of this host.
+    """
+    from ssp import ssp as ssp_module
+    from ssp.placement import format_cpulist
+
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    topology, allocations = launcher.top()
+    used = {cpu for _, cpus in allocations for cpu in cpus}
+    click.echo("%-6s  %-30s  %8s" % ("NODE", "CPUS", "USED"))
+    for node, cpus in sorted(topology.nodes.items()):
+        click.echo("%-6s  %-30s  %3d/%-4d" % (node, format_cpulist(cpus), len(used.intersection(cpus)), len(cpus)))
+    click.echo("")
+    click.echo("%-12s  %-12s  %-30s  %-10s  %-20s  %-6s  %s" %
+               ("CONTAINER", "USER", "IMAGE", "STATUS", "CPUS", "NODES", "POLICY"))
+    for container, cpus in allocations:
+        labels = container.labels
+        nodes = format_cpulist({topology.node_of[cpu] for cpu in cpus if cpu in topology.node_of})
+        click.echo("%-12s  %-12s  %-30s  %-10s  %-20s  %-6s  %s" % (
+            container.short_id, labels.get(config.SSP_USER_LABEL, ''), labels.get(config.SSP_IMAGE_LABEL, ''),
+            container.status, format_cpulist(cpus) or 'any', nodes or 'any', labels.get(config.SSP_PLACEMENT_LABEL, '')))
+
+
+@ssp.group()
+def cache():
+    """
+    Shows and prunes persistent cache volumes defined by `caches` of ssp.yaml.
+    """
+
+
+@cache.command()
+@click.option('--debug', is_flag=True)
+def stats(debug):
+    """
+    Lists your cache volumes with their size.
+    """
+    from ssp import ssp as ssp_module
+    from ssp.context import format_size
+
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    rows = launcher.cache_stats()
+    click.echo("%-50s  %-15s  %-20s  %10s  %10s" % ("VOLUME", "CACHE", "PROJECT", "SIZE", "LIMIT"))
+    for volume, size in rows:
+        labels = volume.attrs.get('Labels') or {}
+        limit = labels.get(config.SSP_SIZE_LIMIT_LABEL)
+        click.echo("%-50s  %-15s  %-20s  %10s  %10s" % (
+            volume.name, labels.get(config.SSP_CACHE_LABEL, ''), labels.get(config.SSP_PROJECT_LABEL, ''),
+            format_size(size) if size is not None else '?', format_size(int(limit)) if limit else ''))
+
+
+@cache.command()
+@click.argument('names', nargs=-1)
+@click.option('--all', 'prune_all', is_flag=True, help="Removes all your cache volumes.")
+@click.option('--debug', is_flag=True)
+def prune(names, prune_all, debug):
+    """
+    Removes cache volumes larger than their size limit, or the NAMES caches.
+    """
+    from ssp import ssp as ssp_module
+    from ssp.context import format_size
+
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    removed = launcher.cache_prune(names, prune_all)
+    click.echo("Removed %d caches, %s freed" % (
+        len(removed), format_size(sum(size or 0 for _, size in removed))))
+
+
+@ssp.command()
+@click.option('--budget', type=str, default=config.SSP_DISK_BUDGET,
+              help="Disk space SSP images and matrix build contexts may use, e.g. 100G. [default: SSP_DISK_BUDGET]")
+@click.option('-n', '--dry-run', is_flag=True, help="Only lists what would be removed.")
+@click.option('--debug', is_flag=True)
+def gc(budget, dry_run, debug):
+    """
+    Removes your least recently used SSP images and build contexts until they fit the disk budget.
+    """
+    from ssp import ssp as ssp_module
+    from ssp.context import format_size
+    from ssp.model import SSPConfig
+
+    if not budget:
+        raise click.ClickException("Set the disk budget by --budget or SSP_DISK_BUDGET")
+    try:
+        budget_bytes = SSPConfig.parse_size(budget)
+    except ValueError:
+        raise click.ClickException("Invalid budget %s, expected size like 100G" % budget)
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    before, after, removed = launcher.gc(budget_bytes, dry_run)
+    click.echo("%s %d images and contexts, usage %s -> %s, budget %s" % (
+        "Would remove" if dry_run else "Removed", len(removed), format_size(before), format_size(max(after, 0)),
+        format_size(budget_bytes)))
+    if after > budget_bytes:
+        click.echo("Usage stays over budget, the rest is used by containers, the current ssp.yaml or other images")
+
+
+@ssp.command()
+@click.argument('containers', nargs=-1)
+@click.option('--idle', 'idle_only', is_flag=True, help="Stops only containers idle for longer than their idle timeout.")
+@click.option('--watch', is_flag=True,
+              help="With --idle, keeps stopping idle containers until none of yours runs. Started by ssp run --reuse.")
+@click.option('--debug', is_flag=True)
+def stop(containers, idle_only, watch, debug):
+    """
+    Stops your running SSP containers. All of them are stopped if no CONTAINERS are given.
+    """
+    from ssp import ssp as ssp_module
+
+    if watch and not idle_only:
+        raise click.UsageError("--watch can be used only together with --idle")
+    launcher = ssp_module.SSP_Launcher(debug=debug, require_yaml_exists=False)
+    stopped = launcher.stop(containers, idle_only, watch)
+    logging.info("Stopped %d container(s)" % len(stopped))
 
 
 @ssp.command()
@@ -0,0 +1,172 @@
+import datetime
+import logging
+import pathlib
+import shutil
+import time
+
+from ssp import config
+from ssp.engine import api_errors
+from ssp.exceptions import Exceptions
+
+
+class ImageCollector:
+    """Removes least recently used SSP images and build contexts of one user to keep disk usage under a budget.
+
+    Images built or run by the user are tracked by files named by the image id in
+    `SSP_STATE_PATH/images`, the modification time of a file is the last use of the image.
+    Images of other users are never removed. Untagged images with the ssp digest label,
+    left behind when a newer build took their name, are collected as well when they carry
+    the user label of `user`. Build contexts
+    of `ssp build --matrix` are collected by the modification time of their files.
+
+    Usage is the size of all image layers on the Docker host plus the size of the contexts.
+    Freed space of an image is estimated as its size without layers shared with other images.
+    """
+
+    def __init__(self, client, user=None, state_path=None, contexts_path=None):
+        self.client = client
+        self.user = user
+        self.state_path = state_path or config.SSP_STATE_PATH.joinpath('images')
+        self.contexts_path = contexts_path or pathlib.Path(config.SSP_DOCKERFILE_PATH, 'matrix')
+
+    def touch(self, image_id):
+        """Record use of the image now."""
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.state_path.joinpath(self._key(image_id)).touch()
+
+    @api_errors
+    def protected(self, images=(), image_ids=()):
+        """Ids of images used by containers, including stopped ones, of the named images and `image_ids`."""
+        import docker
+
+        ids = set(image_ids)
+        ids.update(container.attrs.get('Image') for container in self.client.containers.list(all=True))
+        for image in images:
+            try:
+                ids.add(self.client.images.get(image).id)
+            except docker.errors.ImageNotFound:
+                pass
+        return {self._key(image_id) for image_id in ids if image_id}
+
+    @api_errors
+    def usage(self):
+        """Disk usage and candidates for removal, least recently used first.
+
+        :return: Used bytes and candidates as tuples of last use, kind (`image` or `context`),
+            image id or context path, freed bytes and description.
+        :rtype: (int, [(float, str, str, int, str)])
+        """
+        df = self.client.df()
+        tracked = {path.name: path.stat().st_mtime for path in self._state_files()}
+        candidates = []
+        for image in df.get('Images') or []:
+            key = self._key(image['Id'])
+            labels = image.get('Labels') or {}
+            tags = [tag for tag in image.get('RepoTags') or [] if tag != '<none>:<none>']
+            if key not in tracked and not self._left_behind(tags, labels):
+                continue
+            shared = max(image.get('SharedSize') or 0, 0)
+            last_used = tracked.get(key) or self._created(image.get('Created'))
+            candidates.append((last_used, 'image', key, max(image.get('Size', 0) - shared, 0),
+                               ', '.join(tags) or 'untagged %s' % key[:12]))
+        used = df.get('LayersSize') or 0
+
+        for context in self._contexts():
+            size, last_used = 0, context.stat().st_mtime
+            for path in context.rglob('*'):
+                if path.is_file() and not path.is_symlink():
+                    stat = path.stat()
+                    size += stat.st_size
+                    last_used = max(last_used, stat.st_mtime)
+            candidates.append((last_used, 'context', str(context), size, 'context %s' % context))
+            used += size
+        candidates.sort()
+        return used, candidates
+
+    def collect(self, budget, protected=(), dry_run=False):
+        """Remove least recently used images and contexts until usage is under the budget.
+
+        :param budget: Bytes the images and contexts may use.
+        :type budget: int
+        :param protected: Ids of images which must not be removed, see :meth:`protected`.
+        :type protected: set
+        :param dry_run: Only report what would be removed.
+        :type dry_run: bool
+        :return: Usage before and after, removed candidates, see :meth:`usage`.
+        :rtype: (int, int, [tuple])
+        """
+        before, candidates = self.usage()
+        used = before
+        removed = []
+        for candidate in candidates:
+            if used <= budget:
+                break
+            _, kind, key, size, description = candidate
+            if kind == 'image' and key in protected:
+                continue
+            if not dry_run:
+                try:
+                    self._remove(kind, key)
+                except (Exceptions.DockerException, OSError) as error:
+                    # E.g. base image of other images
+                    logging.debug("Not removing %s: %s" % (description, error))
+                    continue
+            logging.info("%s %s, last used %s" % ("Would remove" if dry_run else "Removed", description,
+                                                  time.strftime('%Y-%m-%d %H:%M', time.localtime(candidate[0]))))
+            removed.append(candidate)
+            used -= size
+        if not dry_run:
+            self._forget_removed()
+        return before, used, removed
+
+    def _remove(self, kind, key):
+        if kind == 'context':
+            shutil.rmtree(key)
+            return
+        self._remove_image(key)
+        state = self.state_path.joinpath(key)
+        if state.exists():
+            state.unlink()
+
+    @api_errors
+    def _remove_image(self, key):
+        # Removes all names of the image, it is not used by any container
+        self.client.images.remove('sha256:' + key, force=True)
+
+    @api_errors
+    def _forget_removed(self):
+        existing = {self._key(image.id) for image in self.client.images.list(all=True)}
+        for state in self._state_files():
+            if state.name not in existing:
+                state.unlink()
+
+    def _left_behind(self, tags, labels):
+        # Untagged image built by ssp for this user, images of other users are not even considered
+        return (not tags and config.SSP_DIGEST_LABEL in labels and self.user is not None
+                and labels.get(config.SSP_USER_LABEL) == self.user)
+
+    def _contexts(self):
+        if not self.contexts_path.is_dir():
+            return []
+        # Build output of matrix builds goes to logs, it is kept
+        return sorted(path for path in self.contexts_path.iterdir() if path.is_dir() and path.name != 'logs')
+
+    def _state_files(self):
+        if not self.state_path.is_dir():
+            return []
+        return list(self.state_path.iterdir())
+
+    @classmethod
+    def _key(cls, image_id):
+        return image_id.partition(':')[2] or image_id
+
+    @classmethod
+    def _created(cls, created):
+        # Seconds since epoch in `docker system df`, RFC 3339 in image inspect
+        if isinstance(created, (int, float)):
+            return float(created)
+        try:
+            return datetime.datetime.strptime(created[:19], '%Y-%m-%dT%H:%M:%S').replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
@@ -13,7 +13,51 @@ SSP_CONFIG_PATH = SSP_CONFIG_PATH.joinpath(SSP_CONFIG_NAME)
 SSP_DOCKERFILE_PATH = os.environ["SSP_DOCKERFILE_PATH"] if "SSP_DOCKERFILE_PATH" in os.environ else pathlib.Path.home(
 ).joinpath('tmp')
 
+# Directory where ssp keeps its state, e.g. last use of running containers
+SSP_STATE_PATH = pathlib.Path(os.environ["SSP_STATE_PATH"]) if "SSP_STATE_PATH" in os.environ else pathlib.Path.home(
+).joinpath('.ssp')
+# Seconds after which containers started by `ssp run --reuse` without any session are stopped
+SSP_IDLE_TIMEOUT = int(os.environ.get("SSP_IDLE_TIMEOUT", 4 * 3600))
+
+# Disk space SSP images and matrix build contexts may use, e.g. 100G. When set, least recently
+# used images of the user are removed after every build to stay under it, see `ssp gc`.
+SSP_DISK_BUDGET = os.environ.get("SSP_DISK_BUDGET")
+
+# Timings of `ssp run`, `ssp download` and `ssp generate` are appended to this file, one JSON line per command
+SSP_PROFILE_HISTORY = SSP_STATE_PATH.joinpath('profile.jsonl')
+# Unix socket `ssp agent` reports the state of its background builds on
+SSP_AGENT_SOCKET = SSP_STATE_PATH.joinpath('agent.sock')
+# Seconds without further changes of ssp.yaml or copyfiles before `ssp agent` starts a build
+SSP_AGENT_DEBOUNCE = float(os.environ.get("SSP_AGENT_DEBOUNCE", 2.0))
+
+# Docker Engine API endpoint, local unix socket unless DOCKER_HOST is exported
+SSP_DOCKER_HOST = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+
+# Registries `ssp download` pulls SSP from, by region. Distributions are repositories in the registry.
+# More registries, e.g. a local mirror, can be added by `registries` section of ssp.yaml.
+SSP_REGISTRIES = {
+    'EU/US': {'url': "ssp-docker-registry.codasip.com",
+              'distributions': {'free': '/free/distrib-ssp-seh1-free'}},
+    'CN': {'url': "ssp-docker-registry-cn.codasip.com:5443",
+           'distributions': {'free': '/distrib-ssp-seh1-free'}},
+}
+# Seconds without any progress after which a pull is considered stalled
+SSP_PULL_STALL_TIMEOUT = int(os.environ.get("SSP_PULL_STALL_TIMEOUT", 120))
+
 SSP_DOCKER_URL = "docker-registry.codasip.com/ssp/distrib-ssp-seh1-free:latest"
 SSP_IMAGE_NAME = "ssp_docker_image_free:1.0.0"
+
+# Prefix of labels ssp puts on images and containers it creates
+SSP_LABEL_PREFIX = "com.codasip.ssp"
+SSP_DIGEST_LABEL = SSP_LABEL_PREFIX + ".digest"
+SSP_USER_LABEL = SSP_LABEL_PREFIX + ".user"
+SSP_IMAGE_LABEL = SSP_LABEL_PREFIX + ".image"
+SSP_IDLE_TIMEOUT_LABEL = SSP_LABEL_PREFIX + ".idle-timeout"
+SSP_CACHE_LABEL = SSP_LABEL_PREFIX + ".cache"
+SSP_PROJECT_LABEL = SSP_LABEL_PREFIX + ".project"
+SSP_SIZE_LIMIT_LABEL = SSP_LABEL_PREFIX + ".size-limit"
+SSP_RESOURCES_LABEL = SSP_LABEL_PREFIX + ".resources"
+SSP_CPUSET_LABEL = SSP_LABEL_PREFIX + ".cpuset"
+SSP_PLACEMENT_LABEL = SSP_LABEL_PREFIX + ".placement"
 # DO NOT CHANGE CODE BELLOW, MODIFY VARIABLE ABOVE ONLY
 # ==============================================================================
@@ -0,0 +1,141 @@
+import fcntl
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+from ssp import config
+from ssp.engine import api_errors
+
+
+class WarmContainers:
+    """Running SSP containers of one user that can be attached to instead of starting new ones.
+
+    Containers are found by labels ssp puts on them. The last time a session was attached to
+    a container is kept as modification time of a file in `SSP_STATE_PATH/containers`.
+    Idle containers are stopped by a watcher, see :meth:`start_watcher`.
+    """
+    # Seconds between two checks of the watcher
+    WATCH_INTERVAL = 60
+    # State files are named by full container ids
+    CONTAINER_ID = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+        self.state_path = config.SSP_STATE_PATH.joinpath('containers')
+        self.lock_path = config.SSP_STATE_PATH.joinpath('containers.lock')
+
+    @api_errors
+    def list(self, image=None):
+        filters = [f"{config.SSP_USER_LABEL}={self.user}"]
+        if image:
+            filters.append(f"{config.SSP_IMAGE_LABEL}={image}")
+        return self.client.containers.list(filters={'label': filters})
+
+    def find(self, image, digest=None, resources=None):
+        """Find running container of the image, built from context with given digest and started with given resources.
+
+        :param image: Name of the customized image, see `SSPConfig.user_image`.
+        :type image: str
+        :param digest: Digest of the image build context, any digest matches if not set.
+        :type digest: str
+        :param resources: Digest of resource options of the container, None for no resource options.
+        :type resources: str
+        :return: Container or None.
+        """
+        for container in self.list(image):
+            if digest and container.labels.get(config.SSP_DIGEST_LABEL) != digest:
+                logging.debug("Container %s runs outdated image, not reusing it" %
+                              container.short_id)
+                continue
+            if container.labels.get(config.SSP_RESOURCES_LABEL) != resources:
+                logging.debug("Container %s runs with other resources, not reusing it" %
+                              container.short_id)
+                continue
+            return container
+        return None
+
+    def touch(self, container):
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.state_path.joinpath(container.id).touch()
+
+    def idle_time(self, container):
+        state = self.state_path.joinpath(container.id)
+        if not state.exists():
+            # Unknown container, e.g. the state was wiped. Start measuring from now.
+            self.touch(container)
+            return 0.0
+        return time.time() - state.stat().st_mtime
+
+    @api_errors
+    def sessions(self, container):
+        """Count `docker exec` and ssh sessions attached to the container."""
+        count = 0
+        for exec_id in container.attrs.get('ExecIDs') or []:
+            if self.client.api.exec_inspect(exec_id).get('Running'):
+                count += 1
+        for process in container.top().get('Processes') or []:
+            # Session processes of sshd look like `sshd: user@pts/0`
+            if process[-1].startswith('sshd: ') and '@' in process[-1]:
+                count += 1
+        return count
+
+    @api_errors
+    def stop(self, container):
+        logging.info("Stopping container %s" % container.short_id)
+        container.stop()
+        state = self.state_path.joinpath(container.id)
+        if state.exists():
+            state.unlink()
+
+    def reap(self):
+        """Stop containers without sessions that are idle for longer than their timeout."""
+        stopped = []
+        for container in self.list():
+            timeout = int(container.labels.get(
+                config.SSP_IDLE_TIMEOUT_LABEL, config.SSP_IDLE_TIMEOUT))
+            if self.idle_time(container) > timeout and not self.sessions(container):
+                self.stop(container)
+                stopped.append(container)
+        self._forget_removed()
+        return stopped
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Stop idle containers every `interval` seconds until the user has no running SSP containers.
+
+        Only one watcher of the user runs at a time, returns right away when another one is running.
+        """
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock_path.open('a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logging.debug("Idle containers are already watched by another process")
+                return
+            while True:
+                for stopped in self.reap():
+                    logging.info("Stopped idle container %s" % stopped.short_id)
+                if not self.list():
+                    return
+                time.sleep(interval)
+
+    def start_watcher(self):
+        """Start `ssp stop --idle --watch` in background, so idle containers are stopped without another ssp command.
+
+        The watcher outlives the terminal and exits together with the last container of the user.
+        """
+        command = [sys.executable, '-c', 'from ssp.cli import ssp; ssp()', 'stop', '--idle', '--watch']
+        logging.debug("Starting idle container watcher: %s" % ' '.join(command))
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         cwd=os.path.expanduser('~'), start_new_session=True)
+
+    def _forget_removed(self):
+        if not self.state_path.exists():
+            return
+        running = {container.id for container in self.list()}
+        for state in self.state_path.iterdir():
+            if self.CONTAINER_ID.match(state.name) and state.name not in running:
+                state.unlink()
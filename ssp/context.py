@@ -0,0 +1,82 @@
+import logging
+import tarfile
+import time
+
+from ssp.exceptions import Exceptions
+
+
+class BuildContext:
+    """Docker build context streamed as a tar archive straight from the host files.
+
+    Files are read in chunks while the archive is being sent, so nothing is staged
+    on disk and memory usage does not depend on the size of the context.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, files):
+        """
+        :param files: Pairs of name inside the context and path of the host file.
+        :type files: [(str, pathlib.Path)]
+        """
+        self.files = list(files)
+        self.bytes_sent = 0
+        self.started = None
+        self.finished = None
+
+    def stream(self):
+        """Yield the tar archive of the context chunk by chunk."""
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+        for arcname, path in self.files:
+            logging.debug("Adding %s as %s to build context" % (path, arcname))
+            yield from self._count(self._file_entry(str(arcname), path))
+        # Archive ends with two empty blocks
+        yield from self._count([tarfile.NUL * tarfile.BLOCKSIZE * 2])
+        self.finished = time.monotonic()
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def report(self):
+        duration = self.duration or 0.0
+        rate = self.bytes_sent / duration if duration > 0 else 0.0
+        return "%s in %.2f s (%s/s)" % (format_size(self.bytes_sent), duration, format_size(rate))
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def _file_entry(self, arcname, path):
+        stat = path.stat()
+        info = tarfile.TarInfo(arcname)
+        info.size = stat.st_size
+        info.mode = stat.st_mode & 0o7777
+        info.mtime = stat.st_mtime
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+        remaining = info.size
+        with path.open('rb') as fp:
+            while remaining > 0:
+                chunk = fp.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise Exceptions.SSPSetupError(
+                        "File %s changed while sending build context" % path)
+                remaining -= len(chunk)
+                yield chunk
+
+        # File data is padded to a whole number of blocks
+        padding = info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TiB" % size
@@ -0,0 +1,88 @@
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+
+from ssp import config, profiler
+
+
+class LocalDisplay:
+    """X server of the host shared with a container through its unix socket.
+
+    X clients in the container talk to the X server directly, without the encryption and
+    TCP round-trips of `ssh -X`. The container gets the cookie of the one display only,
+    with a wildcard address, because the hostname of the container differs from the host.
+    """
+    SOCKET_DIR = pathlib.Path('/tmp/.X11-unix')
+    XAUTHORITY = '/tmp/.ssp-Xauthority'
+    # Toolkits which would use MIT-SHM without a shared IPC namespace and fail with BadAccess
+    NO_SHM_ENVIRONMENT = {'QT_X11_NO_MITSHM': '1', '_X11_NO_MITSHM': '1', '_MITSHM': '0'}
+
+    def __init__(self, display=None, share_ipc=False):
+        self.display = os.environ.get('DISPLAY', '') if display is None else display
+        self.share_ipc = share_ipc
+
+    def number(self):
+        """Number of a local display like `:0`, `:1.0` or `unix:0`, None for displays reached over TCP."""
+        host, separator, rest = self.display.rpartition(':')
+        number = rest.partition('.')[0]
+        if not separator or host not in ('', 'unix') or not number.isdigit():
+            return None
+        return number
+
+    def unavailable(self):
+        """Reason why the display cannot be shared with containers, None if it can."""
+        if not self.display:
+            return "DISPLAY is not set"
+        number = self.number()
+        if number is None:
+            # E.g. localhost:10.0 of ssh X forwarding to this host
+            return "DISPLAY %s is not an X server of this host" % self.display
+        if not self.SOCKET_DIR.joinpath(f"X{number}").exists():
+            return "socket of display %s not found in %s" % (self.display, self.SOCKET_DIR)
+        if not config.SSP_DOCKER_HOST.startswith('unix://'):
+            return "Docker Engine at %s does not run on this host" % config.SSP_DOCKER_HOST
+        return None
+
+    def write_cookie(self, path):
+        """Write cookie of the display, usable from any hostname, to Xauthority file `path`.
+
+        The file is rewritten in place, containers which have it mounted see the new cookie.
+
+        :return: False when there is no cookie, e.g. the X server accepts clients by `xhost`.
+        :rtype: bool
+        """
+        if shutil.which('xauth') is None:
+            logging.debug("xauth not found, display %s is shared without a cookie" % self.display)
+            return False
+        with profiler.span('xauth nlist', 'subprocess'):
+            listed = subprocess.run(['xauth', 'nlist', self.display], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+        # Lines are the hex encoded Xauthority entries, family ffff matches any address
+        entries = [bytes.fromhex('ffff' + line.replace(' ', '')[4:]) for line in listed.splitlines() if line.strip()]
+        if not entries:
+            return False
+        # The directory keeps other users of the host away, the file is readable by the container user of any uid
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with path.open('wb') as fp:
+            os.fchmod(fp.fileno(), 0o644)
+            fp.write(b''.join(entries))
+        return True
+
+    def container_options(self, cookie_path):
+        """Mounts, environment and IPC mode of the container, see `docker.models.containers.ContainerCollection.run`."""
+        from docker.types import Mount
+
+        mounts = [Mount(str(self.SOCKET_DIR), str(self.SOCKET_DIR), type='bind')]
+        environment = {'DISPLAY': f":{self.number()}"}
+        if self.write_cookie(cookie_path):
+            mounts.append(Mount(self.XAUTHORITY, str(cookie_path), type='bind', read_only=True))
+            environment['XAUTHORITY'] = self.XAUTHORITY
+        options = {'mounts': mounts, 'environment': environment}
+        if self.share_ipc:
+            # MIT-SHM passes images through shared memory, it needs the IPC namespace of the X server
+            options['ipc_mode'] = 'host'
+        else:
+            environment.update(self.NO_SHM_ENVIRONMENT)
+        return options
@@ -0,0 +1,289 @@
+import contextlib
+import functools
+import logging
+import os
+import re
+import subprocess
+import sys
+
+from ssp import config, profiler
+from ssp.exceptions import Exceptions
+
+
+def api_errors(function):
+    # Wrapper that turns errors of Docker SDK and its transport into DockerException
+    @functools.wraps(function)
+    def map_errors(*args, **kwargs):
+        import docker
+        import requests
+        import urllib3
+        try:
+            return function(*args, **kwargs)
+        except docker.errors.DockerException as error:
+            raise Exceptions.DockerException(
+                "Docker Engine API error: %s" % error) from error
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as error:
+            raise Exceptions.DockerException(
+                "Unable to communicate with Docker Engine at %s: %s" % (config.SSP_DOCKER_HOST, error)) from error
+    return map_errors
+
+
+class Engine:
+    """Docker Engine API client shared by the whole process.
+
+    One client is created per process, so its connection pool to the Docker socket
+    is reused by all API calls.
+    """
+    _client = None
+    _healthy = False
+
+    @classmethod
+    def client(cls):
+        if cls._client is None:
+            logging.debug("Connecting to Docker Engine at %s" %
+                          config.SSP_DOCKER_HOST)
+            cls._client = cls._new_client()
+        return cls._client
+
+    @classmethod
+    def _new_client(cls, **kwargs):
+        import docker
+        client = docker.DockerClient(base_url=config.SSP_DOCKER_HOST, **kwargs)
+        # Durations of API calls go to the profile of the command, see `ssp run --profile`
+        client.api.hooks['response'].append(profiler.docker_response)
+        return client
+
+    @classmethod
+    def ping(cls):
+        """Check Docker Engine is reachable. The result is cached for the process."""
+        if cls._healthy:
+            return
+        try:
+            with profiler.span('docker check'):
+                cls.client().ping()
+        except Exception as error:
+            raise Exceptions.DockerException(
+                "Docker is not properly installed. %s" % error) from error
+        cls._healthy = True
+
+    @classmethod
+    @api_errors
+    def build(cls, build_context, tag, labels=None, cpu_shares=None, output=None):
+        """Build image from streamed context and print the build output.
+
+        :param build_context: Context to send to Docker.
+        :type build_context: ssp.context.BuildContext
+        :param tag: Name of the built image.
+        :type tag: str
+        :param labels: Labels of the built image.
+        :type labels: dict
+        :param cpu_shares: Relative CPU weight of the build containers, 1024 is the default.
+        :type cpu_shares: int
+        :param output: File the build output is written to, standard output by default.
+        """
+        output = output or sys.stdout
+        container_limits = {'cpushares': cpu_shares} if cpu_shares else None
+        chunks = cls.client().api.build(fileobj=build_context.stream(), custom_context=True,
+                                        tag=tag, labels=labels, rm=True, decode=True,
+                                        container_limits=container_limits)
+        logging.info("Sent build context: %s" % build_context.report())
+        for chunk in chunks:
+            if 'error' in chunk:
+                raise Exceptions.DockerException(
+                    "Docker build failed: %s" % chunk['error'].strip())
+            output.write(chunk.get('stream', ''))
+        output.flush()
+
+    @classmethod
+    def buildx(cls, build_context, tag, labels=None, cache_from=None, cache_to=None, output=None, cpu_shares=None):
+        """Build image with BuildKit through `docker buildx build`, the context is streamed to its stdin.
+
+        :param build_context: Context to send to BuildKit.
+        :type build_context: ssp.context.BuildContext
+        :param cache_from: Directory or registry reference to import build cache from.
+        :type cache_from: str
+        :param cache_to: Directory or registry reference to export build cache to.
+        :type cache_to: str
+        :param output: File the build output is written to, the terminal by default.
+        :param cpu_shares: Relative CPU weight of the build, see :meth:`buildkit_priority`.
+        :type cpu_shares: int
+        """
+        with cls.buildkit_priority(cpu_shares):
+            cls._buildx(build_context, tag, labels, cache_from, cache_to, output)
+
+    @classmethod
+    @contextlib.contextmanager
+    def buildkit_priority(cls, cpu_shares):
+        """Lower CPU weight of BuildKit of the current buildx builder while the block runs.
+
+        Build steps run in BuildKit, not in the `docker buildx` client, so the weight is set on the
+        container BuildKit runs in with the `docker-container` driver. BuildKit built into Docker
+        Engine, the `docker` driver, cannot be deprioritized and builds at normal priority.
+        """
+        container = cls._buildkit_container() if cpu_shares else None
+        if cpu_shares and container is None:
+            logging.warning("BuildKit of the current buildx builder does not run in a container, "
+                            "building at normal CPU priority")
+        if container is None:
+            yield
+            return
+        previous = container.attrs.get('HostConfig', {}).get('CpuShares') or 1024
+        logging.debug("Lowering CPU shares of %s from %d to %d" % (container.name, previous, cpu_shares))
+        cls._update_cpu_shares(container, cpu_shares)
+        try:
+            yield
+        finally:
+            cls._update_cpu_shares(container, previous)
+
+    @classmethod
+    def _buildkit_container(cls):
+        # `docker buildx inspect` lists the builder, its driver and then its nodes
+        try:
+            inspect = subprocess.run(['docker', 'buildx', 'inspect'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     universal_newlines=True, check=True,
+                                     env=dict(os.environ, DOCKER_HOST=config.SSP_DOCKER_HOST)).stdout
+        except (OSError, subprocess.CalledProcessError) as error:
+            logging.debug("Unable to inspect buildx builder: %s" % error)
+            return None
+        drivers = re.findall(r'^Driver:\s*(\S+)', inspect, re.MULTILINE)
+        names = re.findall(r'^Name:\s*(\S+)', inspect, re.MULTILINE)
+        if drivers[:1] != ['docker-container'] or len(names) < 2:
+            return None
+        return cls._container(f"buildx_buildkit_{names[1]}")
+
+    @classmethod
+    @api_errors
+    def _container(cls, name):
+        import docker
+
+        try:
+            return cls.client().containers.get(name)
+        except docker.errors.NotFound:
+            return None
+
+    @classmethod
+    @api_errors
+    def _update_cpu_shares(cls, container, cpu_shares):
+        container.update(cpu_shares=cpu_shares)
+
+    @classmethod
+    def _buildx(cls, build_context, tag, labels, cache_from, cache_to, output):
+        command = ['docker', 'buildx', 'build', '--load', '--tag', tag]
+        for key, value in (labels or {}).items():
+            command += ['--label', f"{key}={value}"]
+        if cache_from:
+            command += ['--cache-from', cls.cache_option(cache_from)]
+        if cache_to:
+            command += ['--cache-to', cls.cache_option(cache_to, export=True)]
+        command.append('-')
+        logging.debug("Running %s" % ' '.join(command))
+
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output,
+                                       stderr=subprocess.STDOUT if output else None,
+                                       env=dict(os.environ, DOCKER_HOST=config.SSP_DOCKER_HOST))
+        except OSError as error:
+            raise Exceptions.DockerException(
+                "Unable to run docker buildx: %s" % error) from error
+        try:
+            for chunk in build_context.stream():
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # buildx exited early, its exit code is reported below
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        if process.wait() != 0:
+            raise Exceptions.DockerException(
+                "Docker buildx build failed with exit code %d" % process.returncode)
+        logging.info("Sent build context: %s" % build_context.report())
+
+    @classmethod
+    def cache_option(cls, location, export=False):
+        """Value of `--cache-from` or `--cache-to` of `docker buildx build`.
+
+        Directories are used as local cache, anything else as a registry reference. Values
+        with explicit `type=` are passed as they are.
+        """
+        if 'type=' in location:
+            return location
+        if location.startswith(('/', '.', '~')) or os.path.isdir(location):
+            path = os.path.abspath(os.path.expanduser(location))
+            return f"type=local,dest={path},mode=max" if export else f"type=local,src={path}"
+        return f"type=registry,ref={location},mode=max" if export else f"type=registry,ref={location}"
+
+    @classmethod
+    @api_errors
+    def pull(cls, repository, tag, stall_timeout=None):
+        """Pull image and print progress of its layers.
+
+        :param stall_timeout: Seconds without progress after which the pull is aborted.
+        :type stall_timeout: int
+        """
+        client = cls.client()
+        if stall_timeout:
+            # Timeout of the client applies to every read of the streamed progress
+            client = cls._new_client(timeout=stall_timeout)
+        statuses = {}
+        for chunk in client.api.pull(repository, tag, stream=True, decode=True):
+            if 'error' in chunk:
+                raise Exceptions.DockerException(
+                    "Could not pull specified docker image: %s" % chunk['error'].strip())
+            # Print only changes of layer status, not every progress update
+            layer = chunk.get('id', '')
+            status = chunk.get('status', '')
+            if statuses.get(layer) != status:
+                statuses[layer] = status
+                sys.stdout.write(f"{layer}: {status}\n" if layer else f"{status}\n")
+        sys.stdout.flush()
+
+    @classmethod
+    @api_errors
+    def image_id(cls, image):
+        """Id of local image, or the image name itself if it is not present."""
+        import docker
+        try:
+            return cls.client().images.get(image).id
+        except docker.errors.ImageNotFound:
+            return image
+
+    @classmethod
+    @api_errors
+    def image_size(cls, image):
+        """Size of local image in bytes, including layers shared with other images."""
+        return cls.client().images.get(image).attrs.get('Size')
+
+    @classmethod
+    @api_errors
+    def repo_digests(cls, image):
+        """Digests of the local image in the registries it was pulled from, empty if it is not present."""
+        import docker
+        try:
+            return cls.client().images.get(image).attrs.get('RepoDigests') or []
+        except docker.errors.ImageNotFound:
+            return []
+
+    @classmethod
+    @api_errors
+    def images(cls, label):
+        return cls.client().images.list(filters={'label': label})
+
+    @classmethod
+    @api_errors
+    def tag(cls, image, name):
+        image.tag(name)
+
+    @classmethod
+    @api_errors
+    def create(cls, image, **kwargs):
+        """Create container, parameters are the same as of `docker.models.containers.ContainerCollection.create`."""
+        return cls.client().containers.create(image, **kwargs)
+
+    @classmethod
+    @api_errors
+    def run_detached(cls, image, **kwargs):
+        """Start container in background and return it."""
+        return cls.client().containers.run(image, detach=True, **kwargs)
@@ -1,7 +1,4 @@
 import functools
-import os
-import subprocess
-import sys
 
 class Exceptions():
     class DockerException(Exception):
@@ -24,11 +21,10 @@ class Exceptions():
 
     @classmethod
     def test_wrapper(cls, function):
-        # Wrapper that checks if docker is installed and user has proper rights, by calling docker info
+        # Wrapper that checks if docker is installed and user has proper rights, by pinging Docker Engine
         @functools.wraps(function)
         def test_docker_installation(*args, **kwargs):
-            if subprocess.run(['docker', 'info'], stdout=open(os.devnull, 'wb')).returncode != 0:
-                raise Exceptions.DockerException(
-                    "Docker is not properly installed.")
+            from ssp.engine import Engine
+            Engine.ping()
             return function(*args, **kwargs)
         return test_docker_installation
@@ -1,20 +1,14 @@
-import functools
+import hashlib
 import logging
 import pathlib
 import os
-import shutil
-import subprocess
+import re
+import shlex
 from string import Template
-from ssp import exceptions
 
+from ssp import manifest
 from ssp.exceptions import Exceptions
 
-import yaml
-try:
-    from yaml import CDumper as Dumper
-except ImportError:
-    from yaml import Dumper
-
 
 user_template = Template("""
 RUN set -eux && getent group $username || groupadd -f $username -g $gid \\
@@ -28,24 +22,70 @@ user_tamplate_add_groups = Template("""
 RUN usermod -aG $usergroups $username\n
 """)
 
+# Creates all groups and users from files generated into the build context,
+# so the number of layers does not grow with the number of users.
+users_batch_template = Template("""
+COPY $provisioning /tmp/$provisioning
+RUN set -eu && cd /tmp/$provisioning \\
+    && while read -r name gid; do groupadd "$$name" -g "$$gid"; done < groups \\
+    && newusers users \\
+    && while IFS=: read -r name _ uid gid _; do \\
+        cp -r /etc/skel/. "/home/$$name" \\
+        && echo 'export MODULEPATH=/prj/ssp/modules' >> "/home/$$name/.bashrc" \\
+        && chown -R "$$uid:$$gid" "/home/$$name"; done < users \\
+    && while read -r name usergroups; do usermod -aG "$$usergroups" "$$name"; done < memberships \\
+    && cat sudoers >> /etc/sudoers \\
+    && rm -rf /tmp/$provisioning\n
+""")
+
+# Mounts drives from /etc/fstab concurrently, started by the container CMD.
+# Marker file tells shells the drives are ready, failed mount points are listed next to it.
+drives_mount_template = Template("""#!/bin/sh
+rm -f /run/ssp-drives-ready /run/ssp-drives.failed
+for target in $targets; do
+    (mount "$$target" >> /run/ssp-drives.log 2>&1 || echo "$$target" >> /run/ssp-drives.failed) &
+done
+wait
+touch /run/ssp-drives-ready
+""")
+
+# Appended to system wide bashrc, so interactive shells start once drives are mounted
+drives_wait_script = """
+# Wait until drives of ssp.yaml are mounted by /usr/local/lib/ssp-drives/mount
+if [ ! -e /run/ssp-drives-ready ]; then
+    echo "Waiting for drives to be mounted..."
+    ssp_wait=0
+    while [ ! -e /run/ssp-drives-ready ] && [ "$ssp_wait" -lt 600 ]; do sleep 0.1; ssp_wait=$((ssp_wait + 1)); done
+    unset ssp_wait
+fi
+if [ -s /run/ssp-drives.failed ]; then
+    echo "Drives not mounted, see /run/ssp-drives.log:" $(cat /run/ssp-drives.failed)
+fi
+"""
+
 
-def test_wrapper(function):
-    # Wrapper that checks if docker is installed and user has proper rights, by calling docker info
-    @functools.wraps(function)
-    def test_docker_installation(*args, **kwargs):
-        if subprocess.run(['docker', 'info'], stdout=open(os.devnull, 'wb')).returncode != 0:
-            raise Exceptions.DockerException(
-                "Docker is not properly installed.")
-        return function(*args, **kwargs)
-    return test_docker_installation
+test_wrapper = Exceptions.test_wrapper
 
 
 class Dockergen:
-    def __init__(self, config, current_user):
+    PROVISIONING_DIR = 'ssp-provisioning'
+    DRIVES_DIR = 'ssp-drives'
+    BASE_DOCKERFILE = 'Dockerfile.base'
+    # Exported variables read by `cpm init`
+    CPM_ENV_PREFIXES = ('CPM_', 'MGEN_')
+    # Installation `cpm init` works in, anything placed there stays ahead of it
+    SSP_ROOT = '/prj/ssp'
+
+    def __init__(self, config, current_user, buildkit=False):
         self.config = config
         self.current_user = current_user
+        # Dockerfile may use BuildKit only features, e.g. cache mounts
+        self.buildkit = buildkit
+        # Files generated into the Docker context besides Dockerfile, relative to it
+        self.generated_files = []
+        self.manifest = manifest.ContentManifest()
 
-    def generate_dockerfile(self, where, skip_config, run_uid, run_gid):
+    def generate_dockerfile(self, where, skip_config, run_uid, run_gid, stage_copyfiles=True):
         """Generate Dockerfile with instructions to copy packages into SSP.
 
         :param where: Path where the Docker context directory is.
@@ -56,110 +96,473 @@ class Dockergen:
         :type packages: [ArchivedPackage]
         :param master_metadata: Master metadata file for SSP (package.json)
         :type master_metadata: pathlib.Path
+        :param stage_copyfiles: Copy `copyfiles` sources next to the Dockerfile. Not needed
+            when the context is streamed by :class:`ssp.context.BuildContext`.
+        :type stage_copyfiles: bool
         """
 
         logging.info("Generating context for Docker build")
         if not where.is_dir():
             where.mkdir(parents=True, exist_ok=True)
 
+        self.generated_files = []
+        self.generate_files(where)
+
+        if stage_copyfiles:
+            # Sources already in the same dir as dockerfile need not be staged
+            files = [copied for source, _ in self.copyfiles() if source.parent != where
+                     for copied in manifest.walk(source, source.name)]
+            counts = manifest.stage(files, where)
+            logging.info("Staged copyfiles: %s" % ', '.join(
+                "%d %s" % (count, method) for method, count in counts.items() if count))
+
+        if self.config.shared_base:
+            logging.info("Generating Dockerfile of shared base image %s" % self.config.base_image)
+            (where / self.BASE_DOCKERFILE).write_text(self.render_base(skip_config))
+
         logging.info("Generating Dockerfile")
-        with (where / 'Dockerfile').open('w') as dockerfile:
-            # We are creating am image from distribution image
-            dockerfile.write(f"FROM {self.config['from_image']}\n")
-            dockerfile.write("USER root\n")
-            dockerfile.write("\n")
-
-            # Groups specification
-            if 'groups' in self.config:
-                # Create all groups first
-                for group_name, group_id in self.config['groups'].items():
-                    dockerfile.write(
-                        f"RUN groupadd {group_name} -g {group_id}\n")
-                dockerfile.write("\n")
-
-            # Users with uids, gids, groups and shell
-            if 'users' in self.config:
-                # Creating all users with appropriate uid an gid, along with custom shell
-                for user in self.config['users']:
-                    dockerfile.write(user_template.substitute(
-                        username=user['name'], uid=user['uid'], gid=user['gid']))
-
-                    if 'groups' in user:
-                        dockerfile.write(user_tamplate_add_groups.substitute(
-                            usergroups=','.join(str(x) for x in user['groups']), username=user['name']))
-
-                    # Get shell user wants to use
-                    # if user['name'] == self.current_user:
-                    #     self.shell = user['shell']
-                dockerfile.write("\n")
-
-            # Mount drives
-            if 'drives' in self.config:
-                # Mount all the drives
-                dockerfile.write("RUN touch /etc/fstab\n")
-                for drive, mount in self.split_items_list(self.config['drives']):
-                    dockerfile.write(
-                        f"RUN mkdir -p {mount}"
-                        f" && echo '{drive} {mount} nfs defaults 0 0' >> /etc/fstab\n")
-                dockerfile.write("\n")
-
-            if 'copyfiles' in self.config:
-                for file_source, file_target in self.split_items_list(self.config['copyfiles']):
-                    # Local file has to be copied to the same directory as dockerfile.
-                    source = pathlib.Path(file_source).expanduser()
-                    if not source.is_absolute():
-                        source = source.absolute()
-                    if not source.exists():
-                        logging.error("Source target does not exist, skipping copying file %s" % source)
-                        continue
-                    
-                    # TODO 
-                        
-                    # Do not copy file to dockerfile location if they are in the same dir as 
-                    # shutil will raise samefile error
-                    if source.parent != where:
-                        shutil.copy2(str(source), str(where))
-
-                    # Expand user for target as well
-                    target = pathlib.Path(file_target).expanduser()
-
-                    # Create copy command with source name only since it is in the same dir.
-                    dockerfile.write(f"COPY {source.name} {target}\n")
-
-                dockerfile.write("\n")
-
-            # Symlinks
-            if 'symlinks' in self.config:
-                for symlink in self.split_items_list(self.config['symlinks']):
-                    dockerfile.write(f"RUN ln -s {symlink[0]} {symlink[1]}\n")
-
-            # Exports
-            if 'export' in self.config:
-                for item in self.config['export']:
-                    dockerfile.write(f"ENV {item}\n")
-                dockerfile.write("\n")
-
-            dockerfile.write(
-                f"RUN chown {run_uid}:{run_gid} /prj/ssp /prj/ssp/** /prj/ssp/.cpm\n")
-            # Set user
-            if skip_config:
-                dockerfile.write(f"RUN cpm init -y --skip-config\n")
-            else:
-                dockerfile.write(f"RUN cpm init -y\n")
-            dockerfile.write("\n")
-            dockerfile.write(f"USER {self.current_user}\n")
-            dockerfile.write(f"WORKDIR /home/{self.current_user}\n")
-            dockerfile.write(
-                f"CMD sudo mount -a & sudo /usr/sbin/sshd -D & /bin/bash\n")
-            dockerfile.write("\n")
+        (where / 'Dockerfile').write_text(
+            self.render_dockerfile(skip_config, run_uid, run_gid))
+
+    def render_dockerfile(self, skip_config, run_uid, run_gid):
+        """Render Dockerfile in order given by `layer_order` of ssp.yaml.
+
+        With `config` order, sections follow ssp.yaml. With `cost` order, cheap steps are grouped
+        to single layers and sections listed in `after_cpm_init` go after `cpm init`, so that e.g.
+        editing an export does not invalidate the `cpm init` layer. Entries `cpm init` may depend
+        on stay ahead of it anyway, see :meth:`_cpm_dependencies`.
+
+        With `shared_base`, only the thin per-user stage on top of `base_image` is rendered,
+        see :meth:`render_base`.
+
+        :rtype: str
+        """
+        chown = self._chown_section(run_uid, run_gid)
+        if self.config.shared_base:
+            dockerfile = [f"FROM {self.config.base_image}\n", "USER root\n", "\n"] + chown + ["\n"]
+        else:
+            dockerfile = self._base_sections(skip_config, chown)
+
+        dockerfile.append(f"USER {self.current_user}\n")
+        dockerfile.append(f"WORKDIR /home/{self.current_user}\n")
+        dockerfile.append(self._cmd())
+        dockerfile.append("\n")
+        return ''.join(dockerfile)
+
+    def render_base(self, skip_config):
+        """Render Dockerfile of the base image shared by all users of ssp.yaml.
+
+        It contains everything but ownership of /prj/ssp and the user the container runs as.
+
+        :rtype: str
+        """
+        return ''.join(self._base_sections(skip_config, []))
+
+    def _base_sections(self, skip_config, chown):
+        # We are creating am image from distribution image
+        dockerfile = [f"FROM {self.config.from_image}\n", "USER root\n", "\n"]
+        if self.buildkit and self.config.buildkit_syntax:
+            dockerfile.insert(0, f"# syntax={self.config.buildkit_syntax}\n")
+
+        if self.config.layer_order == 'cost':
+            # Same order as with `config`, only the sections independent of cpm init move after it
+            moved = set(self.config.after_cpm_init)
+            before, after = self._cpm_dependencies()
+            for section in ('users', 'drives', 'caches'):
+                if section not in moved:
+                    dockerfile += self._section(section)
+            dockerfile += self._copyfiles_section(before['copyfiles'])
+            dockerfile += self._symlinks_section(before['symlinks'], grouped=True)
+            dockerfile += self._env_section(before['export'], grouped=True)
+            if chown:
+                dockerfile += chown + ["\n"]
+            dockerfile += self._cpm_init_section(skip_config)
+            for section in ('users', 'drives', 'caches'):
+                if section in moved:
+                    dockerfile += self._section(section)
+            dockerfile += self._copyfiles_section(after['copyfiles'], largest_first=True)
+            dockerfile += self._symlinks_section(after['symlinks'], grouped=True)
+            dockerfile += self._env_section(after['export'], grouped=True)
+        else:
+            dockerfile += self._users_section()
+            dockerfile += self._drives_section()
+            dockerfile += self._caches_section()
+            dockerfile += self._copyfiles_section()
+            dockerfile += self._symlinks_section()
+            dockerfile += self._env_section(self.config.export)
+            dockerfile += chown
+            dockerfile += self._cpm_init_section(skip_config)
+        return dockerfile
+
+    def _section(self, name):
+        if name == 'users':
+            return self._users_section(grouped=True)
+        if name == 'drives':
+            return self._drives_section(grouped=True)
+        return self._caches_section()
+
+    def _cpm_dependencies(self):
+        """Split `copyfiles`, `symlinks` and `export` to entries which have to stay before `cpm init` and the rest.
+
+        Only sections listed in `after_cpm_init` are split. Even then, copyfiles and symlinks into
+        /prj/ssp, `CPM_*` and `MGEN_*` exports, `*PATH` exports and exports referring to /prj/ssp
+        or other variables stay ahead of `cpm init`, together with the exports they refer to.
+
+        :return: Entries before and after `cpm init` by section.
+        :rtype: ({str: list}, {str: list})
+        """
+        moved = set(self.config.after_cpm_init)
+        copyfiles = list(self.copyfiles())
+        entries = {
+            'copyfiles': (copyfiles, lambda copyfile: self._in_ssp_root(copyfile[1])),
+            'symlinks': (self.config.symlinks,
+                         lambda symlink: self._in_ssp_root(symlink.source) or self._in_ssp_root(symlink.target)),
+            'export': (self.config.export, self._kept_exports()),
+        }
+        before, after = {}, {}
+        for section, (items, needed) in entries.items():
+            before[section] = [item for item in items if section not in moved or needed(item)]
+            after[section] = [item for item in items if section in moved and not needed(item)]
+        return before, after
+
+    def _kept_exports(self):
+        # Exports staying ahead of `cpm init`, and whatever they refer to, as a predicate
+        kept = {item for item in self.config.export if self._cpm_reads(item)}
+        while True:
+            referred = {item for item in self.config.export if item not in kept and any(
+                re.search(r'\$\{?%s\b' % re.escape(re.split(r'[=\s]', item, 1)[0]), other) for other in kept)}
+            if not referred:
+                return lambda item: item in kept
+            kept |= referred
+
+    def _cpm_reads(self, item):
+        name, _, value = item.partition('=')
+        return (name.startswith(self.CPM_ENV_PREFIXES) or name.endswith('PATH')
+                or '$' in item or self.SSP_ROOT in value)
+
+    @classmethod
+    def _in_ssp_root(cls, path):
+        path = pathlib.PurePosixPath(str(path))
+        return path == pathlib.PurePosixPath(cls.SSP_ROOT) or pathlib.PurePosixPath(cls.SSP_ROOT) in path.parents
+
+    def _users_section(self, grouped=False):
+        section = []
+        if self.config.provisioning == 'batch':
+            section.append(users_batch_template.substitute(
+                provisioning=self.PROVISIONING_DIR))
+            section.append("\n")
+            return section
+
+        # Groups specification
+        if self.config.groups:
+            # Create all groups first
+            commands = [f"groupadd {group.name} -g {group.gid}" for group in self.config.groups]
+            section += self._run(commands, grouped)
+            section.append("\n")
+
+        # Users with uids, gids, groups and shell
+        if self.config.users:
+            # Creating all users with appropriate uid an gid, along with custom shell
+            for user in self.config.users:
+                section.append(user_template.substitute(
+                    username=user.name, uid=user.uid, gid=user.gid))
+
+                if user.groups:
+                    section.append(user_tamplate_add_groups.substitute(
+                        usergroups=','.join(str(x) for x in user.groups), username=user.name))
+            section.append("\n")
+        return section
+
+    def _drives_section(self, grouped=False):
+        # Volumes and bind mounts are attached by `docker run`
+        if not self._mounts_in_container():
+            return []
+        # Mount all the drives
+        commands = ["touch /etc/fstab"]
+        commands += [f"mkdir -p {drive.target}"
+                     f" && echo '{drive.source} {drive.target} nfs defaults 0 0' >> /etc/fstab"
+                     for drive in self.config.drives]
+        section = self._run(commands, grouped)
+        section.append(f"COPY {self.DRIVES_DIR} /usr/local/lib/{self.DRIVES_DIR}\n")
+        section.append(f"RUN chmod 755 /usr/local/lib/{self.DRIVES_DIR}/mount \\\n"
+                       f"    && for rc in /etc/bash.bashrc /etc/bashrc; do \\\n"
+                       f"        if [ -f \"$rc\" ]; then cat /usr/local/lib/{self.DRIVES_DIR}/wait.sh >> \"$rc\"; fi; done\n")
+        return section + ["\n"]
+
+    def _caches_section(self):
+        if not self.config.caches:
+            return []
+        # Docker initializes new cache volumes with the mode of their mount point, all users can write
+        targets = ' '.join(cache.target for cache in self.config.caches)
+        return [f"RUN mkdir -p {targets} && chmod 1777 {targets}\n", "\n"]
+
+    def _mounts_in_container(self):
+        return self.config.drive_strategy == 'fstab' and bool(self.config.drives)
+
+    def _cmd(self):
+        if self._mounts_in_container():
+            return f"CMD sudo /usr/local/lib/{self.DRIVES_DIR}/mount & sudo /usr/sbin/sshd -D & /bin/bash\n"
+        if self.config.drives:
+            return "CMD sudo /usr/sbin/sshd -D & /bin/bash\n"
+        return "CMD sudo mount -a & sudo /usr/sbin/sshd -D & /bin/bash\n"
+
+    def _copyfiles_section(self, copyfiles=None, largest_first=False):
+        copyfiles = list(self.copyfiles()) if copyfiles is None else list(copyfiles)
+        if not copyfiles:
+            return []
+        # Later COPY wins when targets overlap, their order must not change then
+        targets = [pathlib.PurePosixPath(str(target)) for _, target in copyfiles]
+        if largest_first and not any(target in other.parents for target in targets for other in targets):
+            # Large files, e.g. tool installers, change rarely and are expensive to re-add
+            copyfiles.sort(key=lambda copyfile: -sum(
+                path.stat().st_size for _, path in manifest.walk(copyfile[0], copyfile[0].name)))
+        # Create copy command with source name only since it is in the same dir.
+        # Content of directory sources is copied into the target directory.
+        return [f"COPY {source.name} {target}\n" for source, target in copyfiles] + ["\n"]
+
+    def _symlinks_section(self, symlinks=None, grouped=False):
+        symlinks = self.config.symlinks if symlinks is None else symlinks
+        commands = [f"ln -s {symlink.source} {symlink.target}" for symlink in symlinks]
+        if not commands:
+            return []
+        return self._run(commands, grouped) + (["\n"] if grouped else [])
+
+    def _env_section(self, items, grouped=False):
+        if not items:
+            return []
+        # Only KEY=VALUE form can be merged to one instruction, and variables are substituted
+        # with values from before the instruction, so references need instructions of their own
+        if grouped and all('=' in item and '$' not in item for item in items):
+            return ["ENV " + " \\\n    ".join(items) + "\n", "\n"]
+        return [f"ENV {item}\n" for item in items] + ["\n"]
+
+    def _chown_section(self, run_uid, run_gid):
+        return [self.ownership_instruction(self.config.ownership, run_uid, run_gid)]
 
     @classmethod
-    def split_items_list(self, items):
-        for item in items:
-            split_list = list(filter(lambda x: len(x) > 0, item.split(" ")))
-            if len(split_list) != 2:
-                raise exceptions.Exceptions().SSPSetupError("An error ocured while parsing yaml input.\n Error ocured while parsing: %s" % items)
-            yield split_list
+    def ownership_instruction(cls, strategy, run_uid, run_gid):
+        """Instruction giving the container user ownership of /prj/ssp.
+
+        `chown` changes owner of /prj/ssp, the entries directly in it and /prj/ssp/.cpm. On overlay
+        filesystems, every regular file whose owner is set is copied to the new layer, even when the
+        owner does not change. `state` changes owner of the same entries, but skips those the user
+        owns already, e.g. in images installed as the container user. It never copies more than `chown`.
+
+        :param strategy: One of :attr:`ssp.model.SSPConfig.OWNERSHIP_STRATEGIES`.
+        :type strategy: str
+        :rtype: str
+        """
+        if strategy == 'state':
+            return (f"RUN find -L /prj/ssp /prj/ssp/** /prj/ssp/.cpm -maxdepth 0 "
+                    f"! \\( -user {run_uid} -group {run_gid} \\) \\\n"
+                    f"        -exec chown {run_uid}:{run_gid} {{}} +\n")
+        return f"RUN chown {run_uid}:{run_gid} /prj/ssp /prj/ssp/** /prj/ssp/.cpm\n"
+
+    def _cpm_init_section(self, skip_config):
+        run = "RUN"
+        if self.buildkit:
+            # Package manager caches survive between builds, without being stored in the image
+            run += ''.join(f" --mount=type=cache,target={target}" for target in self.config.cache_mounts)
+        if skip_config:
+            return [f"{run} cpm init -y --skip-config\n", "\n"]
+        return [f"{run} cpm init -y\n", "\n"]
+
+    @classmethod
+    def _run(cls, commands, grouped):
+        if grouped:
+            return ["RUN " + " \\\n    && ".join(commands) + "\n"]
+        return [f"RUN {command}\n" for command in commands]
+
+    @classmethod
+    def explain(cls, previous, current, changed_sources=()):
+        """Report which layers of the current Dockerfile are rebuilt, compared to the previous one.
+
+        Docker reuses cached layers up to the first instruction which differs, every layer after
+        it is rebuilt. COPY is also rebuilt when its source content changed.
+
+        :param previous: Previously built Dockerfile.
+        :type previous: str
+        :param current: Newly generated Dockerfile.
+        :type current: str
+        :param changed_sources: Sources of COPY instructions whose content changed.
+        :type changed_sources: {str}
+        :return: Report lines.
+        :rtype: [str]
+        """
+        old = cls.instructions(previous)
+        new = cls.instructions(current)
+        rebuild_from = len(new)
+        for index, instruction in enumerate(new):
+            copy_source = instruction.split()[1] if instruction.startswith('COPY ') else None
+            if index >= len(old) or old[index] != instruction or copy_source in changed_sources:
+                rebuild_from = index
+                break
+
+        report = ["%d of %d instructions are reused from cache, %d are rebuilt" %
+                  (rebuild_from, len(new), len(new) - rebuild_from)]
+        for index, instruction in enumerate(new):
+            status = 'cached' if index < rebuild_from else 'rebuild'
+            if index == rebuild_from:
+                status = 'changed'
+            elif status == 'cached' and instruction.startswith('COPY '):
+                status = 'cached?'
+            summary = instruction if len(instruction) <= 100 else instruction[:97] + '...'
+            report.append("  %-8s %s" % (status, summary))
+        if any(line.startswith('  cached?') for line in report):
+            report.append("  cached? = reused only if the copied source did not change")
+        return report
+
+    @classmethod
+    def instructions(cls, dockerfile):
+        # Join continuation lines, drop empty lines and comments
+        instructions = []
+        current = ''
+        for line in dockerfile.splitlines():
+            stripped = line.strip()
+            if not current and (not stripped or stripped.startswith('#')):
+                continue
+            if stripped.endswith('\\'):
+                current += stripped[:-1].strip() + ' '
+                continue
+            instructions.append(' '.join((current + stripped).split()))
+            current = ''
+        if current:
+            instructions.append(' '.join(current.split()))
+        return instructions
+
+    def provisioning_files(self):
+        """Render batch provisioning files.
+
+        :return: Content of group, newusers(8) and sudoers input files, by file name.
+        :rtype: {str: str}
+        """
+        users = self.config.users
+        files = {
+            'groups': [f"{group.name} {group.gid}" for group in self.config.groups],
+            # newusers format: name:password:uid:gid:gecos:home:shell
+            'users': [f"{user.name}:{user.name}:{user.uid}:{user.gid}::/home/{user.name}:"
+                      for user in users],
+            'memberships': [f"{user.name} {','.join(str(x) for x in user.groups)}"
+                            for user in users if user.groups],
+            'sudoers': [f"{user.name} ALL=(ALL) NOPASSWD: ALL" for user in users],
+        }
+        return {name: ''.join(line + '\n' for line in lines) for name, lines in files.items()}
+
+    def drive_files(self):
+        """Render scripts mounting `drives` concurrently inside the container.
+
+        :return: Content of the mount script and of the bashrc snippet waiting for it, by file name.
+        :rtype: {str: str}
+        """
+        targets = ' '.join(shlex.quote(drive.target) for drive in self.config.drives)
+        return {'mount': drives_mount_template.substitute(targets=targets),
+                'wait.sh': drives_wait_script}
+
+    def generated_contents(self):
+        """Render files generated into the Docker context besides Dockerfile.
+
+        :return: Content by path relative to the Dockerfile.
+        :rtype: {pathlib.PurePosixPath: str}
+        """
+        files = {}
+        if self.config.provisioning == 'batch':
+            for name, content in self.provisioning_files().items():
+                files[pathlib.PurePosixPath(self.PROVISIONING_DIR, name)] = content
+        if self._mounts_in_container():
+            for name, content in self.drive_files().items():
+                files[pathlib.PurePosixPath(self.DRIVES_DIR, name)] = content
+        return files
+
+    def generate_files(self, where):
+        """Generate batch provisioning files and drive mount scripts.
+
+        :param where: Path where the Docker context directory is.
+        :type where: pathlib.Path
+        """
+        if self.config.provisioning == 'batch':
+            logging.info("Generating batch provisioning files for %d users" %
+                         len(self.config.users))
+        for path, content in self.generated_contents().items():
+            (where / path).parent.mkdir(parents=True, exist_ok=True)
+            (where / path).write_text(content)
+            self.generated_files.append(pathlib.Path(path))
+
+    def changed_sources(self, where):
+        """Names of generated COPY sources whose content differs from the ones in `where`."""
+        changed = set()
+        for path, content in self.generated_contents().items():
+            previous = where / path
+            if not previous.exists() or previous.read_text() != content:
+                changed.add(path.parts[0])
+        return changed
+
+    def copyfiles(self):
+        """Resolve `copyfiles` entries to existing host sources and image targets.
+
+        :return: Pairs of absolute host source path and target path in the image.
+        :rtype: [(pathlib.Path, pathlib.Path)]
+        """
+        for copyfile in self.config.copyfiles:
+            # Local file has to be copied to the same directory as dockerfile.
+            source = pathlib.Path(copyfile.source).expanduser()
+            if not source.is_absolute():
+                source = source.absolute()
+            if not source.exists():
+                logging.error("Source target does not exist, skipping copying file %s" % source)
+                continue
+
+            # Expand user for target as well
+            yield source, pathlib.Path(copyfile.target).expanduser()
+
+    def context_digest(self, where, from_image_id, files=None):
+        """Compute digest of everything the customized image is built from.
+
+        :param where: Path where the generated Dockerfile is.
+        :type where: pathlib.Path
+        :param from_image_id: Id of the local base image, or its name if it was not pulled yet.
+            For the per-user image of `shared_base`, digest of the shared base image.
+        :type from_image_id: str
+        :param files: Context files, :meth:`context_files` by default.
+        :type files: [(str, pathlib.Path)]
+        :return: Hex encoded sha256 digest.
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        digest.update(from_image_id.encode('utf-8') + b'\0')
+        # Hashes of unchanged files are reused from the manifest instead of reading them again
+        for arcname, path in files if files is not None else self.context_files(where):
+            digest.update(f"\0{arcname}\0{self.manifest.sha256(path)}".encode('utf-8'))
+        self.manifest.save()
+        logging.debug("Hashed %d bytes of build context" % self.manifest.hashed_bytes)
+
+        return digest.hexdigest()
+
+    def context_files(self, where):
+        """List files the Docker build context consists of.
+
+        With `shared_base`, it is only the per-user Dockerfile, see :meth:`base_context_files`.
+
+        :param where: Path where the generated Dockerfile is.
+        :type where: pathlib.Path
+        :return: Pairs of name inside the context and path of the host file.
+        :rtype: [(str, pathlib.Path)]
+        """
+        if self.config.shared_base:
+            return [('Dockerfile', where / 'Dockerfile')]
+        return self._context_files(where, where / 'Dockerfile')
+
+    def base_context_files(self, where):
+        """List files the build context of the shared base image consists of."""
+        return self._context_files(where, where / self.BASE_DOCKERFILE)
+
+    def _context_files(self, where, dockerfile):
+        files = [('Dockerfile', dockerfile)]
+        files += [(str(generated), where / generated)
+                  for generated in self.generated_files]
+        if self.config.copyfiles:
+            for source, _ in self.copyfiles():
+                files += manifest.walk(source, source.name)
+        return files
 
 
 class Yamlgen:
@@ -168,6 +571,12 @@ class Yamlgen:
         self.yaml_path = yaml_path
 
     def generate_yamlfile(self, ssp_yaml, indent=4):
+        import yaml
+        try:
+            from yaml import CDumper as Dumper
+        except ImportError:
+            from yaml import Dumper
+
         with open(str(self.yaml_path.joinpath(self.yaml_name)), 'w') as fp:
             yaml.dump(ssp_yaml, fp, Dumper=Dumper, indent=indent,
                       default_flow_style=False,  allow_unicode=True, sort_keys=False)
@@ -0,0 +1,201 @@
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+
+from ssp import config
+from ssp.exceptions import Exceptions
+
+# Files staged by ssp into a directory, see :func:`stage`
+STAGED_MANIFEST = '.ssp-staged.json'
+# Linux ioctl sharing data blocks of two files, supported e.g. by btrfs and XFS
+FICLONE = 0x40049409
+
+
+class ContentManifest:
+    """Content hashes of files, reused as long as size, modification time and inode do not change.
+
+    The manifest is kept in `SSP_STATE_PATH`, so unchanged multi-GB `copyfiles` sources are
+    not read again to compute the digest of the build context.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config.SSP_STATE_PATH.joinpath('cache', 'content-manifest.json')
+        self.hashed_bytes = 0
+        self._entries = None
+        self._changed = False
+
+    def sha256(self, path):
+        """Hex encoded sha256 of the file content."""
+        entries = self._load()
+        stat = path.stat()
+        key = str(path.absolute())
+        stamp = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entry = entries.get(key)
+        if entry and entry[:3] == stamp:
+            return entry[3]
+
+        digest = hashlib.sha256()
+        with path.open('rb') as fp:
+            for chunk in iter(functools.partial(fp.read, 1024 * 1024), b''):
+                digest.update(chunk)
+        self.hashed_bytes += stat.st_size
+        entries[key] = stamp + [digest.hexdigest()]
+        self._changed = True
+        return entries[key][3]
+
+    def save(self):
+        if not self._changed:
+            return
+        # Forget removed files, so the manifest does not grow forever
+        entries = {key: entry for key, entry in self._entries.items() if os.path.exists(key)}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = self.path.with_suffix('.%d.tmp' % os.getpid())
+            temporary.write_text(json.dumps(entries))
+            os.replace(str(temporary), str(self.path))
+        except OSError as error:
+            logging.debug("Unable to write content manifest: %s" % error)
+        self._changed = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+
+def walk(source, arcname):
+    """List files of a `copyfiles` source, which can be a file or a directory.
+
+    :param source: File or directory.
+    :type source: pathlib.Path
+    :param arcname: Name of the source inside the build context.
+    :type arcname: str
+    :return: Pairs of name inside the build context and path of the file, sorted by the name.
+    :rtype: [(str, pathlib.Path)]
+    """
+    if not source.is_dir():
+        return [(arcname, source)]
+    files = []
+    for directory, dirnames, filenames in os.walk(str(source)):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = pathlib.Path(directory, name)
+            files.append((f"{arcname}/{path.relative_to(source).as_posix()}", path))
+    return files
+
+
+def stage(files, where):
+    """Make files available in directory `where` under their names, touching only what changed.
+
+    Files are hardlinked when `where` is on the same filesystem, reflinked when the filesystem
+    supports it, and copied otherwise. Files ssp staged earlier are listed in `STAGED_MANIFEST`
+    in `where`, only those are replaced or removed when they are no longer among `files`.
+    Other files in `where`, e.g. of the user in the current directory, are never modified.
+
+    :param files: Pairs of name inside `where` and path of the file, see :func:`walk`.
+    :type files: [(str, pathlib.Path)]
+    :return: Number of files by how they were staged: unchanged, link, reflink and copy.
+    :rtype: {str: int}
+    :raises Exceptions.SSPSetupError: When a file not staged by ssp is in the way.
+    """
+    staged = _load_staged(where)
+    counts = {'unchanged': 0, 'link': 0, 'reflink': 0, 'copy': 0}
+    conflicts = []
+    for arcname, source in files:
+        target = where / arcname
+        if target.exists() or target.is_symlink():
+            if target.is_file() and _same(source, target):
+                counts['unchanged'] += 1
+                continue
+            if not _staged_by_ssp(staged, arcname, target):
+                conflicts.append(arcname)
+                continue
+    if conflicts:
+        raise Exceptions.SSPSetupError(
+            "Unable to stage copyfiles, %s in %s not created by ssp: %s. Remove them or run from another directory" % (
+                "file is" if len(conflicts) == 1 else "files are", where, ', '.join(conflicts[:5])))
+
+    for arcname, source in files:
+        target = where / arcname
+        if target.exists():
+            if _same(source, target):
+                if arcname in staged:
+                    staged[arcname] = _stamp(target)
+                continue
+            target.unlink()
+        target.parent.mkdir(parents=True, exist_ok=True)
+        counts[_place(source, target)] += 1
+        staged[arcname] = _stamp(target)
+
+    names = {arcname for arcname, _ in files}
+    for arcname in [arcname for arcname in staged if arcname not in names]:
+        target = where / arcname
+        if _staged_by_ssp(staged, arcname, target) and target.is_file():
+            target.unlink()
+        elif target.exists():
+            logging.warning("Keeping %s, it was modified since ssp staged it" % target)
+        del staged[arcname]
+    _save_staged(where, staged)
+    return counts
+
+
+def _stamp(path):
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def _staged_by_ssp(staged, arcname, target):
+    # Unchanged since ssp placed it, anything else belongs to the user
+    return arcname in staged and target.is_file() and not target.is_symlink() and _stamp(target) == staged[arcname]
+
+
+def _load_staged(where):
+    try:
+        return json.loads((where / STAGED_MANIFEST).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_staged(where, staged):
+    path = where / STAGED_MANIFEST
+    if not staged and not path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + '.%d.tmp' % os.getpid())
+    temporary.write_text(json.dumps(staged, sort_keys=True))
+    os.replace(str(temporary), str(path))
+
+
+def _same(source, target):
+    source_stat = source.stat()
+    target_stat = target.stat()
+    if (source_stat.st_dev, source_stat.st_ino) == (target_stat.st_dev, target_stat.st_ino):
+        return True
+    # Copies keep modification time of the source
+    return (source_stat.st_size, source_stat.st_mtime_ns) == (target_stat.st_size, target_stat.st_mtime_ns)
+
+
+def _place(source, target):
+    try:
+        os.link(str(source), str(target))
+        return 'link'
+    except OSError:
+        pass
+    try:
+        with source.open('rb') as source_fp, target.open('wb') as target_fp:
+            fcntl.ioctl(target_fp.fileno(), FICLONE, source_fp.fileno())
+        shutil.copystat(str(source), str(target))
+        return 'reflink'
+    except OSError:
+        if target.exists():
+            target.unlink()
+    shutil.copy2(str(source), str(target))
+    return 'copy'
@@ -0,0 +1,458 @@
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+
+from ssp import config
+from ssp.exceptions import Exceptions
+
+
+class UserRecord:
+    __slots__ = ('name', 'uid', 'gid', 'groups', 'shell')
+
+    def __init__(self, name, uid, gid, groups=(), shell=None):
+        self.name = name
+        self.uid = uid
+        self.gid = gid
+        self.groups = tuple(groups)
+        self.shell = shell
+
+
+class GroupRecord:
+    __slots__ = ('name', 'gid')
+
+    def __init__(self, name, gid):
+        self.name = name
+        self.gid = gid
+
+
+class PathPair:
+    """Source and target of `drives`, `symlinks` and `copyfiles` entries."""
+    __slots__ = ('source', 'target')
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+
+class CacheRecord:
+    """Persistent cache volume mounted to `target`, see `caches` of ssp.yaml."""
+    __slots__ = ('name', 'target', 'size_limit', 'export')
+
+    def __init__(self, name, target, size_limit=None, export=()):
+        self.name = name
+        self.target = target
+        self.size_limit = size_limit
+        self.export = tuple(export)
+
+
+class ResourcesRecord:
+    """Scratch space and limits of containers, see `resources` of ssp.yaml.
+
+    Sizes are in bytes, ulimits map the limit name to soft and hard value, -1 is unlimited.
+    """
+    __slots__ = ('scratch', 'scratch_size', 'shm_size', 'cpus', 'memory', 'ulimits')
+
+    DEFAULT_SCRATCH = '/scratch'
+
+    def __init__(self, scratch=None, scratch_size=None, shm_size=None, cpus=None, memory=None, ulimits=None):
+        # Size of the scratch alone mounts it to the default target
+        self.scratch = scratch or (self.DEFAULT_SCRATCH if scratch_size else None)
+        self.scratch_size = scratch_size
+        self.shm_size = shm_size
+        self.cpus = cpus
+        self.memory = memory
+        self.ulimits = dict(ulimits or {})
+
+    def replace(self, **overrides):
+        """Copy of the record with values which are not None replaced, ulimits are merged."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values['ulimits'] = dict(self.ulimits, **(overrides.pop('ulimits', None) or {}))
+        values.update((name, value) for name, value in overrides.items() if value is not None)
+        return ResourcesRecord(**values)
+
+
+class PlacementRecord:
+    """CPU placement of containers on the host, see `placement` of ssp.yaml."""
+    __slots__ = ('policy', 'cores')
+
+    def __init__(self, policy=None, cores=None):
+        self.policy = policy
+        self.cores = cores
+
+
+class SSPConfig:
+    """Validated content of ssp.yaml.
+
+    Users and groups are indexed by name and id, `source target` entries are split
+    once when the configuration is loaded.
+    """
+    __slots__ = ('from_image', 'new_image', 'shared_base', 'base_image', 'provisioning', 'layer_order', 'after_cpm_init',
+                 'ownership',
+                 'buildkit', 'buildkit_syntax', 'cache_mounts', 'drive_strategy', 'drive_options', 'caches',
+                 'cache_project', 'resources', 'placement', 'display', 'display_ipc', 'users', 'groups', 'drives', 'symlinks', 'copyfiles', 'export', 'registries', 'users_by_name', 'users_by_uid', 'groups_by_name',
+                 'groups_by_gid')
+
+    # Bump when the layout of the classes above changes, so old compiled caches are not used
+    CACHE_VERSION = 11
+    PROVISIONING_MODES = ('layered', 'batch')
+    LAYER_ORDERS = ('config', 'cost')
+    # Sections `layer_order: cost` may move after `cpm init` when listed in `after_cpm_init`
+    CPM_INDEPENDENT_SECTIONS = ('users', 'drives', 'caches', 'copyfiles', 'symlinks', 'export')
+    OWNERSHIP_STRATEGIES = ('chown', 'state')
+    DRIVE_STRATEGIES = ('fstab', 'volume', 'bind')
+    PLACEMENT_POLICIES = ('packed', 'spread', 'reserved')
+    DISPLAY_MODES = ('ssh', 'local')
+    # Variables exported for well known caches, formatted with target and size of the cache as in ssp.yaml
+    CACHE_EXPORTS = {
+        'ccache': ('CCACHE_DIR={target}', 'CCACHE_MAXSIZE={size}'),
+        'pip': ('PIP_CACHE_DIR={target}',),
+    }
+    SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+    @classmethod
+    def load(cls, path, use_cache=True):
+        """Load configuration from ssp.yaml, using the compiled cache when the file did not change.
+
+        :param path: Path to ssp.yaml.
+        :type path: pathlib.Path
+        :rtype: SSPConfig
+        """
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        cache_path = config.SSP_STATE_PATH.joinpath(
+            'cache', 'config-%s.pickle' % hashlib.sha1(str(path).encode('utf-8')).hexdigest())
+
+        cached = cls._read_cache(cache_path) if use_cache else None
+        if cached and (cached['mtime_ns'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+            logging.debug("Using compiled configuration %s" % cache_path)
+            return cached['config']
+
+        content = path.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached and cached['sha256'] == digest:
+            # Only touched, content is the same
+            ssp_config = cached['config']
+        else:
+            ssp_config = cls.from_yaml(content, path)
+
+        if use_cache:
+            cls._write_cache(cache_path, {'version': cls.CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns,
+                                          'size': stat.st_size, 'sha256': digest, 'config': ssp_config})
+        return ssp_config
+
+    @classmethod
+    def from_yaml(cls, content, path='ssp.yaml'):
+        import yaml
+        try:
+            from yaml import CLoader as Loader
+        except ImportError:
+            from yaml import Loader
+
+        try:
+            raw = yaml.load(content, Loader=Loader)
+        except yaml.YAMLError as error:
+            raise Exceptions.ConfigurationError(
+                "Unable to parse %s: %s" % (path, error))
+        return cls.from_dict(raw or {}, path)
+
+    @classmethod
+    def from_dict(cls, raw, path='ssp.yaml'):
+        """Validate raw configuration and build the model. All problems are reported at once."""
+        errors = []
+        ssp_config = cls.__new__(cls)
+
+        if not isinstance(raw, dict):
+            raise Exceptions.ConfigurationError(
+                "Invalid configuration %s: expected mapping of sections" % path)
+        for key in ('from_image', 'new_image'):
+            if not isinstance(raw.get(key), str) or not raw.get(key):
+                errors.append("`%s` has to be an image name" % key)
+        ssp_config.from_image = raw.get('from_image')
+        ssp_config.new_image = raw.get('new_image')
+
+        ssp_config.shared_base = raw.get('shared_base') or False
+        if not isinstance(ssp_config.shared_base, bool):
+            errors.append("`shared_base` has to be true or false")
+        ssp_config.base_image = raw.get('base_image')
+        if ssp_config.base_image is not None and not isinstance(ssp_config.base_image, str):
+            errors.append("`base_image` has to be an image name")
+        elif ssp_config.base_image is None and isinstance(ssp_config.new_image, str):
+            ssp_config.base_image = cls._derive_image(ssp_config.new_image, '-base')
+
+        ssp_config.provisioning = raw.get('provisioning') or 'layered'
+        if ssp_config.provisioning not in cls.PROVISIONING_MODES:
+            errors.append("`provisioning` has to be one of: %s" %
+                          ', '.join(cls.PROVISIONING_MODES))
+
+        ssp_config.layer_order = raw.get('layer_order') or 'config'
+        if ssp_config.layer_order not in cls.LAYER_ORDERS:
+            errors.append("`layer_order` has to be one of: %s" %
+                          ', '.join(cls.LAYER_ORDERS))
+        ssp_config.after_cpm_init = [str(item) for item in cls._list(raw, 'after_cpm_init', errors)]
+        for section in ssp_config.after_cpm_init:
+            if section not in cls.CPM_INDEPENDENT_SECTIONS:
+                errors.append("`after_cpm_init` sections have to be some of: %s" %
+                              ', '.join(cls.CPM_INDEPENDENT_SECTIONS))
+                break
+
+        ssp_config.ownership = raw.get('ownership') or 'chown'
+        if ssp_config.ownership not in cls.OWNERSHIP_STRATEGIES:
+            errors.append("`ownership` has to be one of: %s" %
+                          ', '.join(cls.OWNERSHIP_STRATEGIES))
+
+        ssp_config.buildkit = raw.get('buildkit') or False
+        if not isinstance(ssp_config.buildkit, bool):
+            errors.append("`buildkit` has to be true or false")
+        # Empty syntax uses the Dockerfile frontend built into BuildKit, e.g. without network
+        ssp_config.buildkit_syntax = raw.get('buildkit_syntax', 'docker/dockerfile:1') or ''
+        ssp_config.cache_mounts = [str(item) for item in cls._list(raw, 'cache_mounts', errors)]
+        if 'cache_mounts' not in raw:
+            ssp_config.cache_mounts = ['/root/.cache']
+
+        ssp_config.groups = []
+        groups = raw.get('groups') or {}
+        if not isinstance(groups, dict):
+            errors.append("`groups` has to be a mapping of group name to gid")
+            groups = {}
+        for name, gid in groups.items():
+            if not isinstance(gid, int):
+                errors.append("gid of group %s has to be a number" % name)
+                continue
+            ssp_config.groups.append(GroupRecord(str(name), gid))
+
+        ssp_config.users = []
+        for index, user in enumerate(cls._list(raw, 'users', errors)):
+            if not isinstance(user, dict) or not user.get('name'):
+                errors.append("user #%d has to define name" % (index + 1))
+                continue
+            if not isinstance(user.get('uid'), int) or not isinstance(user.get('gid'), int):
+                errors.append("uid and gid of user %s have to be numbers" % user['name'])
+                continue
+            ssp_config.users.append(UserRecord(str(user['name']), user['uid'], user['gid'],
+                                               user.get('groups') or (), user.get('shell')))
+
+        ssp_config.users_by_name = cls._index(ssp_config.users, 'name', 'user name', errors)
+        ssp_config.users_by_uid = cls._index(ssp_config.users, 'uid', 'uid', errors)
+        ssp_config.groups_by_name = cls._index(ssp_config.groups, 'name', 'group name', errors)
+        ssp_config.groups_by_gid = cls._index(ssp_config.groups, 'gid', 'gid', errors)
+
+        for section in ('drives', 'symlinks', 'copyfiles'):
+            pairs = []
+            for item in cls._list(raw, section, errors):
+                split_list = list(filter(lambda x: len(x) > 0, str(item).split(" ")))
+                if len(split_list) != 2:
+                    errors.append("`%s` entry has to be `source target`: %s" % (section, item))
+                    continue
+                pairs.append(PathPair(*split_list))
+            setattr(ssp_config, section, pairs)
+
+        ssp_config.drive_strategy = raw.get('drive_strategy') or 'fstab'
+        if ssp_config.drive_strategy not in cls.DRIVE_STRATEGIES:
+            errors.append("`drive_strategy` has to be one of: %s" %
+                          ', '.join(cls.DRIVE_STRATEGIES))
+        ssp_config.drive_options = str(raw.get('drive_options') or 'rw')
+        for drive in ssp_config.drives:
+            # Bind mounts need the drive mounted on the host already, e.g. by autofs
+            if ssp_config.drive_strategy == 'bind' and not drive.source.startswith('/'):
+                errors.append("drive %s has to be a host path with `drive_strategy: bind`" % drive.source)
+
+        ssp_config.export = [str(item) for item in cls._list(raw, 'export', errors)]
+
+        ssp_config.caches = []
+        caches = raw.get('caches') or {}
+        if not isinstance(caches, dict):
+            errors.append("`caches` has to be a mapping of cache name to its target")
+            caches = {}
+        for name, cache in caches.items():
+            if isinstance(cache, str):
+                cache = {'target': cache}
+            if not isinstance(cache, dict) or not str(cache.get('target', '')).startswith('/'):
+                errors.append("cache %s has to define absolute target" % name)
+                continue
+            try:
+                size_limit = cls.parse_size(cache['size']) if cache.get('size') else None
+            except ValueError:
+                errors.append("size of cache %s has to be a number with optional K, M, G or T unit" % name)
+                continue
+            export = [item.format(target=cache['target'], size=cache.get('size'))
+                      for item in cls.CACHE_EXPORTS.get(name, ())
+                      if size_limit is not None or '{size}' not in item]
+            export += [str(item) for item in cache.get('export') or []]
+            ssp_config.caches.append(CacheRecord(str(name), str(cache['target']), size_limit, export))
+            # Cache variables are written to the image as any other export
+            ssp_config.export += export
+        # Caches are kept per project, the image repository without registry and tag by default
+        default_project = str(ssp_config.new_image or '').rpartition('/')[2].partition(':')[0]
+        ssp_config.cache_project = str(raw.get('cache_project') or default_project)
+
+        ssp_config.resources = ResourcesRecord()
+        resources = raw.get('resources') or {}
+        if not isinstance(resources, dict):
+            errors.append("`resources` has to be a mapping")
+            resources = {}
+        try:
+            ssp_config.resources = cls.parse_resources(**resources)
+        except TypeError as error:
+            errors.append("unknown option of `resources`: %s" % str(error).rpartition(' ')[2])
+        except ValueError as error:
+            errors.append("`resources` %s" % error)
+
+        ssp_config.placement = PlacementRecord()
+        placement = raw.get('placement') or {}
+        if not isinstance(placement, dict):
+            errors.append("`placement` has to be a mapping")
+            placement = {}
+        try:
+            ssp_config.placement = cls.parse_placement(placement.get('policy'), placement.get('cores'),
+                                                       ssp_config.resources)
+        except ValueError as error:
+            errors.append("`placement` %s" % error)
+
+        ssp_config.display = raw.get('display') or 'ssh'
+        if ssp_config.display not in cls.DISPLAY_MODES:
+            errors.append("`display` has to be one of: %s" %
+                          ', '.join(cls.DISPLAY_MODES))
+        ssp_config.display_ipc = raw.get('display_ipc') or False
+        if not isinstance(ssp_config.display_ipc, bool):
+            errors.append("`display_ipc` has to be true or false")
+
+        ssp_config.registries = {}
+        registries = raw.get('registries') or {}
+        if not isinstance(registries, dict):
+            errors.append("`registries` has to be a mapping of region to registry")
+            registries = {}
+        for name, registry in registries.items():
+            if not isinstance(registry, dict) or 'url' not in registry or not isinstance(registry.get('distributions'), dict):
+                errors.append("registry %s has to define url and distributions" % name)
+                continue
+            ssp_config.registries[str(name)] = registry
+
+        if errors:
+            raise Exceptions.ConfigurationError(
+                "Invalid configuration %s:\n  %s" % (path, '\n  '.join(errors)))
+        return ssp_config
+
+    @classmethod
+    def parse_size(cls, size):
+        """Parse size like `512M` or `5G` to bytes."""
+        text = str(size).strip().upper().rstrip('B').rstrip('I')
+        unit = text[-1:] if text[-1:] in cls.SIZE_UNITS and not text[-1:].isdigit() else ''
+        return int(float(text[:len(text) - len(unit)]) * cls.SIZE_UNITS[unit])
+
+    @classmethod
+    def parse_resources(cls, scratch=None, scratch_size=None, shm_size=None, cpus=None, memory=None, ulimits=None):
+        """Validate options of `resources` of ssp.yaml, or the same options given on command line.
+
+        :raises ValueError: Describing the invalid option.
+        :rtype: ResourcesRecord
+        """
+        if scratch is not None and not str(scratch).startswith('/'):
+            raise ValueError("scratch has to be an absolute path")
+        sizes = {}
+        for name, size in (('scratch_size', scratch_size), ('shm_size', shm_size), ('memory', memory)):
+            try:
+                sizes[name] = cls.parse_size(size) if size is not None else None
+            except ValueError:
+                raise ValueError("%s has to be a number with optional K, M, G or T unit" % name)
+        try:
+            cpus = float(cpus) if cpus is not None else None
+        except (TypeError, ValueError):
+            cpus = 0
+        if cpus is not None and cpus <= 0:
+            raise ValueError("cpus has to be a positive number")
+        if ulimits is not None and not isinstance(ulimits, dict):
+            raise ValueError("ulimits has to be a mapping of limit name to value")
+        parsed = {}
+        for name, value in (ulimits or {}).items():
+            try:
+                parsed[str(name)] = cls.parse_ulimit(value)
+            except ValueError:
+                raise ValueError("ulimit %s has to be a number, `unlimited` or `soft:hard`" % name)
+        return ResourcesRecord(scratch, cpus=cpus, ulimits=parsed, **sizes)
+
+    @classmethod
+    def parse_placement(cls, policy=None, cores=None, resources=None):
+        """Validate options of `placement` of ssp.yaml. Number of cores defaults to `cpus` of resources.
+
+        :raises ValueError: Describing the invalid option.
+        :rtype: PlacementRecord
+        """
+        if policy is None:
+            return PlacementRecord()
+        if policy not in cls.PLACEMENT_POLICIES:
+            raise ValueError("policy has to be one of: %s" % ', '.join(cls.PLACEMENT_POLICIES))
+        if cores is None and resources is not None and resources.cpus:
+            cores = -(-resources.cpus // 1)
+        if not isinstance(cores, (int, float)) or cores < 1 or int(cores) != cores:
+            raise ValueError("cores has to be a positive whole number, or `cpus` of resources has to be set")
+        return PlacementRecord(policy, int(cores))
+
+    @classmethod
+    def parse_ulimit(cls, value):
+        """Parse ulimit like `65536`, `unlimited` or `1024:65536` to soft and hard value, -1 is unlimited."""
+        values = [-1 if str(item).strip() in ('unlimited', '-1') else int(str(item).strip())
+                  for item in str(value).split(':')]
+        if len(values) > 2 or any(item < -1 for item in values):
+            raise ValueError(value)
+        return values[0], values[-1]
+
+    def user_image(self, user):
+        """Name of the customized image of the user.
+
+        With `shared_base`, every user gets an own image on top of the shared base image,
+        so users on one host do not overwrite each other's `new_image`.
+        """
+        if self.shared_base:
+            return self._derive_image(self.new_image, '-' + user)
+        return self.new_image
+
+    @classmethod
+    def _derive_image(cls, image, suffix):
+        # Suffix goes to repository name, e.g. registry:5000/ssp:1.0 -> registry:5000/ssp-base:1.0
+        repository, separator, tag = image.rpartition(':')
+        if not separator or '/' in tag:
+            return image + suffix
+        return f"{repository}{suffix}:{tag}"
+
+    @classmethod
+    def _list(cls, raw, section, errors):
+        # Sections containing only comments are loaded as None
+        items = raw.get(section) or []
+        if not isinstance(items, list):
+            errors.append("`%s` has to be a list" % section)
+            return []
+        return items
+
+    @classmethod
+    def _index(cls, records, attribute, description, errors):
+        index = {}
+        for record in records:
+            key = getattr(record, attribute)
+            if key in index:
+                errors.append("duplicate %s %s" % (description, key))
+            index[key] = record
+        return index
+
+    @classmethod
+    def _read_cache(cls, cache_path):
+        try:
+            with cache_path.open('rb') as fp:
+                cached = pickle.load(fp)
+        except (OSError, pickle.PickleError, EOFError, AttributeError, ImportError, ValueError, TypeError):
+            return None
+        if not isinstance(cached, dict) or cached.get('version') != cls.CACHE_VERSION:
+            return None
+        return cached
+
+    @classmethod
+    def _write_cache(cls, cache_path, cached):
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = cache_path.with_suffix('.%d.tmp' % os.getpid())
+            with temporary.open('wb') as fp:
+                pickle.dump(cached, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(str(temporary), str(cache_path))
+        except OSError as error:
+            logging.debug("Unable to write compiled configuration: %s" % error)
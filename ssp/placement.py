@@ -0,0 +1,201 @@
+import datetime
+import fcntl
+import grp
+import logging
+import os
+import pathlib
+import time
+
+from ssp import config
+from ssp.engine import api_errors
+
+SYSFS_PATH = pathlib.Path('/sys/devices/system')
+
+
+def parse_cpulist(text):
+    """Parse list of CPUs like `0-3,8,10-11` used by sysfs and `--cpuset-cpus`."""
+    cpus = []
+    for item in text.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def format_cpulist(cpus):
+    """Format CPUs as list of ranges, e.g. `0-3,8`."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+class Topology:
+    """Online CPUs of the host by NUMA node.
+
+    CPUs of a node are ordered so that hyperthreads of one physical core are next to
+    each other, a slice of the list then takes whole cores where possible.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.node_of = {cpu: node for node, cpus in nodes.items() for cpu in cpus}
+
+    @classmethod
+    def from_sysfs(cls, root=SYSFS_PATH):
+        try:
+            online = set(parse_cpulist(root.joinpath('cpu', 'online').read_text()))
+        except (OSError, ValueError):
+            online = set(range(os.cpu_count() or 1))
+
+        core_of = {}
+        for cpu in online:
+            try:
+                core_of[cpu] = min(parse_cpulist(
+                    root.joinpath('cpu', f"cpu{cpu}", 'topology', 'thread_siblings_list').read_text()))
+            except (OSError, ValueError):
+                core_of[cpu] = cpu
+
+        nodes = {}
+        for path in root.glob('node/node[0-9]*'):
+            try:
+                cpus = set(parse_cpulist(path.joinpath('cpulist').read_text())) & online
+            except (OSError, ValueError):
+                continue
+            if cpus:
+                nodes[int(path.name[4:])] = sorted(cpus, key=lambda cpu: (core_of[cpu], cpu))
+        # Kernels without NUMA support have no node directories
+        if not nodes:
+            nodes = {0: sorted(online, key=lambda cpu: (core_of[cpu], cpu))}
+        return cls(nodes)
+
+    def cpus(self):
+        return sorted(self.node_of)
+
+
+class Placement:
+    """Assigns non-overlapping CPU and memory node slices to SSP containers of all users of the host.
+
+    CPUs given to running containers are known from their labels. Policies:
+
+    * `packed` puts the container on the NUMA node with the fewest free CPUs which still fits it,
+      keeping whole nodes free for larger containers,
+    * `spread` puts it on the node with the most free CPUs, spreading containers over the nodes,
+    * `reserved` places like `packed`, but refuses to start the container when not enough
+      CPUs are free, instead of starting it without a cpuset.
+    """
+    LOCK_PATH = pathlib.Path('/tmp/ssp-placement.lock')
+    # Seconds to wait for the lock before placing without it
+    LOCK_TIMEOUT = 30.0
+    # Seconds a created container keeps its CPUs before it is started, `ssp run` without -X starts it after the lock
+    START_GRACE = 60.0
+
+    def __init__(self, client, topology=None):
+        self.client = client
+        self.topology = topology or Topology.from_sysfs()
+
+    @api_errors
+    def containers(self):
+        """Running containers of all users with their CPUs, and containers created recently which did not start yet."""
+        allocations = []
+        for container in self.client.containers.list(all=True, filters={'label': config.SSP_USER_LABEL}):
+            if container.status != 'running' and not (container.status == 'created' and self._starting(container)):
+                continue
+            cpuset = container.labels.get(config.SSP_CPUSET_LABEL)
+            allocations.append((container, parse_cpulist(cpuset) if cpuset else []))
+        return allocations
+
+    def used(self):
+        return {cpu for _, cpus in self.containers() for cpu in cpus}
+
+    def assign(self, cores, policy, used=None):
+        """Choose CPUs and memory nodes for a new container.
+
+        :param cores: Number of CPUs of the container.
+        :type cores: int
+        :param policy: One of `SSPConfig.PLACEMENT_POLICIES`.
+        :type policy: str
+        :param used: CPUs of running containers, looked up if not given.
+        :type used: set
+        :return: CPUs and NUMA nodes, or None when not enough CPUs are free.
+        :rtype: ([int], [int])
+        """
+        used = self.used() if used is None else used
+        free = {node: [cpu for cpu in cpus if cpu not in used] for node, cpus in self.topology.nodes.items()}
+        fitting = [node for node, cpus in free.items() if len(cpus) >= cores]
+        if fitting:
+            if policy == 'spread':
+                node = max(fitting, key=lambda node: (len(free[node]), -node))
+            else:
+                node = min(fitting, key=lambda node: (len(free[node]), node))
+            chosen = free[node][:cores]
+        elif sum(len(cpus) for cpus in free.values()) >= cores:
+            # Spans as few nodes as possible
+            chosen = []
+            for node in sorted(free, key=lambda node: (-len(free[node]), node)):
+                chosen += free[node][:cores - len(chosen)]
+                if len(chosen) == cores:
+                    break
+        else:
+            return None
+        return sorted(chosen), sorted({self.topology.node_of[cpu] for cpu in chosen})
+
+    @classmethod
+    def lock(cls, timeout=LOCK_TIMEOUT):
+        """Exclusive lock of all ssp processes of the host, held from the choice of CPUs until the container is created.
+
+        The lock file is shared with the `docker` group only, its members can use Docker anyway. A lock which
+        cannot be opened or is held for longer than `timeout` seconds, e.g. by a stuck process, is not waited for.
+
+        :return: Open lock file, closing it releases the lock, or None when placing without the lock.
+        """
+        try:
+            group, mode = grp.getgrnam('docker').gr_gid, 0o660
+        except KeyError:
+            group, mode = -1, 0o666
+        try:
+            descriptor = os.open(str(cls.LOCK_PATH), os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, mode)
+        except OSError as error:
+            logging.warning("Unable to open placement lock %s, placing without it: %s" % (cls.LOCK_PATH, error))
+            return None
+        try:
+            # Other users have to be able to lock the file as well, umask may remove the permission
+            os.fchown(descriptor, -1, group)
+            os.fchmod(descriptor, mode)
+        except OSError:
+            pass
+        lock_file = os.fdopen(descriptor, 'r+')
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    lock_file.close()
+                    logging.warning("Placement lock %s is held for more than %d s, placing without it" %
+                                    (cls.LOCK_PATH, timeout))
+                    return None
+                time.sleep(0.05)
+
+    @classmethod
+    def _starting(cls, container):
+        # Created is RFC 3339 with nanoseconds, e.g. 2024-05-02T10:11:12.123456789Z
+        try:
+            created = datetime.datetime.strptime(container.attrs['Created'][:19], '%Y-%m-%dT%H:%M:%S').replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return False
+        return time.time() - created < cls.START_GRACE
+
+    @api_errors
+    def check_host(self):
+        """Warn when Docker runs on another machine than ssp, the topology of this host does not apply then."""
+        ncpu = self.client.info().get('NCPU')
+        if ncpu and ncpu != len(self.topology.node_of):
+            logging.warning("Docker Engine reports %d CPUs, this host has %d. CPU placement may not match the Docker host."
+                            % (ncpu, len(self.topology.node_of)))
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+from ssp.engine import api_errors
+from ssp.exceptions import Exceptions
+
+
+class SSHReadiness:
+    """Waits until sshd in a container accepts connections.
+
+    The container state is checked through the Docker SDK and its ssh port is polled
+    with exponential backoff, until sshd answers with its protocol banner.
+    """
+
+    def __init__(self, container, port=22, timeout=30.0, initial_delay=0.05, max_delay=1.0):
+        self.container = container
+        self.port = port
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.probes = 0
+
+    def wait(self):
+        """Block until sshd is ready.
+
+        :return: Seconds spent waiting.
+        :rtype: float
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._wait(loop))
+        finally:
+            loop.close()
+
+    async def _wait(self, loop):
+        started = time.monotonic()
+        delay = self.initial_delay
+        while True:
+            # Docker SDK is blocking, do not stall the event loop with it
+            status = await loop.run_in_executor(None, self._status)
+            if status != 'running':
+                raise Exceptions.DockerException(
+                    "Container %s is %s, sshd did not start" % (self.container.short_id, status))
+
+            address = self.container.attrs['NetworkSettings']['IPAddress']
+            remaining = self.timeout - (time.monotonic() - started)
+            if address and await self._probe(address, min(max(remaining, 0.0), self.max_delay)):
+                return time.monotonic() - started
+
+            if time.monotonic() - started + delay > self.timeout:
+                raise Exceptions.DockerException(
+                    "sshd in container %s is not ready after %d s" % (self.container.short_id, self.timeout))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    @api_errors
+    def _status(self):
+        import docker
+
+        try:
+            self.container.reload()
+        except docker.errors.NotFound:
+            # Container started with auto_remove is removed as soon as it exits
+            return 'exited'
+        return self.container.status
+
+    async def _probe(self, address, timeout):
+        self.probes += 1
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, self.port), timeout)
+            # Port may be bound before sshd is able to serve, wait for its banner
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+            return banner.startswith(b'SSH-')
+        except (OSError, asyncio.TimeoutError) as error:
+            logging.debug("Probe %d of %s:%d failed: %s" %
+                          (self.probes, address, self.port, error or type(error).__name__))
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
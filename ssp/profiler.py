@@ -0,0 +1,142 @@
+import contextlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from ssp import config
+
+# Ids of containers, images and execs in Docker Engine API paths
+API_ID = re.compile(r'/(containers|images|exec|volumes)/(?!json$|create$|prune$)[^/]+')
+API_VERSION = re.compile(r'^/v[0-9.]+/')
+# History is trimmed to the most recent half when it grows over this size
+HISTORY_LIMIT = 1024 * 1024
+
+
+class Profiler:
+    """Timeline of one ssp command: its phases, Docker Engine API calls, registry requests and subprocesses.
+
+    Spans are recorded by :func:`span` while a profiler is started and exported as a Chrome trace,
+    which chrome://tracing and https://ui.perfetto.dev open. A summary of every profiled command is
+    appended to the history file, one JSON object per line.
+    """
+    _current = None
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.spans = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, command):
+        """Start profiling of the command, spans of the whole process are recorded from now on."""
+        cls._current = cls(command)
+        return cls._current
+
+    @classmethod
+    def current(cls):
+        return cls._current
+
+    def stop(self, status='ok'):
+        self.duration = time.perf_counter() - self.origin
+        self.status = status
+        if Profiler._current is self:
+            Profiler._current = None
+
+    def record(self, name, category, start, duration, args=None):
+        """Record span which started at `start` of `time.perf_counter` and took `duration` seconds."""
+        with self._lock:
+            thread = self._threads.setdefault(threading.get_ident(), len(self._threads) + 1)
+            self.spans.append((name, category, start - self.origin, duration, thread, args or {}))
+
+    def trace(self):
+        """Recorded spans in the Chrome trace event format.
+
+        :rtype: dict
+        """
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'ssp ' + self.command}}]
+        events.append({'name': 'ssp ' + self.command, 'cat': 'command', 'ph': 'X', 'pid': pid, 'tid': 1, 'ts': 0,
+                       'dur': round((self.duration or 0.0) * 1e6), 'args': {'status': self.status}})
+        for name, category, start, duration, thread, args in self.spans:
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+                           'ts': round(start * 1e6), 'dur': round(duration * 1e6), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'command': 'ssp ' + self.command, 'started': self.started}}
+
+    def summary(self):
+        """Seconds spent by phases, number and seconds of API calls and subprocesses.
+
+        :rtype: dict
+        """
+        summary = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                   'host': socket.gethostname(), 'docker_host': config.SSP_DOCKER_HOST,
+                   'command': self.command, 'status': self.status, 'seconds': round(self.duration or 0.0, 3),
+                   'phases': {}}
+        for name, category, _, duration, _, _ in self.spans:
+            if category == 'phase':
+                summary['phases'][name] = round(summary['phases'].get(name, 0.0) + duration, 3)
+                continue
+            calls, seconds = summary.get(category, {}).get('calls', 0), summary.get(category, {}).get('seconds', 0.0)
+            summary[category] = {'calls': calls + 1, 'seconds': round(seconds + duration, 3)}
+        return summary
+
+    def write_trace(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.trace(), fp)
+
+    def append_history(self, path=None):
+        """Append summary of the command to the history file, `SSP_STATE_PATH/profile.jsonl` by default."""
+        path = path or config.SSP_PROFILE_HISTORY
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open('a') as fp:
+                fp.write(json.dumps(self.summary()) + '\n')
+            if path.stat().st_size > HISTORY_LIMIT:
+                lines = path.read_text().splitlines(True)
+                path.write_text(''.join(lines[len(lines) // 2:]))
+        except OSError as error:
+            # History must never fail the command itself
+            logging.debug("Unable to write profile history %s: %s" % (path, error))
+
+
+@contextlib.contextmanager
+def span(name, category='phase', **args):
+    """Time the block as a span of the current profiler, does nothing when no profiler is started.
+
+    :param name: Name of the span, e.g. `build image`.
+    :param category: `phase` of ssp, `docker` API call, `registry` request or `subprocess`.
+    :param args: Details shown with the span in the trace.
+    """
+    profiler = Profiler.current()
+    if profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as error:
+        args['error'] = type(error).__name__
+        raise
+    finally:
+        profiler.record(name, category, start, time.perf_counter() - start, args)
+
+
+def docker_response(response, *args, **kwargs):
+    """Response hook of the Docker SDK session, records the API call up to its response headers."""
+    profiler = Profiler.current()
+    if profiler is None:
+        return
+    request = response.request
+    path = API_VERSION.sub('/', request.path_url.split('?', 1)[0])
+    seconds = response.elapsed.total_seconds()
+    profiler.record('%s %s' % (request.method, API_ID.sub(r'/\1/{id}', path)), 'docker',
+                    time.perf_counter() - seconds, seconds, {'path': path, 'status': response.status_code})
@@ -0,0 +1,222 @@
+import base64
+import binascii
+import concurrent.futures
+import json
+import logging
+import pathlib
+import re
+import socket
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from ssp import profiler
+from ssp.exceptions import Exceptions
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    # Blobs are often redirected to a storage server, registry token must not be sent there
+    def redirect_request(self, request, fp, code, msg, headers, new_url):
+        redirected = super().redirect_request(request, fp, code, msg, headers, new_url)
+        if redirected is not None and urllib.parse.urlsplit(new_url).netloc != urllib.parse.urlsplit(request.full_url).netloc:
+            redirected.remove_header('Authorization')
+        return redirected
+
+
+class Registry:
+    """Minimal client of Docker Registry HTTP API V2.
+
+    Registry is given as `host[:port]`, which is accessed over https, or with explicit
+    `http://` or `https://` scheme, e.g. for a local registry.
+    """
+    MANIFEST_TYPES = [
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.oci.image.index.v1+json',
+        'application/vnd.oci.image.manifest.v1+json',
+    ]
+
+    def __init__(self, url, timeout=10.0):
+        if '://' not in url:
+            url = 'https://' + url
+        parsed = urllib.parse.urlsplit(url)
+        self.base_url = f"{parsed.scheme}://{parsed.netloc}"
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self._tokens = {}
+        self._opener = urllib.request.build_opener(_RedirectHandler)
+
+    @classmethod
+    def rank(cls, registries, repositories, tag):
+        """Probe registries concurrently and order them from the fastest one.
+
+        :param registries: Registries to probe, by name.
+        :type registries: {str: Registry}
+        :param repositories: Repository of the image in each registry, by name.
+        :type repositories: {str: str}
+        :return: Names of reachable registries, the fastest first.
+        :rtype: [str]
+        """
+        def measure(name):
+            try:
+                return name, registries[name].probe(repositories[name], tag)
+            except Exceptions.DockerException as error:
+                logging.info("Registry %s is not available: %s" % (name, error))
+                return name, None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(registries), 1)) as executor:
+            results = dict(executor.map(measure, registries))
+
+        for name, result in results.items():
+            if result is not None:
+                connect_time, throughput = result
+                logging.info("Registry %s: connect %.0f ms, throughput %s" % (
+                    name, connect_time * 1000, "%.1f MiB/s" % (throughput / 2**20) if throughput else "unknown"))
+
+        reachable = [name for name, result in results.items() if result is not None]
+        # Registries with measured throughput go first, then by connect time
+        return sorted(reachable, key=lambda name: (results[name][1] is None, -(results[name][1] or 0), results[name][0]))
+
+    def reference(self, repository, tag):
+        """Image reference as used by Docker, e.g. `host/repository:tag`."""
+        return f"{self.host}/{repository.strip('/')}:{tag}"
+
+    def manifest_digest(self, repository, tag):
+        """Digest of the image manifest the tag points to, without downloading the manifest.
+
+        :return: Digest, e.g. `sha256:...`.
+        :rtype: str
+        """
+        response = self.request('HEAD', f"/v2/{repository.strip('/')}/manifests/{tag}",
+                                {'Accept': ', '.join(self.MANIFEST_TYPES)})
+        digest = response.headers.get('Docker-Content-Digest')
+        if not digest:
+            raise Exceptions.DockerException(
+                "Registry %s did not return digest of %s:%s" % (self.host, repository, tag))
+        return digest
+
+    def probe(self, repository, tag, sample_size=256 * 1024):
+        """Measure how fast the registry is for the image.
+
+        :return: Seconds to open TCP connection and bytes per second of a sample of the first
+            image layer, or None when the sample cannot be fetched.
+        :rtype: (float, float)
+        """
+        parsed = urllib.parse.urlsplit(self.base_url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        started = time.monotonic()
+        try:
+            socket.create_connection(
+                (parsed.hostname, port), timeout=self.timeout).close()
+        except OSError as error:
+            raise Exceptions.DockerException(
+                "Unable to reach registry %s: %s" % (self.host, error)) from error
+        connect_time = time.monotonic() - started
+
+        try:
+            layer = self._first_layer(repository, tag)
+            started = time.monotonic()
+            with self.request('GET', f"/v2/{repository.strip('/')}/blobs/{layer}",
+                              {'Range': f"bytes=0-{sample_size - 1}"}) as response:
+                received = len(response.read(sample_size))
+            throughput = received / max(time.monotonic() - started, 1e-6)
+        except (Exceptions.DockerException, OSError, ValueError, KeyError, IndexError) as error:
+            logging.debug("Unable to sample throughput of %s: %s" % (self.host, error))
+            throughput = None
+        return connect_time, throughput
+
+    def _first_layer(self, repository, tag):
+        manifest = self._manifest(repository, tag)
+        if 'manifests' in manifest:
+            # Manifest list, prefer linux/amd64 image
+            platforms = sorted(manifest['manifests'], key=lambda entry: entry.get(
+                'platform', {}).get('architecture') != 'amd64')
+            manifest = self._manifest(repository, platforms[0]['digest'])
+        return manifest['layers'][0]['digest']
+
+    def _manifest(self, repository, reference):
+        with self.request('GET', f"/v2/{repository.strip('/')}/manifests/{reference}",
+                          {'Accept': ', '.join(self.MANIFEST_TYPES)}) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def request(self, method, path, headers=None):
+        """Send request to the registry, authenticating with a bearer token when required."""
+        scope = self._scope(path)
+        headers = dict(headers or {})
+        if scope in self._tokens:
+            headers['Authorization'] = 'Bearer ' + self._tokens[scope]
+        try:
+            return self._open(method, path, headers)
+        except urllib.error.HTTPError as error:
+            challenge = error.headers.get('WWW-Authenticate', '')
+            if error.code != 401 or not challenge.lower().startswith('bearer') or scope in self._tokens:
+                raise Exceptions.DockerException(
+                    "Registry %s returned %d for %s" % (self.host, error.code, path)) from error
+
+        self._tokens[scope] = self._token(challenge, scope)
+        headers['Authorization'] = 'Bearer ' + self._tokens[scope]
+        try:
+            return self._open(method, path, headers)
+        except urllib.error.HTTPError as error:
+            raise Exceptions.DockerException(
+                "Registry %s returned %d for %s" % (self.host, error.code, path)) from error
+
+    def _open(self, method, path, headers):
+        request = urllib.request.Request(
+            self.base_url + path, headers=headers, method=method)
+        try:
+            with profiler.span('%s %s' % (method, self.host), 'registry', path=path):
+                return self._opener.open(request, timeout=self.timeout)
+        except urllib.error.HTTPError:
+            raise
+        except (urllib.error.URLError, OSError) as error:
+            raise Exceptions.DockerException(
+                "Unable to reach registry %s: %s" % (self.host, error)) from error
+
+    def _token(self, challenge, scope):
+        # Challenge looks like: Bearer realm="https://auth/token",service="registry",scope="repository:x:pull"
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        if not params.get('realm'):
+            raise Exceptions.DockerException(
+                "Registry %s did not name its token service: %s" % (self.host, challenge))
+        query = {'service': params.get('service', ''),
+                 'scope': params.get('scope', scope)}
+        headers = {}
+        credentials = self._credentials()
+        if credentials:
+            headers['Authorization'] = 'Basic ' + credentials
+        logging.debug("Requesting registry token from %s" % params['realm'])
+        request = urllib.request.Request(
+            params['realm'] + '?' + urllib.parse.urlencode(query), headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = json.loads(response.read().decode('utf-8'))
+        except (urllib.error.URLError, OSError, ValueError) as error:
+            raise Exceptions.DockerException(
+                "Unable to authenticate to registry %s: %s" % (self.host, error)) from error
+        return body.get('token') or body.get('access_token', '')
+
+    def _credentials(self):
+        # Reuse credentials stored by `docker login`, if there are any
+        docker_config = pathlib.Path.home().joinpath('.docker', 'config.json')
+        try:
+            auths = json.loads(docker_config.read_text()).get('auths', {})
+        except (OSError, ValueError):
+            return None
+        for host in (self.host, self.base_url):
+            auth = auths.get(host, {}).get('auth')
+            if auth:
+                # Validate it is base64 encoded user:password before sending it
+                try:
+                    base64.b64decode(auth, validate=True)
+                except binascii.Error:
+                    logging.debug("Ignoring malformed credentials of %s in %s" % (host, docker_config))
+                    return None
+                return auth
+        return None
+
+    @classmethod
+    def _scope(cls, path):
+        match = re.match(r'/v2/(.+)/(manifests|blobs)/', path)
+        return f"repository:{match.group(1)}:pull" if match else ''
@@ -1,22 +1,24 @@
+import concurrent.futures
+import glob
+import hashlib
 import logging
 import pathlib
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
-import docker
 import getpass
-import yaml
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
 from collections import OrderedDict
 
-from ssp import generators, config
+from ssp import agent, caches, collector, display, generators, config, containers, context, placement, profiler
+from ssp.engine import Engine
 from ssp.exceptions import Exceptions
+from ssp.model import PlacementRecord, ResourcesRecord, SSPConfig
+from ssp.registry import Registry
 
 
 class SSP_Launcher:
@@ -32,39 +34,161 @@ class SSP_Launcher:
             raise Exceptions.ConfigurationError(
                 f"Invalid path to config: {self.config_path}. If it does not exists, try `ssp generate`")
 
-        if self.config_path.exists():
-            with open(self.config_path) as fp:
-                self.config = yaml.load(fp, Loader=Loader)
-
         self.current_user = getpass.getuser()
         self.cwd = pathlib.Path().cwd()
         self.shell = None
 
-        self.registry_url = "ssp-docker-registry.codasip.com"
-        self.registry_url_cn = "ssp-docker-registry-cn.codasip.com:5443"
+        # Relative CPU weight of builds, lowered by `ssp agent`
+        self.cpu_shares = None
+        # Images built by this process, `gc` after the builds keeps them
+        self.built_images = set()
+        self.reload()
+
+    def reload(self):
+        """Load ssp.yaml again and reset all settings taken from it, dropping overrides of the `set_*` methods."""
+        # Configuration is validated here, before any Docker work starts
+        self.config = None
+        if self.config_path.exists():
+            with profiler.span('load config'):
+                self.config = SSPConfig.load(self.config_path)
+
+        self.registries = dict(config.SSP_REGISTRIES)
+        if self.config is not None:
+            self.registries.update(self.config.registries)
+
+        self.buildkit = bool(self.config and self.config.buildkit)
+        self.cache_from = None
+        self.cache_to = None
+        self.resources = self.config.resources if self.config is not None else ResourcesRecord()
+        self.placement = self.config.placement if self.config is not None else PlacementRecord()
+        # How `ssp run -X` forwards X11, ssh or the X server socket of the host
+        self.display = self.config.display if self.config is not None else 'ssh'
+        self.display_ipc = bool(self.config and self.config.display_ipc)
+
+    def set_build_cache(self, buildkit=False, cache_from=None, cache_to=None):
+        """Build images with BuildKit, importing and exporting build cache. Cache implies BuildKit.
+
+        :param cache_from: Directory or registry reference to import build cache from.
+        :type cache_from: str
+        :param cache_to: Directory or registry reference to export build cache to.
+        :type cache_to: str
+        """
+        self.buildkit = self.buildkit or buildkit or bool(cache_from or cache_to)
+        self.cache_from = cache_from
+        self.cache_to = cache_to
+
+    def set_resources(self, scratch=None, scratch_size=None, shm_size=None, cpus=None, memory=None, ulimits=()):
+        """Override `resources` of ssp.yaml for containers started by this launcher.
+
+        :param ulimits: Limits like `nofile=1024:65536`.
+        :type ulimits: [str]
+        """
+        limits = {}
+        for ulimit in ulimits:
+            name, separator, value = ulimit.partition('=')
+            if not separator or not name:
+                raise Exceptions.ConfigurationError(
+                    "Invalid ulimit %s, expected name=value, e.g. nofile=1024:65536" % ulimit)
+            limits[name] = value
+        try:
+            overrides = SSPConfig.parse_resources(scratch, scratch_size, shm_size, cpus, memory, limits)
+        except ValueError as error:
+            raise Exceptions.ConfigurationError("Invalid resources: %s" % error)
+        # Size alone keeps the scratch target of ssp.yaml
+        self.resources = self.resources.replace(scratch=scratch, **{name: getattr(overrides, name) for name in (
+            'scratch_size', 'shm_size', 'cpus', 'memory', 'ulimits')})
+
+    def set_placement(self, policy=None, cores=None):
+        """Override `placement` of ssp.yaml for containers started by this launcher. Call after :meth:`set_resources`."""
+        if policy is None and cores is None:
+            return
+        policy = policy or self.placement.policy
+        if policy is None:
+            raise Exceptions.ConfigurationError(
+                "Number of cores needs a placement policy, e.g. --placement packed")
+        try:
+            self.placement = SSPConfig.parse_placement(policy, cores or self.placement.cores, self.resources)
+        except ValueError as error:
+            raise Exceptions.ConfigurationError("Invalid placement: %s" % error)
+
+    def set_display(self, display=None, share_ipc=False):
+        """Override `display` and `display_ipc` of ssp.yaml.
+
+        :param display: `ssh` forwards X11 by `ssh -X`, `local` shares the X server socket of the host.
+        :type display: str
+        :param share_ipc: Share IPC namespace of the host for MIT-SHM of the local display.
+        :type share_ipc: bool
+        """
+        self.display = display or self.display
+        self.display_ipc = share_ipc or self.display_ipc
 
     @Exceptions.test_wrapper
-    def download(self, version, region):
+    def download(self, version, region, check=False, failover=False, stall_timeout=config.SSP_PULL_STALL_TIMEOUT,
+                 distribution='free'):
         # Chineese users cannot download from EU server, therefore this option.
-
+        # With region `auto` the fastest registry is selected.
         logging.debug("%s" % region)
 
-        # As of 2020, Codasip has two docker registries - one in Europe and one in China.
-        # Also there is furture possibility for more than one publicly avialable distribution.
-        distributions = {'eu': {
-            'free': '/free/distrib-ssp-seh1-free'
-        }, 'cn': {
-            'free': '/distrib-ssp-seh1-free'
-        }}
-        # Choose distribution (now only free is avail) and region.
-        distribution = distributions['cn']['free'] if region == 'CN' else distributions['eu']['free']
-        registry_url = self.registry_url_cn if region == 'CN' else self.registry_url
+        if region == 'auto':
+            candidates = [name for name in self.registries
+                          if distribution in self.registries[name]['distributions']]
+            registries = {name: Registry(self.registries[name]['url']) for name in candidates}
+            repositories = {name: self.registries[name]['distributions'][distribution] for name in candidates}
+            with profiler.span('rank registries'):
+                candidates = Registry.rank(registries, repositories, version)
+            if not candidates:
+                raise Exceptions.DockerException(
+                    "None of the configured registries is reachable")
+            logging.info("Selected registry %s" % candidates[0])
+        elif region in self.registries:
+            candidates = [region]
+        else:
+            raise Exceptions.ConfigurationError(
+                "Unknown region %s, choose one of: %s" % (region, ', '.join(list(self.registries) + ['auto'])))
+
+        for index, name in enumerate(candidates):
+            last = index == len(candidates) - 1
+            try:
+                return self._download(self.registries[name], distribution, version, check,
+                                      stall_timeout if failover and not last else None)
+            except Exceptions.DockerException as error:
+                if not failover or last:
+                    raise
+                logging.warning("Download from %s failed: %s. Failing over to %s" %
+                                (name, error, candidates[index + 1]))
+
+    def _download(self, registry_config, distribution, version, check, stall_timeout):
         # Get full url to download docker image from.
-        image_url = registry_url + distribution + ":" + version
-        # Pull docker image using subprocess rather than docker module.
-        if subprocess.run(['docker', 'pull', image_url]).returncode != 0:
-            raise Exceptions.DockerException(
-                "Could not pull specified docker image")
+        registry = Registry(registry_config['url'])
+        distribution = registry_config['distributions'][distribution]
+        image_url = registry.reference(distribution, version)
+
+        # Compare digest of the tag in registry with the local image before pulling it
+        try:
+            with profiler.span('check registry', registry=registry.host):
+                remote_digest = registry.manifest_digest(distribution, version)
+        except Exceptions.DockerException as error:
+            if check:
+                raise
+            logging.warning("Unable to check for update, pulling: %s" % error)
+            remote_digest = None
+        up_to_date = remote_digest is not None and any(
+            repo_digest.endswith('@' + remote_digest) for repo_digest in Engine.repo_digests(image_url))
+        logging.debug("Registry digest of %s: %s" % (image_url, remote_digest))
+
+        if check:
+            if up_to_date:
+                logging.info("Docker image %s is up to date" % image_url)
+            else:
+                logging.info("Update of docker image %s is available" % image_url)
+            return up_to_date
+        if up_to_date:
+            logging.info("Docker image %s is up to date, skipping pull" % image_url)
+            return
+
+        image_repository, _ = image_url.rsplit(':', 1)
+        with profiler.span('pull image', image=image_url):
+            Engine.pull(image_repository, version, stall_timeout)
         logging.info("Successfuly downloaded docker image: %s" % image_url)
 
     @Exceptions.test_wrapper
@@ -100,21 +224,21 @@ class SSP_Launcher:
         yaml_name = output
 
         logging.info("Creating yaml file in: %s" % yaml_path)
-        yamlgen = generators.Yamlgen(yaml_name, yaml_path)
-        yamlgen.generate_yamlfile(ssp_yaml)
+        with profiler.span('write ssp.yaml'):
+            generators.Yamlgen(yaml_name, yaml_path).generate_yamlfile(ssp_yaml)
         logging.info("Finished generating yaml to: %s" % yaml_path)
 
         return yaml_path, yaml_name
 
     @Exceptions.test_wrapper
-    def run(self, sshx, dry_run, skip_config):
-        if self.current_user not in self._list_usernames():
+    def run(self, sshx, dry_run, skip_config, rebuild=False, reuse=False, idle_timeout=config.SSP_IDLE_TIMEOUT):
+        if self.current_user not in self.config.users_by_name:
             raise Exceptions.SSPSetupError(
                 "Current user is not in ssp.yaml. Create entry and try again")
 
         # Generate docker file
         logging.info("Starting SSP run process")
-        dockergen = generators.Dockergen(self.config, self.current_user)
+        dockergen = generators.Dockergen(self.config, self.current_user, self.buildkit)
 
         ssp_dockerfile_path = config.SSP_DOCKERFILE_PATH
         if dry_run:
@@ -122,18 +246,200 @@ class SSP_Launcher:
             os.environ["SSP_DOCKERFILE_PATH"] = str(self.cwd)
             logging.info("Set env variable 'SSP_DOCKERFILE_PATH' to %s" %
                          ssp_dockerfile_path)
+        else:
+            # Do not start a second build of what `ssp agent` is building right now, nor change its context
+            with profiler.span('wait for agent'):
+                agent.AgentClient().wait_for_build(self.config_path)
 
         run_uid, run_gid = self._get_uid_gid()
-        dockergen.generate_dockerfile(
-            ssp_dockerfile_path, skip_config, run_uid, run_gid)
+        ssp_dockerfile_path = pathlib.Path(ssp_dockerfile_path)
+        # Files from copyfiles are only staged for dry run, otherwise they are streamed to docker
+        with profiler.span('generate dockerfile'):
+            dockergen.generate_dockerfile(
+                ssp_dockerfile_path, skip_config, run_uid, run_gid, stage_copyfiles=dry_run)
         if dry_run:
             logging.info("Generated dockerfile to: %s. Exiting" %
                          ssp_dockerfile_path)
             return
         else:
-            self.run_start(sshx)
+            digest = self._context_digest(dockergen, ssp_dockerfile_path, rebuild)
+            self.run_start(sshx, digest, rebuild,
+                           dockergen.context_files(ssp_dockerfile_path), reuse, idle_timeout)
+
+    @Exceptions.test_wrapper
+    def build(self, skip_config, rebuild=False, where=None):
+        """Generate Dockerfile and build the customized image, without starting a container.
+
+        :param where: Directory of the generated build context, `SSP_DOCKERFILE_PATH` by default.
+        :type where: pathlib.Path
+        :return: Name of the image.
+        :rtype: str
+        """
+        if self.current_user not in self.config.users_by_name:
+            raise Exceptions.SSPSetupError(
+                "Current user is not in ssp.yaml. Create entry and try again")
+
+        logging.info("Starting SSP build process")
+        dockergen = generators.Dockergen(self.config, self.current_user, self.buildkit)
+        ssp_dockerfile_path = where or pathlib.Path(config.SSP_DOCKERFILE_PATH)
+        run_uid, run_gid = self._get_uid_gid()
+        dockergen.generate_dockerfile(
+            ssp_dockerfile_path, skip_config, run_uid, run_gid, stage_copyfiles=False)
+
+        image = self.config.user_image(self.current_user)
+        digest = self._context_digest(dockergen, ssp_dockerfile_path, rebuild)
+        self._ensure_image(image, digest, rebuild, dockergen.context_files(ssp_dockerfile_path))
+        self._collect_after_build()
+        return image
+
+    @Exceptions.test_wrapper
+    def build_matrix(self, config_paths, skip_config=False, rebuild=False, workers=4, log_dir=None):
+        """Build customized images of many ssp.yaml files concurrently.
+
+        Contexts of all configurations are generated first. Images with identical build context
+        are built only once and tagged with all their names. Shared base images are built
+        before the images on top of them.
+
+        :param config_paths: ssp.yaml files, see :meth:`matrix_configs`.
+        :type config_paths: [pathlib.Path]
+        :param workers: Maximal number of concurrent builds.
+        :type workers: int
+        :param log_dir: Directory for build output, one file per image.
+        :type log_dir: pathlib.Path
+        :return: Result of each configuration with keys config, image, state, seconds, size, log and error.
+        :rtype: [dict]
+        """
+        matrix_path = pathlib.Path(config.SSP_DOCKERFILE_PATH, 'matrix')
+        log_dir = pathlib.Path(log_dir) if log_dir else matrix_path / 'logs'
+        log_dir.mkdir(parents=True, exist_ok=True)
+
+        results = []
+        # Build contexts by digest, every one with the images built from it
+        bases = OrderedDict()
+        images = OrderedDict()
+        from_image_ids = {}
+        for config_path in config_paths:
+            result = {'config': config_path, 'image': None, 'state': 'failed', 'seconds': 0.0,
+                      'size': None, 'log': None, 'error': None}
+            results.append(result)
+            try:
+                ssp_config = SSPConfig.load(config_path)
+                user = ssp_config.users_by_name.get(self.current_user)
+                if user is None:
+                    raise Exceptions.SSPSetupError(
+                        "Current user is not in %s" % config_path)
+                where = matrix_path / ('%s-%s' % (config_path.stem, hashlib.sha1(
+                    str(config_path.resolve()).encode('utf-8')).hexdigest()[:8]))
+                dockergen = generators.Dockergen(ssp_config, self.current_user, self.buildkit)
+                dockergen.generate_dockerfile(
+                    where, skip_config, user.uid, user.gid, stage_copyfiles=False)
+
+                if ssp_config.from_image not in from_image_ids:
+                    from_image_ids[ssp_config.from_image] = Engine.image_id(ssp_config.from_image)
+                from_image_id = from_image_ids[ssp_config.from_image]
+                if ssp_config.shared_base:
+                    files = dockergen.base_context_files(where)
+                    from_image_id = dockergen.context_digest(where, from_image_id, files)
+                    bases.setdefault(from_image_id, []).append((ssp_config.base_image, files, None))
+                digest = dockergen.context_digest(where, from_image_id)
+            except (Exceptions.ConfigurationError, Exceptions.SSPSetupError) as error:
+                logging.error("Skipping %s: %s" % (config_path, error))
+                result['error'] = str(error)
+                continue
+
+            result['image'] = ssp_config.user_image(self.current_user)
+            images.setdefault(digest, []).append((result['image'], dockergen.context_files(where), result))
+
+        logging.info("%d configurations, %d distinct images to build" % (len(results), len(images)))
+        for builds in (bases, images):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                list(executor.map(lambda digest: self._build_matrix_image(
+                    digest, builds[digest], rebuild, log_dir), builds))
+        self._collect_after_build()
+        return results
+
+    @classmethod
+    def matrix_configs(cls, pattern):
+        """Find ssp.yaml files for :meth:`build_matrix`, in a directory or by a glob pattern."""
+        path = pathlib.Path(pattern).expanduser()
+        if path.is_dir():
+            paths = list(path.glob('*.yaml')) + list(path.glob('*.yml'))
+        else:
+            paths = [pathlib.Path(match) for match in glob.glob(str(path))]
+        return sorted(paths)
+
+    def _build_matrix_image(self, digest, entries, rebuild, log_dir):
+        # Build the context once and tag the image with names of all configurations built from it
+        image, files, _ = entries[0]
+        log_path = log_dir / (re.sub(r'[^\w.-]', '_', image) + '.log')
+        started = time.monotonic()
+        error = None
+        size = None
+        try:
+            if not rebuild and self._tag_cached_image(digest, image):
+                state = 'cached'
+            else:
+                logging.info("Building %s, output in %s" % (image, log_path))
+                with log_path.open('w') as log:
+                    self._build_image(digest, files, image, output=log)
+                state = 'built'
+            for other, _, _ in entries[1:]:
+                self._tag_cached_image(digest, other)
+            size = Engine.image_size(image)
+        except Exceptions.DockerException as exception:
+            logging.error("Build of %s failed: %s" % (image, exception))
+            state = 'failed'
+            error = str(exception)
+
+        seconds = time.monotonic() - started
+        for index, (name, _, result) in enumerate(entries):
+            if result is not None:
+                result.update(state=state if index == 0 or state == 'failed' else 'same as ' + image,
+                              seconds=seconds, size=size, error=error,
+                              log=log_path if log_path.exists() else None)
+
+    def _context_digest(self, dockergen, where, rebuild):
+        from_image_id = Engine.image_id(self.config.from_image)
+        if self.config.shared_base:
+            # Per-user image is built on top of the shared base image, its build is a phase of its own
+            with profiler.span('shared base'):
+                from_image_id = self._prepare_base(dockergen, where, from_image_id, rebuild)
+        with profiler.span('context digest'):
+            return dockergen.context_digest(where, from_image_id)
+
+    def explain(self, skip_config):
+        """Report which layers of the image a change of ssp.yaml rebuilds.
+
+        The Dockerfile is rendered in memory and compared with the last generated one,
+        nothing is written or built.
+        """
+        if self.current_user not in self.config.users_by_name:
+            raise Exceptions.SSPSetupError(
+                "Current user is not in ssp.yaml. Create entry and try again")
 
-    def run_from_file(self, sshx):
+        dockergen = generators.Dockergen(self.config, self.current_user, self.buildkit)
+        ssp_dockerfile_path = pathlib.Path(config.SSP_DOCKERFILE_PATH)
+        previous_path = ssp_dockerfile_path / 'Dockerfile'
+        previous = previous_path.read_text() if previous_path.exists() else ''
+        if not previous:
+            logging.info("No Dockerfile generated in %s yet, whole image is built" %
+                         ssp_dockerfile_path)
+
+        run_uid, run_gid = self._get_uid_gid()
+        current = dockergen.render_dockerfile(skip_config, run_uid, run_gid)
+        if not self.config.shared_base:
+            return dockergen.explain(previous, current, dockergen.changed_sources(ssp_dockerfile_path))
+
+        previous_base_path = ssp_dockerfile_path / dockergen.BASE_DOCKERFILE
+        previous_base = previous_base_path.read_text() if previous_base_path.exists() else ''
+        report = ["Shared base image %s:" % self.config.base_image]
+        report += dockergen.explain(previous_base, dockergen.render_base(skip_config),
+                                    dockergen.changed_sources(ssp_dockerfile_path))
+        report += ["Image %s:" % self.config.user_image(self.current_user)]
+        report += dockergen.explain(previous, current)
+        return report
+
+    def run_from_file(self, sshx, rebuild=False, reuse=False, idle_timeout=config.SSP_IDLE_TIMEOUT):
         cwd = pathlib.Path.cwd()
         if not 'Dockerfile' in os.listdir(cwd):
             raise Exceptions.SSPSetupError(
@@ -147,37 +453,340 @@ class SSP_Launcher:
             except PermissionError:
                 raise Exceptions.DockerException(
                     "Unable to start docker from file. Unable to copy Dockerfile to temporary directory.")
-            self.run_start(sshx)
-
-    def run_start(self, sshx):
-        if self.current_user not in self._list_usernames():
+            digest = hashlib.sha256(pathlib.Path(
+                tmpdir, 'Dockerfile').read_bytes()).hexdigest()
+            self.run_start(sshx, digest, rebuild, reuse=reuse,
+                           idle_timeout=idle_timeout)
+
+    def run_start(self, sshx, digest=None, rebuild=False, context_files=None, reuse=False,
+                  idle_timeout=config.SSP_IDLE_TIMEOUT):
+        if self.current_user not in self.config.users_by_name:
             raise Exceptions.SSPSetupError(
                 "Current user is not in ssp.yaml. Create entry and try again.")
 
-        # Build docker image from new docker file
-        logging.info("Building Docker image")
-        subprocess.run(['docker', 'build', str(config.SSP_DOCKERFILE_PATH),
-                        '-t', self.config['new_image']], check=True)
-        logging.info("Docker image successfuly built")
+        image = self.config.user_image(self.current_user)
+        local_display = None
+        if sshx and self.display == 'local':
+            local_display = display.LocalDisplay(share_ipc=self.display_ipc)
+            reason = local_display.unavailable()
+            if reason:
+                logging.warning("Unable to share the local display, using ssh -X: %s" % reason)
+                local_display = None
+        options = self._container_options(digest, idle_timeout, local_display)
+        warm = containers.WarmContainers(Engine.client(), self.current_user) if reuse else None
+        container = None
+        if warm:
+            with profiler.span('find container'):
+                for stopped in warm.reap():
+                    logging.info("Stopped idle container %s" % stopped.short_id)
+                container = warm.find(image, digest, options['labels'].get(config.SSP_RESOURCES_LABEL))
+
+        if container is not None:
+            logging.info("Reusing running container %s" % container.short_id)
+        else:
+            self._ensure_image(image, digest, rebuild, context_files)
+            self._collect_after_build()
+        # Last use of the image, least recently used images are removed first by `ssp gc`
+        collector.ImageCollector(Engine.client()).touch(Engine.image_id(image))
 
         # Run newly built docker image
-        logging.info("Starting docker container")
-        if sshx:
+        if sshx and local_display is None:
             # If the X-server is needed, docker container has to be started in detached mode,
             # and connected to via ssh -x
-            # docker hash is needed to get docker IP. Also we only need first 12 chars from string.
-            docker_hash = subprocess.run(['docker', 'run', '-dt', '--rm',
-                                          '--privileged', '-p', '22', self.config['new_image']], stdout=subprocess.PIPE).stdout.decode('utf-8')[:12]
-            logging.debug(docker_hash)
+            if container is None:
+                container = self._start_container(image, options, True, tty=True, ports={'22/tcp': None})
+                logging.debug(container.id)
+                if warm:
+                    warm.start_watcher()
+            from ssp import probe
+
+            # sshd is started by the container CMD, do not race it
+            readiness = probe.SSHReadiness(container)
+            with profiler.span('wait for sshd'):
+                waited = readiness.wait()
+            logging.debug("sshd in container %s ready after %.2f s (%d probes)" %
+                          (container.short_id, waited, readiness.probes))
             # Get docker IP
-            client = docker.DockerClient()
-            docker_ip = client.containers.get(
-                docker_hash).attrs['NetworkSettings']['IPAddress']
-            subprocess.run(['ssh', '-X', f"{self.current_user}@{docker_ip}"])
+            docker_ip = container.attrs['NetworkSettings']['IPAddress']
+            self._attach(warm, container, ['ssh', '-X', f"{self.current_user}@{docker_ip}"])
+        elif warm:
+            # Keep the container running in background and attach to it via docker exec
+            if container is None:
+                container = self._start_container(image, options, True, tty=True)
+                warm.start_watcher()
+            self._attach(warm, container, [
+                         'docker', 'exec', '-it', container.id, '/bin/bash'])
         else:
             # If -x is not needed, connect the usual way.
-            subprocess.run(['docker', 'run', '-it', '--rm',
-                            '--privileged', self.config['new_image']])
+            # Container is created through the API, docker CLI only attaches the terminal to it.
+            container = self._start_container(image, options, False, tty=True, stdin_open=True)
+            with profiler.span('docker start', 'subprocess'):
+                subprocess.run(['docker', 'start', '-ai', container.id])
+
+    def _start_container(self, image, options, detached, **kwargs):
+        # Container is started in background when detached, otherwise only created
+        logging.info("Starting docker container")
+        start = Engine.run_detached if detached else Engine.create
+        with profiler.span('start container' if detached else 'create container'):
+            if not self.placement.policy:
+                return start(image, **options, **kwargs)
+            # CPUs are chosen and taken under one lock of the host, so concurrent runs do not choose the same CPUs
+            lock = placement.Placement.lock()
+            try:
+                return start(image, **dict(options, **self._cpuset_options(options['labels'])), **kwargs)
+            finally:
+                if lock is not None:
+                    lock.close()
+
+    def _cpuset_options(self, labels):
+        host = placement.Placement(Engine.client())
+        host.check_host()
+        used = host.used()
+        assigned = host.assign(self.placement.cores, self.placement.policy, used)
+        if assigned is None:
+            message = "Not enough free CPUs for %d cores, %d of %d CPUs are given to other SSP containers" % (
+                self.placement.cores, len(used), len(host.topology.node_of))
+            if self.placement.policy == 'reserved':
+                raise Exceptions.SSPSetupError(message + ". See `ssp top`.")
+            logging.warning("%s, starting container without cpuset" % message)
+            return {}
+        cpus, nodes = (placement.format_cpulist(items) for items in assigned)
+        logging.info("Container placed on CPUs %s of NUMA nodes %s (%s)" % (cpus, nodes, self.placement.policy))
+        return {'cpuset_cpus': cpus, 'cpuset_mems': nodes,
+                'labels': dict(labels, **{config.SSP_CPUSET_LABEL: cpus, config.SSP_PLACEMENT_LABEL: self.placement.policy})}
+
+    @Exceptions.test_wrapper
+    def top(self):
+        """CPU allocations of SSP containers of all users of the host.
+
+        :return: Topology of the host and running containers with their CPUs.
+        :rtype: (ssp.placement.Topology, [(docker.models.containers.Container, [int])])
+        """
+        host = placement.Placement(Engine.client())
+        return host.topology, host.containers()
+
+    @Exceptions.test_wrapper
+    def ps(self):
+        warm = containers.WarmContainers(Engine.client(), self.current_user)
+        for container in warm.list():
+            yield container, warm.idle_time(container), warm.sessions(container)
+
+    @Exceptions.test_wrapper
+    def stop(self, names, idle_only=False, watch=False):
+        warm = containers.WarmContainers(Engine.client(), self.current_user)
+        if watch:
+            warm.watch()
+            return []
+        if idle_only:
+            return warm.reap()
+
+        stopped = []
+        for container in warm.list():
+            if not names or container.name in names or any(container.id.startswith(name) for name in names):
+                warm.stop(container)
+                stopped.append(container)
+        return stopped
+
+    def _ensure_image(self, image, digest, rebuild, context_files):
+        # Skip the build when an image built from the very same context already exists
+        with profiler.span('find cached image'):
+            cached = digest and not rebuild and self._tag_cached_image(digest, image)
+        if cached:
+            logging.info("Image cache hit for %s (%s), skipping docker build" %
+                         (image, digest[:12]))
+            return
+        if digest and not rebuild:
+            logging.info("Image cache miss for %s (%s)" % (image, digest[:12]))
+        self._build_image(digest, context_files, image)
+
+    def _prepare_base(self, dockergen, where, from_image_id, rebuild):
+        # Shared base image is built once for all users of ssp.yaml, return its digest
+        base_image = self.config.base_image
+        files = dockergen.base_context_files(where)
+        digest = dockergen.context_digest(where, from_image_id, files)
+        if not rebuild and self._tag_cached_image(digest, base_image):
+            logging.info("Shared base image %s is up to date (%s)" %
+                         (base_image, digest[:12]))
+        else:
+            logging.info("Building shared base image %s" % base_image)
+            self._build_image(digest, files, base_image)
+        return digest
+
+    @Exceptions.test_wrapper
+    def gc(self, budget, dry_run=False):
+        """Remove least recently used SSP images and matrix build contexts of the user until they fit the budget.
+
+        Images used by any container, images of ssp.yaml, its shared base image and `from_image`,
+        and images built by this process are kept.
+
+        :param budget: Allowed disk usage in bytes.
+        :type budget: int
+        :return: Usage before and after and the removed images and contexts, see :meth:`ssp.collector.ImageCollector.collect`.
+        """
+        images = []
+        if self.config is not None:
+            images = [self.config.user_image(self.current_user), self.config.from_image]
+            if self.config.shared_base:
+                images.append(self.config.base_image)
+        images_collector = collector.ImageCollector(Engine.client(), self.current_user)
+        return images_collector.collect(budget, images_collector.protected(images, self.built_images), dry_run)
+
+    def _collect_after_build(self):
+        # Keeps disk usage under SSP_DISK_BUDGET after new images were built
+        if not config.SSP_DISK_BUDGET or not self.built_images:
+            return
+        try:
+            with profiler.span('collect images'):
+                before, after, removed = self.gc(SSPConfig.parse_size(config.SSP_DISK_BUDGET))
+        except ValueError:
+            logging.warning("Invalid SSP_DISK_BUDGET %s, expected size like 100G" % config.SSP_DISK_BUDGET)
+            return
+        except Exceptions.DockerException as error:
+            logging.warning("Unable to remove unused images: %s" % error)
+            return
+        if removed:
+            logging.info("Removed %d unused images and contexts to stay under disk budget %s, %s freed" % (
+                len(removed), config.SSP_DISK_BUDGET, context.format_size(before - after)))
+
+    @Exceptions.test_wrapper
+    def cache_stats(self):
+        """List cache volumes of the user with their size in bytes, None if unknown."""
+        volumes = caches.CacheVolumes(Engine.client(), self.current_user)
+        usage = volumes.usage()
+        return [(volume, usage.get(volume.name)) for volume in volumes.list()]
+
+    @Exceptions.test_wrapper
+    def cache_prune(self, names=(), prune_all=False):
+        """Remove cache volumes of the user which are larger than their size limit.
+
+        :param names: Remove caches with these names or volume names instead.
+        :type names: [str]
+        :param prune_all: Remove all caches of the user.
+        :type prune_all: bool
+        :return: Removed volumes with their size.
+        :rtype: [(docker.models.volumes.Volume, int)]
+        """
+        volumes = caches.CacheVolumes(Engine.client(), self.current_user)
+        removed = []
+        for volume, size in self.cache_stats():
+            labels = volume.attrs.get('Labels') or {}
+            limit = labels.get(config.SSP_SIZE_LIMIT_LABEL)
+            if names:
+                selected = volume.name in names or labels.get(config.SSP_CACHE_LABEL) in names
+            else:
+                selected = prune_all or bool(limit and size is not None and size > int(limit))
+            if not selected:
+                continue
+            try:
+                volumes.remove(volume)
+            except Exceptions.DockerException as error:
+                # Volumes of running containers cannot be removed
+                logging.warning("Cache %s not removed: %s" % (volume.name, error))
+                continue
+            logging.info("Removed cache %s" % volume.name)
+            removed.append((volume, size))
+        return removed
+
+    def _build_image(self, digest, context_files, image, output=None):
+        # Build docker image from new docker file
+        logging.info("Building Docker image %s" % image)
+        if context_files is None:
+            context_files = [('Dockerfile', pathlib.Path(
+                config.SSP_DOCKERFILE_PATH, 'Dockerfile'))]
+        # The user label lets `ssp gc` of the user collect the image once a newer build takes its name
+        labels = {config.SSP_DIGEST_LABEL: digest, config.SSP_USER_LABEL: self.current_user} if digest else None
+        with profiler.span('build image', image=image, buildkit=self.buildkit):
+            if self.buildkit:
+                Engine.buildx(context.BuildContext(context_files), image, labels,
+                              self.cache_from, self.cache_to, output, self.cpu_shares)
+            else:
+                Engine.build(context.BuildContext(context_files), image, labels, self.cpu_shares, output)
+        logging.info("Docker image successfuly built")
+        image_id = Engine.image_id(image)
+        collector.ImageCollector(Engine.client()).touch(image_id)
+        self.built_images.add(image_id)
+
+    def _container_options(self, digest, idle_timeout, local_display=None):
+        # Options of every container started by ssp, see `docker.models.containers.ContainerCollection.run`
+        labels = {config.SSP_USER_LABEL: self.current_user,
+                  config.SSP_IMAGE_LABEL: self.config.user_image(self.current_user),
+                  config.SSP_IDLE_TIMEOUT_LABEL: str(idle_timeout)}
+        if digest:
+            labels[config.SSP_DIGEST_LABEL] = digest
+        options = {'privileged': True, 'auto_remove': True, 'labels': labels}
+        mounts = []
+        if self.config.drives and self.config.drive_strategy != 'fstab':
+            mounts += self._drive_mounts()
+        if self.config.caches:
+            mounts += caches.CacheVolumes(Engine.client(), self.current_user).mounts(self.config)
+        resources = self._resource_options()
+        # Running containers are reused only with the same resources and display
+        key = sorted(resources.items())
+        if self.placement.policy:
+            key.append(('placement', self.placement.policy, self.placement.cores))
+        if local_display:
+            x11 = local_display.container_options(config.SSP_STATE_PATH.joinpath(
+                'x11', f"Xauthority-{local_display.number()}"))
+            mounts += x11.pop('mounts')
+            key.append(('display', local_display.number(), local_display.share_ipc))
+            resources.update(x11)
+        if mounts:
+            options['mounts'] = mounts
+        if key:
+            labels[config.SSP_RESOURCES_LABEL] = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12]
+            options.update(resources)
+        return options
+
+    def _resource_options(self):
+        # Scratch tmpfs and limits of the container, see `resources` of ssp.yaml
+        from docker.types import Ulimit
+
+        resources = self.resources
+        options = {}
+        if resources.scratch:
+            # Simulations and FPGA flows build executables in scratch, tmpfs of docker is noexec by default
+            tmpfs = 'rw,exec,mode=1777'
+            if resources.scratch_size:
+                tmpfs += f",size={resources.scratch_size}"
+            options['tmpfs'] = {resources.scratch: tmpfs}
+        if resources.shm_size:
+            options['shm_size'] = resources.shm_size
+        if resources.cpus:
+            options['nano_cpus'] = int(resources.cpus * 10**9)
+        if resources.memory:
+            options['mem_limit'] = resources.memory
+        if resources.ulimits:
+            options['ulimits'] = [Ulimit(name=name, soft=soft, hard=hard)
+                                  for name, (soft, hard) in sorted(resources.ulimits.items())]
+        return options
+
+    def _drive_mounts(self):
+        # Drives attached by `docker run`, instead of mounting them inside the container
+        from docker.types import DriverConfig, Mount
+
+        mounts = []
+        for drive in self.config.drives:
+            if self.config.drive_strategy == 'bind' or ':' not in drive.source:
+                mounts.append(Mount(drive.target, drive.source, type='bind'))
+                continue
+            # Volume of the local driver mounts the NFS export when a container using it starts
+            server, export = drive.source.split(':', 1)
+            name = 'ssp-nfs-' + hashlib.sha1(
+                f"{drive.source} {self.config.drive_options}".encode('utf-8')).hexdigest()[:12]
+            mounts.append(Mount(drive.target, name, type='volume', driver_config=DriverConfig(
+                'local', {'type': 'nfs', 'o': f"addr={server},{self.config.drive_options}", 'device': f":{export}"})))
+        return mounts
+
+    @classmethod
+    def _attach(cls, warm, container, command):
+        if warm:
+            warm.touch(container)
+        try:
+            with profiler.span(' '.join(command[:2]), 'subprocess'):
+                subprocess.run(command)
+        finally:
+            if warm:
+                warm.touch(container)
 
     @classmethod
     def split_items_list(cls, items):
@@ -189,13 +798,22 @@ class SSP_Launcher:
             for line in file:
                 yield line.strip('\n')
 
+    def _tag_cached_image(self, digest, image):
+        # Find image labeled with the digest and make sure the image name points to it
+        images = Engine.images(f"{config.SSP_DIGEST_LABEL}={digest}")
+        if not images:
+            return False
+        if image not in images[0].tags:
+            Engine.tag(images[0], image)
+        return True
+
     def _list_usernames(self):
-        return [user['name'] for user in self.config['users']]
+        return list(self.config.users_by_name)
 
     def _get_uid_gid(self):
-        for user in self.config['users']:
-            if user['name'] == self.current_user:
-                return user['uid'], user['gid']
+        user = self.config.users_by_name.get(self.current_user)
+        if user is not None:
+            return user.uid, user.gid
         raise Exceptions.SSPSetupError(
             "Unable to find uid and gid for current user in users definition.")
 
@@ -0,0 +1,11 @@
+import pytest
+
+from ssp import config
+
+
+@pytest.fixture(autouse=True)
+def state_path(tmp_path, monkeypatch):
+    """Keep caches and state of ssp of every test in its own directory."""
+    path = tmp_path / 'state'
+    monkeypatch.setattr(config, 'SSP_STATE_PATH', path)
+    return path
@@ -0,0 +1,62 @@
+from unittest import mock
+
+import pytest
+
+from ssp import agent
+from ssp.exceptions import Exceptions
+from ssp.model import SSPConfig
+
+
+@pytest.fixture
+def launcher(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('tool.run').write_bytes(b'installer')
+    config_path = tmp_path / 'ssp.yaml'
+    config_path.write_text('')
+    launcher = mock.MagicMock(config_path=config_path, current_user='alice')
+    launcher.config = SSPConfig.from_dict({'from_image': 'registry/ssp:1.0', 'new_image': 'custom-ssp',
+                                           'copyfiles': ['tool.run /opt/tool.run']})
+    launcher.build.return_value = 'custom-ssp-alice'
+    return launcher
+
+
+@pytest.fixture
+def ssp_agent(launcher, tmp_path):
+    return agent.Agent(launcher, skip_config=True, socket_path=tmp_path / 'agent.sock')
+
+
+def test_build_reloads_config_and_builds_in_own_context(ssp_agent, launcher, tmp_path):
+    paths = ssp_agent._build()
+    launcher.reload.assert_called_once_with()
+    launcher.build.assert_called_once_with(True, where=ssp_agent.context_path)
+    assert tmp_path / 'tool.run' in paths
+    status = ssp_agent.status()
+    assert (status['state'], status['image'], status['builds']) == ('ready', 'custom-ssp-alice', 1)
+
+
+@pytest.mark.parametrize('error', [Exceptions.DockerException('build failed'), PermissionError('denied'),
+                                   OSError(28, 'No space left on device')])
+def test_failed_build_is_reported_and_agent_keeps_running(ssp_agent, launcher, error):
+    launcher.build.side_effect = error
+    paths = ssp_agent._build()
+    assert paths[0] == ssp_agent.config_path
+    status = ssp_agent.status()
+    assert status['state'] == 'failed'
+    assert str(error) in status['error']
+
+
+def test_wait_idle_returns_when_build_finished(ssp_agent):
+    ssp_agent._update(state='building')
+    assert ssp_agent.wait_idle(timeout=0.01)['state'] == 'building'
+    ssp_agent._update(state='ready')
+    assert ssp_agent.wait_idle(timeout=0.01)['state'] == 'ready'
+
+
+def test_signature_changes_with_file(tmp_path):
+    path = tmp_path / 'ssp.yaml'
+    path.write_text('a')
+    before = agent.Agent.signature([path])
+    path.write_text('ab')
+    assert agent.Agent.signature([path]) != before
+    path.unlink()
+    assert agent.Agent.signature([path]) == [(str(path), None)]
@@ -0,0 +1,94 @@
+import os
+from unittest import mock
+
+import pytest
+
+from ssp import config
+from ssp.collector import ImageCollector
+
+GIB = 2**30
+
+
+def image(key, size=GIB, tags=(), labels=None, shared=0, created=0):
+    return {'Id': 'sha256:' + key, 'Size': size, 'SharedSize': shared, 'RepoTags': list(tags),
+            'Labels': labels or {}, 'Created': created}
+
+
+@pytest.fixture
+def client():
+    client = mock.MagicMock()
+    client.images.list.return_value = []
+    return client
+
+
+@pytest.fixture
+def collector(client, tmp_path):
+    return ImageCollector(client, 'alice', tmp_path / 'images', tmp_path / 'matrix')
+
+
+def track(collector, key, last_used):
+    collector.touch('sha256:' + key)
+    path = str(collector.state_path / key)
+    os.utime(path, (last_used, last_used))
+
+
+def test_usage_orders_tracked_images_least_recently_used_first(client, collector):
+    client.df.return_value = {'LayersSize': 3 * GIB, 'Images': [
+        image('new', tags=['ssp-new:latest']), image('old', tags=['ssp-old:latest']), image('other')]}
+    track(collector, 'new', 2000)
+    track(collector, 'old', 1000)
+    used, candidates = collector.usage()
+    assert used == 3 * GIB
+    assert [candidate[2] for candidate in candidates] == ['old', 'new']
+
+
+def test_usage_counts_only_unshared_size(client, collector):
+    client.df.return_value = {'LayersSize': GIB, 'Images': [image('a', size=GIB, shared=GIB // 4)]}
+    track(collector, 'a', 1000)
+    assert collector.usage()[1][0][3] == GIB - GIB // 4
+
+
+def test_untagged_images_of_other_users_are_not_candidates(client, collector):
+    client.df.return_value = {'LayersSize': 3 * GIB, 'Images': [
+        image('mine', labels={config.SSP_DIGEST_LABEL: 'd1', config.SSP_USER_LABEL: 'alice'}),
+        image('theirs', labels={config.SSP_DIGEST_LABEL: 'd2', config.SSP_USER_LABEL: 'bob'}),
+        image('unlabeled', labels={config.SSP_DIGEST_LABEL: 'd3'})]}
+    assert [candidate[2] for candidate in collector.usage()[1]] == ['mine']
+
+
+def test_collect_removes_until_under_budget(client, collector):
+    client.df.return_value = {'LayersSize': 3 * GIB, 'Images': [image(key) for key in ('a', 'b', 'c')]}
+    for last_used, key in enumerate(('a', 'b', 'c')):
+        track(collector, key, 1000 + last_used)
+    before, after, removed = collector.collect(int(1.5 * GIB))
+    assert (before, after) == (3 * GIB, GIB)
+    assert [candidate[2] for candidate in removed] == ['a', 'b']
+    assert [call[0][0] for call in client.images.remove.call_args_list] == ['sha256:a', 'sha256:b']
+
+
+def test_collect_skips_protected_images(client, collector):
+    client.df.return_value = {'LayersSize': 2 * GIB, 'Images': [image('a'), image('b')]}
+    track(collector, 'a', 1000)
+    track(collector, 'b', 2000)
+    _, _, removed = collector.collect(GIB, protected={'a'})
+    assert [candidate[2] for candidate in removed] == ['b']
+
+
+def test_collect_dry_run_removes_nothing(client, collector):
+    client.df.return_value = {'LayersSize': 2 * GIB, 'Images': [image('a'), image('b')]}
+    track(collector, 'a', 1000)
+    track(collector, 'b', 2000)
+    _, after, removed = collector.collect(0, dry_run=True)
+    assert after == 0 and len(removed) == 2
+    client.images.remove.assert_not_called()
+
+
+def test_matrix_contexts_are_candidates(client, collector):
+    client.df.return_value = {'LayersSize': 0, 'Images': []}
+    context = collector.contexts_path / 'abc'
+    context.mkdir(parents=True)
+    context.joinpath('Dockerfile').write_bytes(b'x' * 100)
+    collector.contexts_path.joinpath('logs').mkdir()
+    used, candidates = collector.usage()
+    assert used == 100
+    assert [(candidate[1], candidate[2]) for candidate in candidates] == [('context', str(context))]
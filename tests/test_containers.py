@@ -0,0 +1,85 @@
+import fcntl
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from ssp import config
+from ssp.containers import WarmContainers
+
+
+def container(number, idle_timeout=3600, processes=()):
+    container = mock.MagicMock(id='%064x' % number, short_id='%012x' % number, attrs={},
+                               labels={config.SSP_IDLE_TIMEOUT_LABEL: str(idle_timeout)})
+    container.top.return_value = {'Processes': [['1', process] for process in processes]}
+    return container
+
+
+@pytest.fixture
+def running():
+    return []
+
+
+@pytest.fixture
+def warm(running):
+    client = mock.MagicMock()
+    client.containers.list.side_effect = lambda **kwargs: list(running)
+    return WarmContainers(client, 'alice')
+
+
+def idle_for(warm, container, seconds):
+    warm.touch(container)
+    last_used = time.time() - seconds
+    os.utime(str(warm.state_path / container.id), (last_used, last_used))
+
+
+def test_reap_stops_only_idle_containers_without_sessions(warm, running):
+    idle, busy, recent = container(1, 60), container(2, 60, ['sshd: alice@pts/0']), container(3, 60)
+    running += [idle, busy, recent]
+    idle_for(warm, idle, 120)
+    idle_for(warm, busy, 120)
+    idle_for(warm, recent, 10)
+    idle.stop.side_effect = lambda: running.remove(idle)
+    assert warm.reap() == [idle]
+    busy.stop.assert_not_called()
+    recent.stop.assert_not_called()
+    assert not (warm.state_path / idle.id).exists()
+
+
+def test_reap_forgets_removed_containers(warm, running):
+    gone = container(1)
+    warm.touch(gone)
+    warm.reap()
+    assert not (warm.state_path / gone.id).exists()
+
+
+def test_reap_leaves_held_watch_lock_alone(warm, running):
+    running.append(container(1))
+    warm.touch(running[0])
+    warm.state_path.joinpath('notes').write_text('')
+    with warm.lock_path.open('a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        inode = os.fstat(lock.fileno()).st_ino
+        warm.reap()
+        assert warm.lock_path.stat().st_ino == inode
+    assert warm.state_path.joinpath('notes').exists()
+
+
+def test_second_watcher_returns_while_first_holds_lock(warm, running):
+    running.append(container(1))
+    warm.lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with warm.lock_path.open('a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with mock.patch.object(warm, 'reap') as reap:
+            warm.watch(interval=0)
+        reap.assert_not_called()
+
+
+def test_watcher_exits_with_last_container(warm, running):
+    idle = container(1, 0)
+    running.append(idle)
+    idle_for(warm, idle, 10)
+    idle.stop.side_effect = lambda: running.remove(idle)
+    warm.watch(interval=0)
+    idle.stop.assert_called_once_with()
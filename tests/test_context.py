@@ -0,0 +1,73 @@
+import io
+import tarfile
+
+import pytest
+
+from ssp import manifest
+from ssp.context import BuildContext
+from ssp.exceptions import Exceptions
+
+
+@pytest.fixture
+def sources(tmp_path):
+    tmp_path.joinpath('Dockerfile').write_text('FROM registry/ssp:1.0\n')
+    tmp_path.joinpath('tool.run').write_bytes(b'x' * (BuildContext.CHUNK_SIZE + 100))
+    tmp_path.joinpath('licenses', 'eda').mkdir(parents=True)
+    tmp_path.joinpath('licenses', 'eda', 'a.lic').write_text('license')
+    return tmp_path
+
+
+def files_of(sources):
+    files = [('Dockerfile', sources / 'Dockerfile')]
+    for name in ('tool.run', 'licenses'):
+        files += manifest.walk(sources / name, name)
+    return files
+
+
+def untar(context):
+    with tarfile.open(fileobj=io.BytesIO(b''.join(context.stream()))) as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+
+
+def test_stream_is_tar_of_the_files(sources):
+    context = BuildContext(files_of(sources))
+    content = untar(context)
+    assert content == {'Dockerfile': b'FROM registry/ssp:1.0\n',
+                       'tool.run': b'x' * (BuildContext.CHUNK_SIZE + 100),
+                       'licenses/eda/a.lic': b'license'}
+    assert context.bytes_sent % tarfile.BLOCKSIZE == 0
+    assert context.duration is not None
+
+
+def test_stream_keeps_file_mode(sources):
+    sources.joinpath('tool.run').chmod(0o755)
+    context = BuildContext([('tool.run', sources / 'tool.run')])
+    with tarfile.open(fileobj=io.BytesIO(b''.join(context.stream()))) as archive:
+        assert archive.getmember('tool.run').mode == 0o755
+
+
+def test_file_truncated_while_streaming_is_an_error(sources):
+    context = BuildContext([('tool.run', sources / 'tool.run')])
+    stream = context.stream()
+    next(stream)
+    sources.joinpath('tool.run').write_bytes(b'short')
+    with pytest.raises(Exceptions.SSPSetupError, match='changed while sending'):
+        list(stream)
+
+
+def test_content_manifest_is_reused_by_next_process(sources, tmp_path):
+    path = tmp_path / 'content-manifest.json'
+    first = manifest.ContentManifest(path)
+    digest = first.sha256(sources / 'tool.run')
+    first.save()
+    second = manifest.ContentManifest(path)
+    assert second.sha256(sources / 'tool.run') == digest
+    assert second.hashed_bytes == 0
+
+
+def test_content_manifest_hashes_changed_file_again(sources, tmp_path):
+    content = manifest.ContentManifest(tmp_path / 'content-manifest.json')
+    digest = content.sha256(sources / 'tool.run')
+    sources.joinpath('tool.run').write_bytes(b'y' * 10)
+    assert content.sha256(sources / 'tool.run') != digest
+
@@ -0,0 +1,61 @@
+import subprocess
+from unittest import mock
+
+import pytest
+
+from ssp.engine import Engine
+
+INSPECT = """Name:          ssp
+Driver:        {driver}
+
+Nodes:
+Name:      ssp0
+Endpoint:  unix:///var/run/docker.sock
+Status:    running
+"""
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = mock.MagicMock()
+    monkeypatch.setattr(Engine, 'client', classmethod(lambda cls: client))
+    return client
+
+
+def inspect(driver):
+    return mock.patch('subprocess.run', return_value=subprocess.CompletedProcess(
+        [], 0, stdout=INSPECT.format(driver=driver)))
+
+
+def test_buildkit_container_is_deprioritized_during_build(client):
+    container = client.containers.get.return_value
+    container.attrs = {'HostConfig': {'CpuShares': 0}}
+    with inspect('docker-container'):
+        with Engine.buildkit_priority(128):
+            container.update.assert_called_once_with(cpu_shares=128)
+    client.containers.get.assert_called_once_with('buildx_buildkit_ssp0')
+    assert container.update.call_args_list[-1] == mock.call(cpu_shares=1024)
+
+
+def test_priority_is_restored_when_build_fails(client):
+    container = client.containers.get.return_value
+    container.attrs = {'HostConfig': {'CpuShares': 512}}
+    with inspect('docker-container'), pytest.raises(RuntimeError):
+        with Engine.buildkit_priority(128):
+            raise RuntimeError('build failed')
+    assert container.update.call_args_list[-1] == mock.call(cpu_shares=512)
+
+
+def test_docker_driver_builds_at_normal_priority(client, caplog):
+    with inspect('docker'):
+        with Engine.buildkit_priority(128):
+            pass
+    client.containers.get.assert_not_called()
+    assert 'normal CPU priority' in caplog.text
+
+
+def test_no_priority_does_not_inspect_builder(client):
+    with mock.patch('subprocess.run') as run:
+        with Engine.buildkit_priority(None):
+            pass
+    run.assert_not_called()
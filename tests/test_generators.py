@@ -0,0 +1,100 @@
+import pytest
+
+from ssp.generators import Dockergen
+from ssp.model import SSPConfig
+
+BASE = {'from_image': 'registry/ssp:1.0', 'new_image': 'custom-ssp', 'groups': {'eda': 4000},
+        'users': [{'name': 'alice', 'uid': 8001, 'gid': 4000}]}
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('small.cfg').write_bytes(b'x' * 10)
+    tmp_path.joinpath('large.run').write_bytes(b'x' * 10000)
+    tmp_path.joinpath('tool.json').write_bytes(b'{}')
+    return tmp_path
+
+
+def render(**raw):
+    ssp_config = SSPConfig.from_dict(dict(BASE, **raw))
+    return Dockergen(ssp_config, 'alice').render_dockerfile(True, 8001, 4000)
+
+
+def lines(dockerfile, *prefixes):
+    return [line for line in dockerfile.splitlines() if line.startswith(prefixes)]
+
+
+def position(dockerfile, text):
+    index = dockerfile.find(text)
+    assert index >= 0, text
+    return index
+
+
+def test_config_order_follows_ssp_yaml():
+    dockerfile = render(export=['EDITOR=vim'], symlinks=['/opt/a /opt/b'])
+    assert position(dockerfile, 'groupadd') < position(dockerfile, 'ln -s') < position(dockerfile, 'ENV EDITOR')
+    assert position(dockerfile, 'ENV EDITOR') < position(dockerfile, 'cpm init')
+
+
+def test_cost_order_moves_independent_sections_after_cpm_init():
+    dockerfile = render(layer_order='cost', after_cpm_init=['users', 'export'], export=['EDITOR=vim'])
+    cpm_init = position(dockerfile, 'cpm init')
+    assert position(dockerfile, 'groupadd') > cpm_init
+    assert position(dockerfile, 'ENV EDITOR') > cpm_init
+    assert position(dockerfile, 'RUN chown') < cpm_init
+
+
+def test_cost_order_keeps_what_cpm_init_reads_ahead_of_it():
+    export = ['EDITOR=vim', 'CPM_REPOSITORY=https://cpm', 'LD_LIBRARY_PATH=/opt/lib', 'TOOLS=/prj/ssp/tools',
+              'PROMPT=$USER']
+    symlinks = ['/opt/tools /prj/ssp/tools', '/opt/a /opt/b']
+    dockerfile = render(layer_order='cost', after_cpm_init=['export', 'symlinks'], export=export, symlinks=symlinks)
+    cpm_init = position(dockerfile, 'cpm init')
+    for item in export[1:]:
+        assert position(dockerfile, item) < cpm_init, item
+    assert position(dockerfile, 'EDITOR=vim') > cpm_init
+    assert position(dockerfile, 'ln -s /opt/tools /prj/ssp/tools') < cpm_init
+    assert position(dockerfile, 'ln -s /opt/a /opt/b') > cpm_init
+
+
+def test_cost_order_without_after_cpm_init_keeps_sections_ahead():
+    dockerfile = render(layer_order='cost', export=['EDITOR=vim'], symlinks=['/opt/a /opt/b'])
+    cpm_init = position(dockerfile, 'cpm init')
+    assert position(dockerfile, 'groupadd') < cpm_init
+    assert position(dockerfile, 'ENV EDITOR') < cpm_init
+    assert position(dockerfile, 'ln -s') < cpm_init
+
+
+def test_cost_order_groups_cheap_instructions():
+    dockerfile = render(layer_order='cost', after_cpm_init=['export', 'symlinks'],
+                        export=['EDITOR=vim', 'PAGER=less'], symlinks=['/opt/a /opt/b', '/opt/c /opt/d'])
+    assert len(lines(dockerfile, 'ENV ')) == 1
+    assert len(lines(dockerfile, 'RUN ln -s')) == 1
+    # References to variables need instructions of their own
+    dockerfile = render(layer_order='cost', after_cpm_init=['export'], export=['A=1', 'B=$A'])
+    assert lines(dockerfile, 'ENV ') == ['ENV A=1', 'ENV B=$A']
+
+
+def test_cost_order_copies_largest_files_first(sources):
+    copyfiles = ['small.cfg /opt/small.cfg', 'large.run /opt/large.run', 'tool.json /prj/ssp/tool.json']
+    dockerfile = render(layer_order='cost', after_cpm_init=['copyfiles'], copyfiles=copyfiles)
+    cpm_init = position(dockerfile, 'cpm init')
+    assert position(dockerfile, 'COPY tool.json /prj/ssp/tool.json') < cpm_init
+    assert cpm_init < position(dockerfile, 'COPY large.run') < position(dockerfile, 'COPY small.cfg')
+
+
+def test_cost_order_keeps_order_of_overlapping_copyfiles(sources):
+    copyfiles = ['small.cfg /opt/tools', 'large.run /opt/tools/large.run']
+    dockerfile = render(layer_order='cost', after_cpm_init=['copyfiles'], copyfiles=copyfiles)
+    assert position(dockerfile, 'COPY small.cfg') < position(dockerfile, 'COPY large.run')
+
+
+
+def test_state_ownership_changes_the_same_entries_as_chown():
+    chown = Dockergen.ownership_instruction('chown', 8001, 4000)
+    state = Dockergen.ownership_instruction('state', 8001, 4000)
+    assert '/prj/ssp /prj/ssp/** /prj/ssp/.cpm' in chown
+    assert '/prj/ssp /prj/ssp/** /prj/ssp/.cpm -maxdepth 0' in state
+    assert '! \\( -user 8001 -group 4000 \\)' in state
+    assert 'chown 8001:4000' in state
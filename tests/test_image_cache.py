@@ -0,0 +1,97 @@
+import sys
+
+import pytest
+
+from benchmarks.fake_docker import FakeDockerEngine
+from ssp import config
+from ssp.engine import Engine
+from ssp.generators import Dockergen
+from ssp.model import SSPConfig
+from ssp.ssp import SSP_Launcher
+
+SSP_YAML = """\
+from_image: registry/ssp:1.0
+new_image: custom-ssp
+users:
+    - name: alice
+      uid: 8001
+      gid: 4000
+"""
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    with FakeDockerEngine(images=['registry/ssp:1.0']) as engine:
+        monkeypatch.setattr(config, 'SSP_DOCKER_HOST', engine.url)
+        monkeypatch.setattr(Engine, '_client', None)
+        yield engine
+    Engine._client = None
+
+
+@pytest.fixture
+def launcher(tmp_path, monkeypatch):
+    # The launcher hides tracebacks of the CLI
+    monkeypatch.setattr(sys, 'tracebacklimit', 1000, raising=False)
+    config_path = tmp_path / 'ssp.yaml'
+    config_path.write_text(SSP_YAML)
+    launcher = SSP_Launcher(config_path)
+    launcher.current_user = 'alice'
+    return launcher
+
+
+@pytest.fixture
+def context_files(tmp_path):
+    dockerfile = tmp_path / 'Dockerfile'
+    dockerfile.write_text('FROM registry/ssp:1.0\n')
+    return [('Dockerfile', dockerfile)]
+
+
+def builds(engine):
+    return sum(1 for method, path, _ in engine.calls if (method, path.rpartition('/')[2]) == ('POST', 'build'))
+
+
+def test_cache_miss_builds_and_hit_skips_build(engine, launcher, context_files):
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, False, context_files)
+    assert builds(engine) == 1
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, False, context_files)
+    assert builds(engine) == 1
+    launcher._ensure_image('custom-ssp-alice', 'b' * 64, False, context_files)
+    assert builds(engine) == 2
+
+
+def test_rebuild_and_unknown_digest_always_build(engine, launcher, context_files):
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, False, context_files)
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, True, context_files)
+    launcher._ensure_image('custom-ssp-alice', None, False, context_files)
+    assert builds(engine) == 3
+
+
+def test_cached_image_is_tagged_with_requested_name(engine, launcher, context_files):
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, False, context_files)
+    launcher._ensure_image('custom-ssp-team:latest', 'a' * 64, False, context_files)
+    assert builds(engine) == 1
+    assert Engine.image_id('custom-ssp-team:latest') == Engine.image_id('custom-ssp-alice')
+
+
+def test_built_image_is_labeled_with_digest_and_user(engine, launcher, context_files):
+    launcher._ensure_image('custom-ssp-alice', 'a' * 64, False, context_files)
+    labels = Engine.client().images.get('custom-ssp-alice').labels
+    assert labels[config.SSP_DIGEST_LABEL] == 'a' * 64
+    assert labels[config.SSP_USER_LABEL] == 'alice'
+
+
+def test_context_digest_follows_content(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('Dockerfile').write_text('FROM registry/ssp:1.0\n')
+    tmp_path.joinpath('licenses').mkdir()
+    tmp_path.joinpath('licenses', 'a.lic').write_text('license')
+    ssp_config = SSPConfig.from_dict({'from_image': 'registry/ssp:1.0', 'new_image': 'custom-ssp',
+                                      'copyfiles': ['licenses /opt/licenses']})
+    dockergen = Dockergen(ssp_config, 'alice')
+    digest = dockergen.context_digest(tmp_path, 'sha256:base')
+    assert Dockergen(ssp_config, 'alice').context_digest(tmp_path, 'sha256:base') == digest
+    assert dockergen.context_digest(tmp_path, 'sha256:other') != digest
+    tmp_path.joinpath('licenses', 'a.lic').write_text('renewed')
+    assert dockergen.context_digest(tmp_path, 'sha256:base') != digest
+    tmp_path.joinpath('Dockerfile').write_text('FROM registry/ssp:1.1\n')
+    assert dockergen.context_digest(tmp_path, 'sha256:base') != digest
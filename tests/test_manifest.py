@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from ssp import manifest
+from ssp.exceptions import Exceptions
+
+
+@pytest.fixture
+def sources(tmp_path):
+    path = tmp_path / 'sources'
+    path.mkdir()
+    path.joinpath('tool.run').write_bytes(b'installer')
+    path.joinpath('licenses').mkdir()
+    path.joinpath('licenses', 'a.lic').write_text('a')
+    return path
+
+
+@pytest.fixture
+def where(tmp_path):
+    path = tmp_path / 'context'
+    path.mkdir()
+    return path
+
+
+def files_of(sources):
+    return [copied for source in sorted(sources.iterdir()) for copied in manifest.walk(source, source.name)]
+
+
+def test_stage_places_files_and_records_them(sources, where):
+    counts = manifest.stage(files_of(sources), where)
+    assert where.joinpath('tool.run').read_bytes() == b'installer'
+    assert where.joinpath('licenses', 'a.lic').read_text() == 'a'
+    assert sum(counts.values()) == 2 and counts['unchanged'] == 0
+    assert where.joinpath(manifest.STAGED_MANIFEST).exists()
+
+
+def test_stage_again_leaves_unchanged_files(sources, where):
+    manifest.stage(files_of(sources), where)
+    counts = manifest.stage(files_of(sources), where)
+    assert counts['unchanged'] == 2
+
+
+def test_stage_removes_files_no_longer_copied(sources, where):
+    manifest.stage(files_of(sources), where)
+    sources.joinpath('tool.run').unlink()
+    manifest.stage(files_of(sources), where)
+    assert not where.joinpath('tool.run').exists()
+    assert where.joinpath('licenses', 'a.lic').exists()
+
+
+def test_stage_refuses_to_replace_user_file(sources, where):
+    where.joinpath('tool.run').write_bytes(b'work of the user')
+    with pytest.raises(Exceptions.SSPSetupError, match='tool.run'):
+        manifest.stage(files_of(sources), where)
+    assert where.joinpath('tool.run').read_bytes() == b'work of the user'
+    # Nothing is staged when the dry run stops
+    assert not where.joinpath('licenses').exists()
+
+
+def test_stage_keeps_user_file_with_same_name_as_source(sources, where):
+    # Running from the directory of the sources, the files are the same
+    os.link(str(sources / 'tool.run'), str(where / 'tool.run'))
+    manifest.stage(files_of(sources), where)
+    sources.joinpath('tool.run').unlink()
+    manifest.stage(files_of(sources), where)
+    assert where.joinpath('tool.run').read_bytes() == b'installer'
+
+
+def test_stage_keeps_staged_file_modified_by_user(sources, where):
+    staged = files_of(sources)
+    manifest.stage(staged, where)
+    where.joinpath('tool.run').unlink()
+    where.joinpath('tool.run').write_bytes(b'edited')
+    manifest.stage([copied for copied in staged if copied[0] != 'tool.run'], where)
+    assert where.joinpath('tool.run').read_bytes() == b'edited'
+
+
+def test_content_manifest_reuses_hash_of_unchanged_file(sources, tmp_path):
+    content = manifest.ContentManifest(tmp_path / 'content-manifest.json')
+    digest = content.sha256(sources / 'tool.run')
+    hashed = content.hashed_bytes
+    assert content.sha256(sources / 'tool.run') == digest
+    assert content.hashed_bytes == hashed
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from ssp.exceptions import Exceptions
+from ssp.model import SSPConfig
+
+MINIMAL = {'from_image': 'registry/ssp:1.0', 'new_image': 'custom-ssp'}
+
+SSP_YAML = """\
+from_image: registry/ssp:1.0
+new_image: custom-ssp
+users:
+    - name: alice
+      uid: 8001
+      gid: 4000
+export:
+    - EDITOR=vim
+"""
+
+
+def test_minimal_defaults():
+    ssp_config = SSPConfig.from_dict(dict(MINIMAL))
+    assert ssp_config.layer_order == 'config'
+    assert ssp_config.after_cpm_init == []
+    assert ssp_config.base_image == 'custom-ssp-base'
+    assert ssp_config.cache_mounts == ['/root/.cache']
+
+
+def test_all_errors_are_reported_at_once():
+    raw = dict(MINIMAL, new_image='', layer_order='fastest', after_cpm_init=['cpm'],
+               users=[{'name': 'alice', 'uid': 'x', 'gid': 1}], placement={'policy': 'random'})
+    with pytest.raises(Exceptions.ConfigurationError) as error:
+        SSPConfig.from_dict(raw)
+    message = str(error.value)
+    assert "`new_image` has to be an image name" in message
+    assert "`layer_order` has to be one of: config, cost" in message
+    assert "`after_cpm_init` sections have to be some of" in message
+    assert "uid and gid of user alice have to be numbers" in message
+    assert "`placement` policy has to be one of" in message
+
+
+def test_duplicate_uid_is_an_error():
+    users = [{'name': 'alice', 'uid': 8001, 'gid': 4000}, {'name': 'bob', 'uid': 8001, 'gid': 4000}]
+    with pytest.raises(Exceptions.ConfigurationError, match='uid'):
+        SSPConfig.from_dict(dict(MINIMAL, users=users))
+
+
+def test_invalid_yaml_is_configuration_error():
+    with pytest.raises(Exceptions.ConfigurationError, match='Unable to parse'):
+        SSPConfig.from_yaml('users: [')
+
+
+def test_cache_is_reused_while_file_is_unchanged(tmp_path, monkeypatch):
+    path = tmp_path / 'ssp.yaml'
+    path.write_text(SSP_YAML)
+    first = SSPConfig.load(path)
+
+    def parse(*args, **kwargs):
+        raise AssertionError("ssp.yaml parsed again")
+
+    monkeypatch.setattr(SSPConfig, 'from_yaml', parse)
+    assert SSPConfig.load(path).users_by_name['alice'].uid == first.users_by_name['alice'].uid
+
+
+def test_cache_is_invalidated_by_change(tmp_path):
+    path = tmp_path / 'ssp.yaml'
+    path.write_text(SSP_YAML)
+    SSPConfig.load(path)
+    path.write_text(SSP_YAML.replace('EDITOR=vim', 'EDITOR=emacs'))
+    # Same size, only the modification time tells the change apart
+    stat = path.stat()
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert SSPConfig.load(path).export == ['EDITOR=emacs']
+
+
+def test_cache_of_other_version_is_ignored(tmp_path, monkeypatch):
+    path = tmp_path / 'ssp.yaml'
+    path.write_text(SSP_YAML)
+    SSPConfig.load(path)
+    monkeypatch.setattr(SSPConfig, 'CACHE_VERSION', SSPConfig.CACHE_VERSION + 1)
+    parsed = []
+    from_yaml = SSPConfig.from_yaml.__func__
+
+    def parse(cls, *args, **kwargs):
+        parsed.append(args)
+        return from_yaml(cls, *args, **kwargs)
+
+    monkeypatch.setattr(SSPConfig, 'from_yaml', classmethod(parse))
+    SSPConfig.load(path)
+    assert parsed
+
+
+def test_corrupted_cache_is_ignored(tmp_path, state_path):
+    path = tmp_path / 'ssp.yaml'
+    path.write_text(SSP_YAML)
+    SSPConfig.load(path)
+    for cache in state_path.joinpath('cache').glob('config-*.pickle'):
+        cache.write_bytes(b'not a pickle')
+    assert SSPConfig.load(path).users_by_name['alice'].gid == 4000
@@ -0,0 +1,89 @@
+import time
+from unittest import mock
+
+import pytest
+
+from ssp import config, placement
+from ssp.placement import Placement, Topology
+
+# Two NUMA nodes of four CPUs, hyperthreads of a core are next to each other
+NODES = {0: [0, 4, 1, 5], 1: [2, 6, 3, 7]}
+
+
+def container(status, cpus, created=None):
+    created = created or time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime())
+    return mock.MagicMock(status=status, labels={config.SSP_CPUSET_LABEL: cpus}, attrs={'Created': created})
+
+
+def host(*containers):
+    client = mock.MagicMock()
+    client.containers.list.return_value = list(containers)
+    return Placement(client, Topology(NODES))
+
+
+def test_cpulist_round_trip():
+    assert placement.parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert placement.format_cpulist([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+
+
+def test_topology_from_sysfs(tmp_path):
+    cpu = tmp_path / 'cpu'
+    cpu.mkdir()
+    cpu.joinpath('online').write_text('0-3\n')
+    for number, siblings in ((0, '0,2'), (1, '1,3'), (2, '0,2'), (3, '1,3')):
+        cpu.joinpath(f"cpu{number}", 'topology').mkdir(parents=True)
+        cpu.joinpath(f"cpu{number}", 'topology', 'thread_siblings_list').write_text(siblings)
+    tmp_path.joinpath('node', 'node0').mkdir(parents=True)
+    tmp_path.joinpath('node', 'node0', 'cpulist').write_text('0-3')
+    assert Topology.from_sysfs(tmp_path).nodes == {0: [0, 2, 1, 3]}
+
+
+def test_packed_fills_used_node_first():
+    assert host().assign(2, 'packed', used={0, 4}) == ([1, 5], [0])
+
+
+def test_spread_uses_node_with_most_free_cpus():
+    assert host().assign(2, 'spread', used={0, 4}) == ([2, 6], [1])
+
+
+def test_large_container_spans_nodes():
+    assert host().assign(6, 'packed', used={0, 4}) == ([1, 2, 3, 5, 6, 7], [0, 1])
+
+
+def test_no_placement_when_cpus_are_taken():
+    assert host().assign(3, 'reserved', used={0, 1, 2, 3, 4, 5}) is None
+
+
+def test_only_running_and_starting_containers_hold_cpus():
+    used = host(container('running', '0-1'), container('created', '2'),
+                container('created', '3', created='2020-01-01T00:00:00.000000000Z'),
+                container('exited', '4'), container('running', '')).used()
+    assert used == {0, 1, 2}
+
+
+def test_lock_is_not_waited_for_forever(tmp_path, monkeypatch):
+    monkeypatch.setattr(Placement, 'LOCK_PATH', tmp_path / 'placement.lock')
+    held = Placement.lock()
+    try:
+        started = time.monotonic()
+        assert Placement.lock(timeout=0.2) is None
+        assert time.monotonic() - started < 5
+    finally:
+        held.close()
+    lock = Placement.lock(timeout=0.2)
+    assert lock is not None
+    lock.close()
+
+
+def test_lock_does_not_follow_symlink(tmp_path, monkeypatch):
+    target = tmp_path / 'target'
+    target.write_text('')
+    tmp_path.joinpath('placement.lock').symlink_to(target)
+    monkeypatch.setattr(Placement, 'LOCK_PATH', tmp_path / 'placement.lock')
+    assert Placement.lock() is None
+
+
+@pytest.mark.parametrize('policy', ['packed', 'spread'])
+def test_cpus_of_one_core_go_together(policy):
+    cpus, _ = host().assign(2, policy, used=set())
+    assert cpus in ([0, 4], [2, 6])
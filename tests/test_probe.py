@@ -0,0 +1,27 @@
+from unittest import mock
+
+import docker
+import pytest
+
+from ssp.exceptions import Exceptions
+from ssp.probe import SSHReadiness
+
+
+def test_removed_container_is_reported_as_exited():
+    container = mock.MagicMock(short_id='abc')
+    container.reload.side_effect = docker.errors.NotFound('No such container')
+    with pytest.raises(Exceptions.DockerException, match='Container abc is exited'):
+        SSHReadiness(container).wait()
+
+
+def test_api_error_is_docker_exception():
+    container = mock.MagicMock(short_id='abc')
+    container.reload.side_effect = docker.errors.APIError('Server error')
+    with pytest.raises(Exceptions.DockerException, match='Docker Engine API error'):
+        SSHReadiness(container).wait()
+
+
+def test_stopped_container_is_not_waited_for():
+    container = mock.MagicMock(short_id='abc', status='created')
+    with pytest.raises(Exceptions.DockerException, match='is created'):
+        SSHReadiness(container).wait()
@@ -0,0 +1,149 @@
+import json
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from ssp.engine import Engine
+from ssp.exceptions import Exceptions
+from ssp.registry import Registry
+from ssp.ssp import SSP_Launcher
+
+DIGEST = 'sha256:' + 'd' * 64
+MANIFEST = {'layers': [{'digest': 'sha256:' + 'l' * 64}]}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_GET(self):
+        self._reply()
+
+    def _reply(self):
+        registry = self.server.registry
+        registry['requests'].append((self.command, self.path, self.headers.get('Authorization')))
+        if self.path.startswith('/token'):
+            return self._send(200, json.dumps({'token': 'secret'}).encode('utf-8'))
+        if registry['challenge'] and self.headers.get('Authorization') != 'Bearer secret':
+            return self._send(401, b'', {'WWW-Authenticate': registry['challenge'] % self.server.server_port})
+        if '/manifests/' in self.path:
+            return self._send(200, json.dumps(MANIFEST).encode('utf-8'), {'Docker-Content-Digest': DIGEST})
+        if '/blobs/' in self.path:
+            return self._send(206, b'x' * 1024)
+        return self._send(404, b'')
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def registry():
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    server.registry = {'challenge': None, 'requests': []}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server):
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+def closed_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def test_manifest_digest(registry):
+    assert Registry(url(registry)).manifest_digest('free/ssp', '1.0') == DIGEST
+    method, path, _ = registry.registry['requests'][0]
+    assert (method, path) == ('HEAD', '/v2/free/ssp/manifests/1.0')
+
+
+def test_manifest_digest_with_bearer_token(registry):
+    registry.registry['challenge'] = 'Bearer realm="http://127.0.0.1:%d/token",service="registry"'
+    assert Registry(url(registry)).manifest_digest('free/ssp', '1.0') == DIGEST
+    token = [request for request in registry.registry['requests'] if request[1].startswith('/token')]
+    assert token and 'scope=repository%3Afree%2Fssp%3Apull' in token[0][1]
+    assert registry.registry['requests'][-1][2] == 'Bearer secret'
+
+
+def test_challenge_without_realm_is_docker_exception(registry):
+    registry.registry['challenge'] = 'Bearer service="registry%d"'
+    with pytest.raises(Exceptions.DockerException, match='did not name its token service'):
+        Registry(url(registry)).manifest_digest('free/ssp', '1.0')
+
+
+def test_malformed_credentials_are_not_sent(tmp_path, monkeypatch):
+    tmp_path.joinpath('.docker').mkdir()
+    tmp_path.joinpath('.docker', 'config.json').write_text(
+        json.dumps({'auths': {'registry.example': {'auth': 'not base64!'}}}))
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert Registry('registry.example')._credentials() is None
+
+
+def test_unreachable_registry_is_docker_exception():
+    with pytest.raises(Exceptions.DockerException, match='Unable to reach'):
+        Registry('http://127.0.0.1:%d' % closed_port(), timeout=1.0).manifest_digest('free/ssp', '1.0')
+
+
+def test_rank_orders_reachable_registries(registry):
+    registries = {'down': Registry('http://127.0.0.1:%d' % closed_port(), timeout=1.0),
+                  'local': Registry(url(registry))}
+    assert Registry.rank(registries, {'down': 'free/ssp', 'local': 'free/ssp'}, '1.0') == ['local']
+
+
+def test_rank_prefers_measured_throughput(monkeypatch):
+    results = {'slow': (0.01, 1e6), 'fast': (0.05, 1e8), 'unknown': (0.001, None)}
+    monkeypatch.setattr(Registry, 'probe', lambda self, repository, tag: results[self.host])
+    registries = {name: Registry('http://' + name) for name in results}
+    assert Registry.rank(registries, dict.fromkeys(results, 'free/ssp'), '1.0') == ['fast', 'slow', 'unknown']
+
+
+@pytest.fixture
+def launcher(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'tracebacklimit', 1000, raising=False)
+    monkeypatch.setattr(Engine, '_healthy', True)
+    launcher = SSP_Launcher(tmp_path / 'ssp.yaml', require_yaml_exists=False)
+    launcher.registries = {name: {'url': 'https://%s.example' % name, 'distributions': {'free': 'free/ssp'}}
+                           for name in ('eu', 'us')}
+    return launcher
+
+
+def test_download_fails_over_to_next_registry(launcher, monkeypatch):
+    attempts = []
+
+    def download(registry_config, distribution, version, check, stall_timeout):
+        attempts.append((registry_config['url'], stall_timeout))
+        if len(attempts) == 1:
+            raise Exceptions.DockerException('pull stalled')
+        return True
+
+    monkeypatch.setattr(Registry, 'rank', classmethod(lambda cls, registries, repositories, tag: ['eu', 'us']))
+    monkeypatch.setattr(launcher, '_download', download)
+    assert launcher.download('1.0', 'auto', failover=True, stall_timeout=30)
+    # The last registry is not given up on stalls
+    assert attempts == [('https://eu.example', 30), ('https://us.example', None)]
+
+
+def test_download_without_failover_raises(launcher, monkeypatch):
+    def download(*args):
+        raise Exceptions.DockerException('pull failed')
+
+    monkeypatch.setattr(launcher, '_download', download)
+    with pytest.raises(Exceptions.DockerException, match='pull failed'):
+        launcher.download('1.0', 'eu')